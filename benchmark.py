@@ -0,0 +1,541 @@
+"""
+Бенчмарки бота проти локальних заглушок Apps Script, OpenAI та Telegram.
+
+Запуск:
+    python benchmark.py --players 50 100 200 --latency 0.5
+    python benchmark.py --e2e --players 50 200 --rounds 3 --output results.json
+
+Без --e2e порівнює старий блокуючий виклик (синхронний POST всередині обробника)
+з асинхронним GoogleSheetsAPI на спільному пулі з'єднань.
+
+З --e2e будує синтетичні оновлення Telegram і проганяє через обробники бота
+повний сценарій гравця: вибір класу, дії (handle_message), кидки кубика, /stats.
+Звітує пропускну здатність і p50/p95/p99 затримки по кожному обробнику.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import httpx
+
+STUB_PLAYER = {
+    'user_id': '0', 'name': 'Bench', 'class': 'knight', 'level': 1,
+    'hp_current': 15, 'hp_max': 15, 'mp_current': 0, 'mp_max': 0,
+    'str': 15, 'dex': 10, 'con': 14, 'int': 8, 'wis': 12, 'cha': 13,
+    'xp': 0, 'gold': 50, 'inventory': 'sword,shield,chainmail'
+}
+
+
+GM_RESPONSE = {
+    'main_response': 'Орк ричить і замахується сокирою. Ви встигаєте підняти щит - час відповісти ударом!',
+    'action_type': 'simple',
+    'dice_required': {'type': 'd20', 'modifier_stat': 'STR', 'difficulty': 13, 'damage_dice': 'd8'},
+    'hint': 'Лицар може використати Могутній удар, щоб подвоїти урон.',
+    'consequences': {'success': 'Орк падає', 'failure': 'Орк контратакує'},
+    'xp_reward': 10,
+    'gold_reward': 5
+}
+
+PLAYER_ACTIONS = [
+    'Атакую орка мечем',
+    'Шукаю скарби в печері',
+    'Розмовляю з торговцем',
+    'Йду в ліс',
+    'Використовую зілля лікування',
+    'Скільки в мене золота?',
+]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Спільна основа заглушок: затримка, частка помилок і лічильники запитів"""
+
+    latency = 0.0
+    error_rate = 0.0
+    protocol_version = 'HTTP/1.1'
+    # Заголовки і тіло однією відправкою, без затримки Nagle/delayed ACK
+    wbufsize = 64 * 1024
+
+    @classmethod
+    def configure(cls, latency: float, error_rate: float = 0.0):
+        cls.latency = latency
+        cls.error_rate = error_rate
+        cls.counters = {'requests': 0, 'errors': 0}
+        cls.lock = threading.Lock()
+
+    def count(self, failed: bool):
+        with self.lock:
+            self.counters['requests'] += 1
+            self.counters['errors'] += failed
+
+    def should_fail(self) -> bool:
+        failed = random.random() < self.error_rate
+        self.count(failed)
+        return failed
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+    def send_json(self, body, status: int = 200):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SlowAppsScriptHandler(StubHandler):
+    """Заглушка Apps Script: протокол JSON дій бота із затримкою"""
+
+    latency = 0.5
+    # user_id -> рядок гравця; невідомі гравці отримують STUB_PLAYER
+    players = {}
+
+    def do_POST(self):
+        data = json.loads(self.read_body() or b'{}')
+        time.sleep(self.latency)
+        if self.should_fail():
+            self.send_json({'success': False, 'error': 'Service unavailable'}, status=500)
+            return
+
+        action = data.get('action')
+        if action == 'get_player':
+            row = self.players.get(data.get('user_id')) or dict(STUB_PLAYER, user_id=data.get('user_id'))
+            body = {'success': True, 'player': row}
+        elif action in ('create_player', 'update_player'):
+            # Рядок гравця приходить плоскими полями поруч з action
+            fields = {key: value for key, value in data.items() if key != 'action'}
+            self.players.setdefault(data.get('user_id'), dict(STUB_PLAYER)).update(fields)
+            body = {'success': True}
+        elif action == 'batch_update':
+            for fields in data.get('players', []):
+                self.players.setdefault(fields.get('user_id'), dict(STUB_PLAYER)).update(fields)
+            body = {'success': True}
+        elif action == 'get_ability':
+            body = {'success': True, 'used': False, 'uses': 0}
+        else:
+            body = {'success': True}
+        self.send_json(body)
+
+
+class OpenAIStubHandler(StubHandler):
+    """Заглушка OpenAI chat completions: потокова і звичайна відповідь Майстра гри"""
+
+    # Затримка між фрагментами потоку (latency - до першого фрагмента)
+    chunk_delay = 0.01
+    chunks = 12
+
+    def do_POST(self):
+        request = json.loads(self.read_body() or b'{}')
+        time.sleep(self.latency)
+        if self.should_fail():
+            self.send_json({'error': {'message': 'Stub overloaded', 'type': 'server_error'}}, status=500)
+            return
+
+        content = json.dumps(GM_RESPONSE, ensure_ascii=False)
+        usage = {'prompt_tokens': 450, 'completion_tokens': 120, 'total_tokens': 570}
+        base = {'id': 'chatcmpl-bench', 'created': int(time.time()), 'model': request.get('model', 'gpt-4o-mini')}
+
+        if not request.get('stream'):
+            self.send_json(dict(base, object='chat.completion', usage=usage, choices=[{
+                'index': 0, 'finish_reason': 'stop',
+                'message': {'role': 'assistant', 'content': content}
+            }]))
+            return
+
+        # Server-sent events до закриття з'єднання
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        step = max(1, len(content) // self.chunks)
+        for offset in range(0, len(content), step):
+            chunk = dict(base, object='chat.completion.chunk', choices=[{
+                'index': 0, 'finish_reason': None, 'delta': {'content': content[offset:offset + step]}
+            }])
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(self.chunk_delay)
+        if request.get('stream_options', {}).get('include_usage'):
+            self.wfile.write(f"data: {json.dumps(dict(base, object='chat.completion.chunk', choices=[], usage=usage))}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class TelegramStubHandler(StubHandler):
+    """Заглушка Bot API: приймає відповіді бота і повертає мінімальні Message"""
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'BenchBot', 'username': 'bench_bot'}
+    message_ids = iter(range(1, 1 << 62))
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or b'{}')
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        time.sleep(self.latency)
+        self.count(False)
+
+        method = self.path.rsplit('/', 1)[-1]
+        if method == 'getMe':
+            result = self.BOT_USER
+        elif method in ('sendMessage', 'editMessageText'):
+            result = {
+                'message_id': int(params.get('message_id') or next(self.message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'from': self.BOT_USER,
+                'text': params.get('text', '')
+            }
+        else:
+            result = True
+        self.send_json({'ok': True, 'result': result})
+
+
+def start_server(handler) -> ThreadingHTTPServer:
+    """Запускає заглушку на вільному локальному порту"""
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_stub(latency: float, error_rate: float = 0.0) -> ThreadingHTTPServer:
+    """Запускає заглушку Apps Script"""
+    SlowAppsScriptHandler.configure(latency, error_rate)
+    return start_server(SlowAppsScriptHandler)
+
+
+def server_url(server: ThreadingHTTPServer, path: str = '') -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def load_bot(stub_url: str, **env):
+    """Імпортує main.py з фіктивними ключами та адресою заглушки"""
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:bench')
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-bench')
+    os.environ['GOOGLE_SCRIPT_URL'] = stub_url
+    for key, value in env.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    return main
+
+
+async def run_blocking(url: str, user_ids: range) -> float:
+    """Старий підхід: синхронний POST блокує цикл подій на кожному гравці"""
+    client = httpx.Client(timeout=30)
+
+    async def player(user_id: int):
+        client.post(url, json={'action': 'get_player', 'user_id': str(user_id)}).json()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(player(i) for i in user_ids))
+    client.close()
+    return time.perf_counter() - started
+
+
+async def run_async(bot, user_ids: range) -> float:
+    """Новий підхід: усі гравці чекають на спільному AsyncClient"""
+
+    async def player(user_id: int) -> dict:
+        try:
+            return await bot.GoogleSheetsAPI.get_player(user_id)
+        except bot.BackendBusy:
+            return {'success': False, 'busy': True}
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(player(i) for i in user_ids))
+    elapsed = time.perf_counter() - started
+    busy = sum(1 for r in results if r.get('busy'))
+    failed = sum(1 for r in results if not r.get('success')) - busy
+    if busy:
+        print(f"  ⚠️ {busy} запитів відхилено чергою (BackendBusy)")
+    if failed:
+        print(f"  ⚠️ {failed} запитів завершились помилкою")
+    return elapsed
+
+
+async def run_transport(bot, url: str, players: list, blocking: bool):
+    """Усі кількості гравців в одному циклі подій: клієнт і черги бота живуть у ньому"""
+    first_id = 0
+    for count in players:
+        # Нові id на кожен прогін, щоб кеш гравців не відповідав замість сховища
+        user_ids = range(first_id, first_id + count)
+        first_id += count
+        modes = [('async', lambda: run_async(bot, user_ids))]
+        if blocking:
+            modes.insert(0, ('blocking', lambda: run_blocking(url, user_ids)))
+        for mode, runner in modes:
+            elapsed = await runner()
+            print(f"{count:>8} {mode:>10} {elapsed:>8.2f} {count / elapsed:>10.1f}")
+    await bot.GoogleSheetsAPI.close()
+
+
+class LoadRecorder:
+    """Затримки та помилки по обробниках за один прогін"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.current = None
+
+    def record(self, handler: str, elapsed: float, failed: bool):
+        self.latencies.setdefault(handler, []).append(elapsed)
+        self.errors[handler] = self.errors.get(handler, 0) + failed
+
+    def report(self, elapsed: float) -> dict:
+        import numpy as np
+        handlers = {}
+        for handler, samples in sorted(self.latencies.items()):
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+            handlers[handler] = {
+                'count': len(samples),
+                'errors': self.errors[handler],
+                'throughput': round(len(samples) / elapsed, 2),
+                'mean_ms': round(float(np.mean(samples)) * 1000, 1),
+                'p50_ms': round(float(p50), 1),
+                'p95_ms': round(float(p95), 1),
+                'p99_ms': round(float(p99), 1),
+            }
+        total = sum(item['count'] for item in handlers.values())
+        return {'elapsed': round(elapsed, 3), 'throughput': round(total / elapsed, 2), 'handlers': handlers}
+
+
+class SyntheticPlayer:
+    """Віртуальний гравець: будує оновлення Telegram і проганяє їх через Application"""
+
+    update_ids = iter(range(1, 1 << 62))
+
+    def __init__(self, bot, application, recorder: LoadRecorder, user_id: int):
+        self.bot = bot
+        self.application = application
+        self.recorder = recorder
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': f'Player{user_id}'}
+        self.chat = {'id': user_id, 'type': 'private'}
+
+    def message(self, text: str) -> dict:
+        message = {'message_id': next(self.update_ids), 'date': int(time.time()),
+                   'chat': self.chat, 'from': self.user, 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def callback(self, data: str) -> dict:
+        message = {'message_id': next(self.update_ids), 'date': int(time.time()),
+                   'chat': self.chat, 'from': TelegramStubHandler.BOT_USER, 'text': '...'}
+        return {'update_id': next(self.update_ids), 'callback_query': {
+            'id': str(next(self.update_ids)), 'from': self.user, 'chat_instance': str(self.user['id']),
+            'data': data, 'message': message
+        }}
+
+    async def send(self, handler: str, data: dict):
+        """Обробляє оновлення і чекає, поки гравець отримає відповідь"""
+        update = self.bot.Update.de_json(data, self.application.bot)
+        self.recorder.current = None
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        failed = self.recorder.current is not None
+
+        # Дія гравця виконується після вікна злиття повідомлень, окремою задачею
+        state = self.bot.message_debouncer._states.get(self.user['id'])
+        if state is not None and state['timer'] is not None:
+            await state['timer']
+        if state is not None and state['turn'] is not None:
+            await asyncio.wait([state['turn']])
+            failed = failed or state['turn'].cancelled() or state['turn'].exception() is not None
+
+        self.recorder.record(handler, time.perf_counter() - started, failed)
+
+    async def play(self, rounds: int, think: float):
+        classes = list(self.bot.CLASSES)
+        await self.send('handle_class_selection', self.callback(f"class_{random.choice(classes)}"))
+        for _ in range(rounds):
+            for handler, build in (
+                ('handle_message', lambda: self.message(random.choice(PLAYER_ACTIONS))),
+                # Кнопка кидка належить останньому ходу Майстра гри
+                ('handle_dice_roll', lambda: self.callback(f"roll_d20+STR@{self.turn_id()}")),
+                ('stats', lambda: self.message('/stats')),
+            ):
+                if think:
+                    await asyncio.sleep(random.uniform(0, 2 * think))
+                await self.send(handler, build())
+
+    def turn_id(self) -> int:
+        return self.application.user_data.get(self.user['id'], {}).get('turn_id', 0)
+
+
+async def run_e2e(bot, telegram_url: str, runs, rounds: int, think: float) -> list:
+    """Проганяє сценарій для кожної кількості гравців на одному екземплярі бота"""
+    from telegram.ext import Application
+
+    application = (
+        Application.builder()
+        .token(bot.TELEGRAM_BOT_TOKEN)
+        .base_url(f"{telegram_url}/bot")
+        .updater(None)
+        .concurrent_updates(True)
+        .build()
+    )
+    bot.register_handlers(application)
+    results = []
+
+    async def count_error(update, context):
+        recorder.current = context.error
+
+    application.add_error_handler(count_error)
+
+    async with application:
+        # Хід Майстра гри - задача Application, тож вона має бути запущена
+        await application.start()
+        await bot.on_startup(application)
+        for index, players in enumerate(runs):
+            recorder = LoadRecorder()
+            first_user = (index + 1) * 1_000_000
+            synthetic = [SyntheticPlayer(bot, application, recorder, first_user + i) for i in range(players)]
+            started = time.perf_counter()
+            await asyncio.gather(*(player.play(rounds, think) for player in synthetic))
+            results.append(dict(recorder.report(time.perf_counter() - started), players=players))
+        await application.stop()
+        await bot.on_shutdown(application)
+    return results
+
+
+def print_e2e(results: list, baseline: dict = None):
+    """Друкує таблицю прогонів і, якщо є, зміну відносно попередніх результатів"""
+    previous = {run['players']: run for run in (baseline or {}).get('runs', [])}
+    print(f"{'гравців':>8} {'обробник':>24} {'к-сть':>6} {'помилок':>7} {'оп/с':>8} "
+          f"{'p50, мс':>8} {'p95, мс':>8} {'p99, мс':>8}")
+    for run in results:
+        for handler, item in run['handlers'].items():
+            line = (f"{run['players']:>8} {handler:>24} {item['count']:>6} {item['errors']:>7} "
+                    f"{item['throughput']:>8.1f} {item['p50_ms']:>8.0f} {item['p95_ms']:>8.0f} {item['p99_ms']:>8.0f}")
+            old = previous.get(run['players'], {}).get('handlers', {}).get(handler)
+            if old and old['p95_ms']:
+                line += f"  (p95 {item['p95_ms'] / old['p95_ms'] - 1:+.0%}, оп/с {item['throughput'] / old['throughput'] - 1:+.0%})"
+            print(line)
+        print(f"{run['players']:>8} {'усього':>24} {'':>6} {'':>7} {run['throughput']:>8.1f}  за {run['elapsed']:.1f}s")
+
+
+def main_e2e(args):
+    """Наскрізний бенчмарк обробників проти заглушок усіх зовнішніх сервісів"""
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    sheets = start_stub(args.latency, args.sheets_error_rate)
+    OpenAIStubHandler.configure(args.openai_latency, args.openai_error_rate)
+    openai_server = start_server(OpenAIStubHandler)
+    TelegramStubHandler.configure(args.telegram_latency)
+    telegram = start_server(TelegramStubHandler)
+
+    # Локальні файли бота - у тимчасовій теці, щоб не зачепити робочі
+    workdir = tempfile.mkdtemp(prefix='rpg-bench-')
+    os.environ['OPENAI_BASE_URL'] = server_url(openai_server, '/v1')
+    bot = load_bot(
+        server_url(sheets, '/exec'),
+        MESSAGE_DEBOUNCE='0',
+        WRITE_BEHIND_JOURNAL=os.path.join(workdir, 'pending_writes.json'),
+        SQLITE_PATH=os.path.join(workdir, 'rpg.db'),
+        SNAPSHOT_PATH=os.path.join(workdir, 'warm_snapshot.bin'),
+    )
+
+    config = {
+        'players': args.players, 'rounds': args.rounds, 'think': args.think,
+        'sheets_latency': args.latency, 'sheets_error_rate': args.sheets_error_rate,
+        'openai_latency': args.openai_latency, 'openai_error_rate': args.openai_error_rate,
+        'telegram_latency': args.telegram_latency, 'storage': bot.STORAGE_BACKEND,
+        'openai_rps': bot.OPENAI_RPS, 'sheets_rps': bot.SHEETS_RPS,
+        'message_debounce': bot.MESSAGE_DEBOUNCE, 'gpt_cache_variants': bot.GPT_CACHE_VARIANTS,
+    }
+    print(f"Заглушки: Apps Script {args.latency}s/{args.sheets_error_rate:.0%} помилок, "
+          f"OpenAI {args.openai_latency}s/{args.openai_error_rate:.0%} помилок, Telegram {args.telegram_latency}s; "
+          f"сховище {bot.STORAGE_BACKEND}")
+
+    results = asyncio.run(run_e2e(bot, server_url(telegram), args.players, args.rounds, args.think))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_e2e(results, baseline)
+
+    report = {
+        'config': config,
+        'runs': results,
+        'backends': {
+            'apps_script': SlowAppsScriptHandler.counters,
+            'openai': OpenAIStubHandler.counters,
+            'telegram': TelegramStubHandler.counters,
+        },
+        'bot': {
+            'player_cache': bot.player_cache.stats(),
+            'gpt_cache': bot.gpt_cache.stats(),
+            'openai_scheduler': bot.openai_scheduler.stats(),
+            'sheets_scheduler': bot.sheets_scheduler.stats(),
+            'conversation_memory': bot.conversation_memory.stats(),
+            'fast_path': bot.fast_path.stats(),
+            'gpt_usage': bot.RPGGameLogic.usage,
+        },
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+        print(f"Результати записано в {args.output}")
+
+    for server in (sheets, openai_server, telegram):
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--latency', type=float, default=0.5, help='затримка заглушки, секунди')
+    parser.add_argument('--skip-blocking', action='store_true', help='не запускати блокуючий варіант')
+    e2e = parser.add_argument_group('наскрізний бенчмарк (--e2e)')
+    e2e.add_argument('--e2e', action='store_true', help='прогнати обробники бота проти заглушок усіх сервісів')
+    e2e.add_argument('--rounds', type=int, default=3, help='ходів (дія, кидок, /stats) на гравця')
+    e2e.add_argument('--think', type=float, default=0.0, help='середня пауза гравця між діями, секунди')
+    e2e.add_argument('--sheets-error-rate', type=float, default=0.0, help='частка відповідей Apps Script з помилкою')
+    e2e.add_argument('--openai-latency', type=float, default=1.0, help='затримка OpenAI до першого токена, секунди')
+    e2e.add_argument('--openai-error-rate', type=float, default=0.0, help='частка відповідей OpenAI з помилкою')
+    e2e.add_argument('--telegram-latency', type=float, default=0.05, help='затримка Bot API, секунди')
+    e2e.add_argument('--output', help='записати результати в JSON')
+    e2e.add_argument('--baseline', help='JSON попереднього прогону для порівняння')
+    e2e.add_argument('--verbose', action='store_true', help='не приховувати логи бота')
+    args = parser.parse_args()
+
+    if args.e2e:
+        main_e2e(args)
+        return
+
+    server = start_stub(args.latency)
+    url = server_url(server, '/exec')
+    # Порівнюємо лише транспорт: ліміти запитів, черга і дублі запитів не заважають
+    peak = str(max(args.players))
+    bot = load_bot(url, SHEETS_RPS='1000000', SHEETS_BURST=peak, SHEETS_CONCURRENCY=peak,
+                   SHEETS_MAX_QUEUE=peak, SHEETS_HEDGE_DELAY='0')
+
+    print(f"Заглушка Apps Script: {url}, затримка {args.latency}s")
+    print(f"{'гравців':>8} {'режим':>10} {'час, с':>8} {'запитів/с':>10}")
+    asyncio.run(run_transport(bot, url, args.players, not args.skip_blocking))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,760 +1,5172 @@
-import os
-import json
-import asyncio
-import logging
-import random
-from typing import Dict, Any, List, Optional
-from datetime import datetime
-
-import requests
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
-from openai import OpenAI
-
-# Налаштування логування
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-# Конфігурація - читаємо змінні середовища напряму
-TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
-GOOGLE_SCRIPT_URL = os.environ.get('GOOGLE_SCRIPT_URL')
-
-# Перевіряємо що всі змінні налаштовані
-if not TELEGRAM_BOT_TOKEN:
-    logger.error("TELEGRAM_BOT_TOKEN не налаштований!")
-    exit(1)
-
-if not OPENAI_API_KEY:
-    logger.error("OPENAI_API_KEY не налаштований!")
-    exit(1)
-    
-if not GOOGLE_SCRIPT_URL:
-    logger.error("GOOGLE_SCRIPT_URL не налаштований!")
-    exit(1)
-
-# Ініціалізація OpenAI клієнта
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
-# Класи персонажів
-CLASSES = {
-    'knight': {
-        'name': '🛡️ Лицар',
-        'stats': {'str': 15, 'dex': 10, 'con': 14, 'int': 8, 'wis': 12, 'cha': 13},
-        'hp_base': 15,
-        'mp_base': 0,
-        'equipment': ['sword', 'shield', 'chainmail'],
-        'gold': 50,
-        'abilities': ['mighty_strike', 'protect_ally']
-    },
-    'mage': {
-        'name': '🧙‍♂️ Маг',
-        'stats': {'str': 8, 'dex': 12, 'con': 10, 'int': 15, 'wis': 14, 'cha': 11},
-        'hp_base': 8,
-        'mp_base': 10,
-        'equipment': ['staff', 'robe', 'spellbook'],
-        'gold': 30,
-        'abilities': ['magic_missile', 'fireball', 'heal']
-    },
-    'archer': {
-        'name': '🏹 Лучник',
-        'stats': {'str': 12, 'dex': 15, 'con': 13, 'int': 10, 'wis': 14, 'cha': 8},
-        'hp_base': 12,
-        'mp_base': 0,
-        'equipment': ['bow', 'arrows:30', 'leather_armor'],
-        'gold': 40,
-        'abilities': ['precise_shot', 'multi_shot']
-    },
-    'thief': {
-        'name': '🗡️ Злодій',
-        'stats': {'str': 10, 'dex': 15, 'con': 12, 'int': 13, 'wis': 11, 'cha': 14},
-        'hp_base': 10,
-        'mp_base': 0,
-        'equipment': ['dagger', 'dagger', 'thieves_tools', 'dark_cloak'],
-        'gold': 60,
-        'abilities': ['backstab', 'stealth']
-    },
-    'cleric': {
-        'name': '⚕️ Жрець',
-        'stats': {'str': 11, 'dex': 10, 'con': 13, 'int': 12, 'wis': 15, 'cha': 14},
-        'hp_base': 12,
-        'mp_base': 8,
-        'equipment': ['mace', 'holy_symbol', 'healing_potion:2'],
-        'gold': 35,
-        'abilities': ['mass_heal', 'turn_undead']
-    }
-}
-
-# Предмети та їх характеристики
-ITEMS = {
-    'sword': {'name': 'Меч', 'damage': 'd8', 'type': 'weapon', 'price': 50},
-    'dagger': {'name': 'Кинджал', 'damage': 'd4', 'type': 'weapon', 'price': 10},
-    'bow': {'name': 'Лук', 'damage': 'd8', 'type': 'ranged', 'price': 40},
-    'staff': {'name': 'Посох', 'damage': 'd6', 'type': 'weapon', 'price': 25},
-    'mace': {'name': 'Булава', 'damage': 'd6', 'type': 'weapon', 'price': 30},
-    'shield': {'name': 'Щит', 'defense': 2, 'type': 'armor', 'price': 25},
-    'chainmail': {'name': 'Кольчуга', 'defense': 3, 'type': 'armor', 'price': 100},
-    'leather_armor': {'name': 'Шкіряна броня', 'defense': 2, 'type': 'armor', 'price': 30},
-    'robe': {'name': 'Мантія', 'defense': 1, 'type': 'armor', 'price': 20},
-    'healing_potion': {'name': 'Зілля лікування', 'heal': 'd6+1', 'type': 'consumable', 'price': 20}
-}
-
-# Спеціальні здібності
-ABILITIES = {
-    'mighty_strike': {'name': 'Могутній удар', 'uses_per_battle': 1, 'effect': 'double_damage'},
-    'protect_ally': {'name': 'Захист союзника', 'uses_per_battle': 1, 'effect': 'redirect_damage'},
-    'magic_missile': {'name': 'Магічна стріла', 'mp_cost': 2, 'damage': 'd4+INT', 'auto_hit': True},
-    'fireball': {'name': 'Вогняна куля', 'mp_cost': 4, 'damage': 'd8+INT', 'area': True},
-    'heal': {'name': 'Лікування', 'mp_cost': 2, 'heal': 'd6+WIS'},
-    'precise_shot': {'name': 'Точний постріл', 'uses_per_battle': 1, 'effect': '+5_attack'},
-    'multi_shot': {'name': 'Багатократний постріл', 'uses_per_battle': 1, 'effect': '3_arrows'},
-    'backstab': {'name': 'Удар зі спини', 'uses_per_battle': 1, 'damage': '+d6'},
-    'stealth': {'name': 'Скрадання', 'uses_per_battle': 1, 'effect': 'advantage'},
-    'mass_heal': {'name': 'Масове лікування', 'uses_per_day': 1, 'heal': 'd6_all'},
-    'turn_undead': {'name': 'Вигнання нежиті', 'uses_per_battle': 1, 'effect': 'fear_undead'}
-}
-
-class GoogleSheetsAPI:
-    """Клас для роботи з Google Sheets через Apps Script"""
-    
-    @staticmethod
-    def make_request(data: Dict[str, Any]) -> Dict[str, Any]:
-        """Відправляє запит до Google Apps Script"""
-        try:
-            response = requests.post(
-                GOOGLE_SCRIPT_URL,
-                json=data,
-                headers={'Content-Type': 'application/json'},
-                timeout=30
-            )
-            return response.json()
-        except Exception as e:
-            logger.error(f"Помилка запиту до Google Sheets: {e}")
-            return {"success": False, "error": str(e)}
-    
-    @staticmethod
-    def get_player(user_id: int) -> Dict[str, Any]:
-        """Отримує дані гравця"""
-        return GoogleSheetsAPI.make_request({
-            "action": "get_player",
-            "user_id": str(user_id)
-        })
-    
-    @staticmethod
-    def create_player(user_id: int, name: str, player_class: str) -> Dict[str, Any]:
-        """Створює нового гравця"""
-        class_data = CLASSES[player_class]
-        return GoogleSheetsAPI.make_request({
-            "action": "create_player",
-            "user_id": str(user_id),
-            "name": name,
-            "class": player_class,
-            "level": 1,
-            "hp_current": class_data['hp_base'],
-            "hp_max": class_data['hp_base'],
-            "mp_current": class_data['mp_base'],
-            "mp_max": class_data['mp_base'],
-            "str": class_data['stats']['str'],
-            "dex": class_data['stats']['dex'],
-            "con": class_data['stats']['con'],
-            "int": class_data['stats']['int'],
-            "wis": class_data['stats']['wis'],
-            "cha": class_data['stats']['cha'],
-            "xp": 0,
-            "gold": class_data['gold'],
-            "inventory": ','.join(class_data['equipment'])
-        })
-    
-    @staticmethod
-    def update_player(user_id: int, updates: Dict[str, Any]) -> Dict[str, Any]:
-        """Оновлює дані гравця"""
-        data = {
-            "action": "update_player",
-            "user_id": str(user_id)
-        }
-        data.update(updates)
-        return GoogleSheetsAPI.make_request(data)
-    
-    @staticmethod
-    def get_ability_usage(user_id: int, ability: str) -> Dict[str, Any]:
-        """Перевіряє чи використовувалася здібність"""
-        return GoogleSheetsAPI.make_request({
-            "action": "get_ability",
-            "user_id": str(user_id),
-            "ability_name": ability
-        })
-    
-    @staticmethod
-    def use_ability(user_id: int, ability: str) -> Dict[str, Any]:
-        """Позначає здібність як використану"""
-        return GoogleSheetsAPI.make_request({
-            "action": "use_ability",
-            "user_id": str(user_id),
-            "ability_name": ability,
-            "used": True
-        })
-
-class DiceRoller:
-    """Клас для кидання кубиків"""
-    
-    @staticmethod
-    def roll(dice_str: str) -> int:
-        """Кидає кубик по строці типу 'd20', '2d6', 'd8+3'"""
-        try:
-            # Парсимо строку кубика
-            if '+' in dice_str:
-                dice_part, bonus = dice_str.split('+')
-                bonus = int(bonus)
-            elif '-' in dice_str:
-                dice_part, penalty = dice_str.split('-')
-                bonus = -int(penalty)
-            else:
-                dice_part = dice_str
-                bonus = 0
-            
-            if 'd' in dice_part:
-                if dice_part.startswith('d'):
-                    count = 1
-                    sides = int(dice_part[1:])
-                else:
-                    count, sides = dice_part.split('d')
-                    count = int(count)
-                    sides = int(sides)
-            else:
-                # Просто число
-                return int(dice_part) + bonus
-            
-            total = sum(random.randint(1, sides) for _ in range(count))
-            return total + bonus
-            
-        except Exception as e:
-            logger.error(f"Помилка при кидку кубика {dice_str}: {e}")
-            return 1
-
-    @staticmethod
-    def get_modifier(stat_value: int) -> int:
-        """Обчислює модифікатор характеристики"""
-        return (stat_value - 10) // 2
-
-class RPGGameLogic:
-    """Клас для ігрової логіки"""
-    
-    @staticmethod
-    def get_gpt_response(prompt: str, player_data: Dict, context: str = "") -> Dict[str, Any]:
-        """Отримує відповідь від GPT з ігровою логікою"""
-        
-        # Формуємо характеристики з модифікаторами
-        stats_str = ""
-        for stat in ['str', 'dex', 'con', 'int', 'wis', 'cha']:
-            value = player_data.get(stat, 10)
-            modifier = DiceRoller.get_modifier(value)
-            mod_str = f"+{modifier}" if modifier >= 0 else str(modifier)
-            stats_str += f"{stat.upper()}: {value}({mod_str}) "
-        
-        system_prompt = f"""
-        Ти - Майстер гри (Game Master) у RPG грі в стилі D&D.
-
-        ПОТОЧНИЙ ГРАВЕЦЬ:
-        - Ім'я: {player_data.get('name')}
-        - Клас: {CLASSES.get(player_data.get('class'), {}).get('name', 'Невідомий')}
-        - Рівень: {player_data.get('level')}
-        - HP: {player_data.get('hp_current')}/{player_data.get('hp_max')}
-        - MP: {player_data.get('mp_current')}/{player_data.get('mp_max')}
-        - Характеристики: {stats_str}
-        - Досвід: {player_data.get('xp')} XP
-        - Золото: {player_data.get('gold')}
-        - Інвентар: {player_data.get('inventory', '')}
-
-        КОНТЕКСТ: {context}
-
-        ТВОЯ РОЛЬ:
-        1. Аналізуй дії гравців та визначай їх можливість
-        2. Оцінюй кількість ходів (1 хід, 2 ходи, неможливо)
-        3. Визначай складність (d20 + модифікатор проти цілі)
-        4. Генеруй цікавий світ та ситуації
-        5. Будь справедливим але викликаючим
-
-        ПРАВИЛА КИДКІВ:
-        - Проста дія: автоматичний успіх
-        - Середня дія: d20 + модифікатор ≥ 12-15
-        - Складна дія: d20 + модифікатор ≥ 16-18
-        - Майже неможлива: d20 + модифікатор ≥ 20
-
-        КІЛЬКІСТЬ ХОДІВ:
-        - 1 хід: одна проста дія (атака, заклинання, рух)
-        - 1 хід складний: комбо дія (скрадання+атака)
-        - 2+ ходи: множинні дії (осліпити+атакувати+обшукати)
-        - Неможливо: занадто багато за раунд
-
-        ЗАВЖДИ відповідай у JSON форматі:
-        {{
-            "main_response": "Основна відповідь гравцю (2-3 речення)",
-            "action_type": "simple/complex/multi_turn/impossible",
-            "dice_required": {{
-                "type": "d20/d6/d8/none",
-                "modifier_stat": "STR/DEX/CON/INT/WIS/CHA/none",
-                "difficulty": 12-20,
-                "damage_dice": "d4/d6/d8/d10/none"
-            }},
-            "hint": "Підказка про можливості класу (1-2 речення)",
-            "consequences": {{
-                "success": "Що станеться при успіху",
-                "failure": "Що станеться при невдачі"
-            }},
-            "xp_reward": 0-50,
-            "gold_reward": 0-20
-        }}
-
-        Дія гравця: {prompt}
-        """
-        
-        try:
-            response = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=300,
-                temperature=0.7,
-                timeout=10
-            )
-            
-            # Парсимо JSON відповідь
-            content = response.choices[0].message.content
-            return json.loads(content)
-            
-        except Exception as e:
-            logger.error(f"Помилка GPT: {e}")
-            return {
-                "main_response": "Щось пішло не так з магією... Спробуй ще раз!",
-                "action_type": "simple",
-                "dice_required": {"type": "none"},
-                "hint": "Перевір чи все правильно написано.",
-                "consequences": {"success": "", "failure": ""},
-                "xp_reward": 0,
-                "gold_reward": 0
-            }
-
-    @staticmethod
-    def calculate_attack(attacker_data: Dict, target_defense: int, weapon: str = "fists") -> Dict:
-        """Обчислює атаку"""
-        # Отримуємо дані зброї
-        weapon_data = ITEMS.get(weapon, {'damage': 'd4', 'type': 'weapon'})
-        
-        # Модифікатор атаки
-        if weapon_data.get('type') == 'ranged':
-            attack_mod = DiceRoller.get_modifier(attacker_data.get('dex', 10))
-        else:
-            attack_mod = DiceRoller.get_modifier(attacker_data.get('str', 10))
-        
-        # Кидок атаки
-        attack_roll = DiceRoller.roll('d20') + attack_mod
-        
-        if attack_roll >= target_defense:
-            # Попадання - рахуємо урон
-            damage_roll = DiceRoller.roll(weapon_data['damage'])
-            if weapon_data.get('type') != 'ranged':
-                damage_roll += DiceRoller.get_modifier(attacker_data.get('str', 10))
-            
-            return {
-                'hit': True,
-                'attack_roll': attack_roll,
-                'damage': max(1, damage_roll),  # Мінімум 1 урон
-                'critical': attack_roll >= 20
-            }
-        else:
-            return {
-                'hit': False,
-                'attack_roll': attack_roll,
-                'damage': 0,
-                'critical': False
-            }
-
-# Обробники команд
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /start"""
-    user_id = update.effective_user.id
-    
-    # Перевіряємо чи гравець вже існує
-    player_data = GoogleSheetsAPI.get_player(user_id)
-    
-    if player_data.get("success") and player_data.get("player"):
-        player = player_data["player"]
-        await update.message.reply_text(
-            f"🎮 Вітаю знову, {player['name']}!\n"
-            f"🛡️ Клас: {CLASSES.get(player['class'], {}).get('name', 'Невідомий')}\n"
-            f"❤️ HP: {player['hp_current']}/{player['hp_max']}\n"
-            f"💙 MP: {player['mp_current']}/{player['mp_max']}\n"
-            f"⭐ Рівень: {player['level']} (XP: {player['xp']})\n"
-            f"💰 Золото: {player['gold']}\n\n"
-            f"Готовий до пригод? Напиши що хочеш зробити!\n\n"
-            f"Доступні команди:\n"
-            f"/stats - характеристики персонажа\n"
-            f"/inventory - інвентар\n"
-            f"/abilities - спеціальні здібності\n"
-            f"/help - довідка"
-        )
-    else:
-        # Показуємо кнопки вибору класу
-        keyboard = []
-        for class_key, class_data in CLASSES.items():
-            keyboard.append([InlineKeyboardButton(class_data['name'], callback_data=f"class_{class_key}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            "🏰 Ласкаво просимо до RPG пригоди!\n\n"
-            "🎯 **Виберіть клас свого персонажа:**\n\n"
-            "🛡️ **Лицар** - сильний воїн з мечем і щитом\n"
-            "🧙‍♂️ **Маг** - володар магії та заклинань\n"
-            "🏹 **Лучник** - майстер стрільби та виживання\n"
-            "🗡️ **Злодій** - скритний та спритний\n"
-            "⚕️ **Жрець** - цілитель та захисник від зла",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
-
-async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /stats - показати характеристики"""
-    user_id = update.effective_user.id
-    player_data = GoogleSheetsAPI.get_player(user_id)
-    
-    if not player_data.get("success") or not player_data.get("player"):
-        await update.message.reply_text("❌ Спочатку створіть персонажа командою /start")
-        return
-    
-    player = player_data["player"]
-    
-    # Формуємо статистику з модифікаторами
-    stats_text = "📊 **ХАРАКТЕРИСТИКИ ПЕРСОНАЖА**\n\n"
-    stats_text += f"👤 **{player['name']}** ({CLASSES.get(player['class'], {}).get('name', 'Невідомий')})\n"
-    stats_text += f"⭐ Рівень: {player['level']} (XP: {player['xp']})\n\n"
-    
-    stats_text += f"❤️ **Здоров'я:** {player['hp_current']}/{player['hp_max']}\n"
-    stats_text += f"💙 **Мана:** {player['mp_current']}/{player['mp_max']}\n"
-    stats_text += f"💰 **Золото:** {player['gold']}\n\n"
-    
-    stats_text += "**Основні характеристики:**\n"
-    for stat in ['str', 'dex', 'con', 'int', 'wis', 'cha']:
-        value = player.get(stat, 10)
-        modifier = DiceRoller.get_modifier(value)
-        mod_str = f"+{modifier}" if modifier >= 0 else str(modifier)
-        stat_names = {
-            'str': '💪 Сила', 'dex': '🏃 Спритність', 'con': '🛡️ Витривалість',
-            'int': '🧠 Інтелект', 'wis': '👁️ Мудрість', 'cha': '😊 Харизма'
-        }
-        stats_text += f"{stat_names[stat]}: {value} ({mod_str})\n"
-    
-    await update.message.reply_text(stats_text, parse_mode='Markdown')
-
-async def inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /inventory - показати інвентар"""
-    user_id = update.effective_user.id
-    player_data = GoogleSheetsAPI.get_player(user_id)
-    
-    if not player_data.get("success") or not player_data.get("player"):
-        await update.message.reply_text("❌ Спочатку створіть персонажа командою /start")
-        return
-    
-    player = player_data["player"]
-    inventory_str = player.get('inventory', '')
-    
-    if not inventory_str:
-        await update.message.reply_text("🎒 Ваш інвентар порожній!")
-        return
-    
-    items = inventory_str.split(',')
-    inv_text = "🎒 **ІНВЕНТАР**\n\n"
-    
-    for item in items:
-        if ':' in item:
-            item_name, quantity = item.split(':')
-            item_data = ITEMS.get(item_name, {'name': item_name})
-            inv_text += f"• {item_data.get('name', item_name)} x{quantity}\n"
-        else:
-            item_data = ITEMS.get(item, {'name': item})
-            inv_text += f"• {item_data.get('name', item)}\n"
-    
-    await update.message.reply_text(inv_text, parse_mode='Markdown')
-
-async def abilities(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /abilities - показати здібності"""
-    user_id = update.effective_user.id
-    player_data = GoogleSheetsAPI.get_player(user_id)
-    
-    if not player_data.get("success") or not player_data.get("player"):
-        await update.message.reply_text("❌ Спочатку створіть персонажа командою /start")
-        return
-    
-    player = player_data["player"]
-    player_class = player.get('class')
-    class_abilities = CLASSES.get(player_class, {}).get('abilities', [])
-    
-    abilities_text = "⚡ **СПЕЦІАЛЬНІ ЗДІБНОСТІ**\n\n"
-    
-    for ability in class_abilities:
-        ability_data = ABILITIES.get(ability, {'name': ability})
-        abilities_text += f"🔸 **{ability_data['name']}**\n"
-        
-        # Додаємо опис здібності
-        if 'mp_cost' in ability_data:
-            abilities_text += f"   💙 Вартість: {ability_data['mp_cost']} MP\n"
-        if 'uses_per_battle' in ability_data:
-            abilities_text += f"   ⚔️ Використань за бій: {ability_data['uses_per_battle']}\n"
-        if 'uses_per_day' in ability_data:
-            abilities_text += f"   📅 Використань за день: {ability_data['uses_per_day']}\n"
-        if 'damage' in ability_data:
-            abilities_text += f"   💥 Урон: {ability_data['damage']}\n"
-        
-        abilities_text += "\n"
-    
-    await update.message.reply_text(abilities_text, parse_mode='Markdown')
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /help - довідка"""
-    help_text = """
-🎮 **RPG BOT - ДОВІДКА**
-
-**Основні команди:**
-/start - почати гру або показати персонажа
-/stats - характеристики персонажа
-/inventory - показати інвентар
-/abilities - спеціальні здібності
-/help - ця довідка
-
-**Як грати:**
-1. Створіть персонажа командою /start
-2. Пишіть що хочете робити звичайним текстом
-3. Натискайте кнопки кубиків коли потрібно
-4. Використовуйте кнопку "Підказка" для порад
-
-**Приклади дій:**
-• "Йду в ліс"
-• "Атакую орка мечем"  
-• "Шукаю скарби"
-• "Розмовляю з торговцем"
-• "Використовую зілля лікування"
-
-**Система кубиків:**
-• d20 - основні перевірки
-• d6, d8, d10 - урон від зброї
-• Модифікатори від характеристик
-
-**Характеристики:**
-💪 Сила - рукопашний бій, підйом важких речей
-🏃 Спритність - стрільба, ухилення, скрадання  
-🛡️ Витривалість - здоров'я, опір хворобам
-🧠 Інтелект - магія, знання
-👁️ Мудрість - інтуїція, сприйняття
-😊 Харизма - переконання, торгівля
-
-Приємної гри! 🎲
-"""
-    
-    await update.message.reply_text(help_text, parse_mode='Markdown')
-
-async def handle_class_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обробка вибору класу"""
-    query = update.callback_query
-    await query.answer()
-    
-    class_chosen = query.data.replace("class_", "")
-    user_id = query.from_user.id
-    user_name = query.from_user.first_name or "Герой"
-    
-    # Створюємо гравця
-    result = GoogleSheetsAPI.create_player(user_id, user_name, class_chosen)
-    
-    if result.get("success"):
-        class_data = CLASSES[class_chosen]
-        await query.edit_message_text(
-            f"🎉 **Персонаж створено!**\n\n"
-            f"👤 **Ім'я:** {user_name}\n"
-            f"🛡️ **Клас:** {class_data['name']}\n"
-            f"❤️ **HP:** {class_data['hp_base']}\n"
-            f"💙 **MP:** {class_data['mp_base']}\n"
-            f"💰 **Золото:** {class_data['gold']}\n"
-            f"🎒 **Спорядження:** {', '.join([ITEMS.get(item.split(':')[0], {'name': item}).get('name', item) for item in class_data['equipment']])}\n\n"
-            f"🎮 **Ваша пригода починається!**\n"
-            f"Напишіть що хочете зробити, наприклад:\n"
-            f"• 'Йду досліджувати ліс'\n"
-            f"• 'Шукаю пригоди в таверні'\n"
-            f"• 'Треную свої навички'\n\n"
-            f"💡 Використовуйте /help для довідки!",
-            parse_mode='Markdown'
-        )
-    else:
-        await query.edit_message_text(
-            f"❌ Помилка створення персонажа: {result.get('error', 'Невідома помилка')}"
-        )
-
-async def handle_dice_roll(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обробка кидання кубиків"""
-    query = update.callback_query
-    await query.answer()
-    
-    user_id = query.from_user.id
-    dice_data = query.data
-    
-    # Парсимо дані кубика
-    if dice_data.startswith('roll_'):
-        dice_info = dice_data.replace('roll_', '')
-        
-        # Отримуємо дані гравця для модифікаторів
-        player_data = GoogleSheetsAPI.get_player(user_id)
-        if not player_data.get("success"):
-            await query.edit_message_text("❌ Помилка отримання даних гравця")
-            return
-        
-        player = player_data["player"]
-        
-        # Кидаємо кубик
-        if '+' in dice_info:
-            dice_type, modifier_info = dice_info.split('+')
-            if modifier_info.isdigit():
-                modifier = int(modifier_info)
-            else:
-                # Модифікатор від характеристики
-                stat_value = player.get(modifier_info.lower(), 10)
-                modifier = DiceRoller.get_modifier(stat_value)
-        else:
-            dice_type = dice_info
-            modifier = 0
-        
-        roll_result = DiceRoller.roll(dice_type)
-        total = roll_result + modifier
-        
-        # Визначаємо результат
-        if roll_result == 20:
-            result_text = "🎯 **КРИТИЧНИЙ УСПІХ!**"
-        elif roll_result == 1:
-            result_text = "💥 **КРИТИЧНА НЕВДАЧА!**"
-        elif total >= 15:
-            result_text = "✅ **УСПІХ!**"
-        else:
-            result_text = "❌ **НЕВДАЧА**"
-        
-        mod_str = f"+{modifier}" if modifier >= 0 else str(modifier)
-        
-        await query.edit_message_text(
-            f"🎲 **Кидок кубика**\n\n"
-            f"🎯 {dice_type}{mod_str} = {roll_result}{mod_str} = **{total}**\n\n"
-            f"{result_text}\n\n"
-            f"Що робите далі?"
-        )
-
-async def handle_hint(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обробка запиту підказки"""
-    query = update.callback_query
-    await query.answer()
-    
-    # Отримуємо збережену підказку з контексту
-    hint = context.user_data.get('last_hint', 'Підказка недоступна')
-    
-    await query.edit_message_text(
-        f"💡 **ПІДКАЗКА**\n\n{hint}\n\n"
-        f"Що робите далі?",
-        parse_mode='Markdown'
-    )
-
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обробка звичайних повідомлень від гравців"""
-    user_id = update.effective_user.id
-    user_message = update.message.text
-    
-    # Отримуємо дані гравця
-    player_data = GoogleSheetsAPI.get_player(user_id)
-    
-    if not player_data.get("success") or not player_data.get("player"):
-        await update.message.reply_text(
-            "❌ Спочатку створіть персонажа командою /start"
-        )
-        return
-    
-    player = player_data["player"]
-    
-    # Показуємо що бот думає
-    thinking_message = await update.message.reply_text("🤔 Аналізую вашу дію...")
-    
-    # Отримуємо відповідь від GPT
-    gpt_response = RPGGameLogic.get_gpt_response(user_message, player)
-    
-    # Видаляємо повідомлення "думаю"
-    await thinking_message.delete()
-    
-    # Формуємо кнопки
-    keyboard = []
-    
-    # Кнопка кубика якщо потрібна
-    dice_info = gpt_response.get("dice_required", {})
-    if dice_info.get("type") != "none" and dice_info.get("type"):
-        dice_type = dice_info["type"]
-        modifier_stat = dice_info.get("modifier_stat", "")
-        
-        if modifier_stat and modifier_stat != "none":
-            stat_value = player.get(modifier_stat.lower(), 10)
-            modifier = DiceRoller.get_modifier(stat_value)
-            mod_str = f"+{modifier_stat}({modifier:+d})" if modifier != 0 else f"+{modifier_stat}"
-            dice_text = f"🎲 {dice_type}{mod_str}"
-            dice_callback = f"roll_{dice_type}+{modifier_stat}"
-        else:
-            dice_text = f"🎲 {dice_type}"
-            dice_callback = f"roll_{dice_type}"
-        
-        keyboard.append([InlineKeyboardButton(dice_text, callback_data=dice_callback)])
-    
-    # Кнопка підказки (завжди)
-    keyboard.append([InlineKeyboardButton("💡 Підказка", callback_data="show_hint")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-    
-    # Зберігаємо контекст для кнопок
-    context.user_data['last_gpt_response'] = gpt_response
-    context.user_data['last_hint'] = gpt_response.get('hint', 'Підказка недоступна')
-    context.user_data['player_data'] = player
-    
-    # Додаємо інформацію про складність якщо є кубик
-    response_text = gpt_response["main_response"]
-    if dice_info.get("difficulty"):
-        response_text += f"\n\n🎯 Складність: {dice_info['difficulty']}"
-    
-    await update.message.reply_text(
-        response_text,
-        reply_markup=reply_markup
-    )
-
-async def handle_button_press(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обробка натискання кнопок"""
-    query = update.callback_query
-    await query.answer()
-    
-    if query.data == "show_hint":
-        await handle_hint(update, context)
-    elif query.data.startswith("roll_"):
-        await handle_dice_roll(update, context)
-
-def main():
-    """Головна функція"""
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-    
-    # Додаємо обробники
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(CommandHandler("inventory", inventory))
-    application.add_handler(CommandHandler("abilities", abilities))
-    application.add_handler(CommandHandler("help", help_command))
-    
-    application.add_handler(CallbackQueryHandler(handle_class_selection, pattern="^class_"))
-    application.add_handler(CallbackQueryHandler(handle_button_press, pattern="^(show_hint|roll_)"))
-    
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    
-    # Запускаємо бота
-    logger.info("🎮 RPG Бот запущений!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
-
-if __name__ == '__main__':
-    main()
+import os
+import sys
+import json
+import asyncio
+import logging
+import random
+import re
+import copy
+import heapq
+import itertools
+import contextlib
+import contextvars
+import argparse
+import bisect
+import hashlib
+import mmap
+import multiprocessing
+import signal
+import threading
+import sqlite3
+import time
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Callable, Awaitable, Tuple
+from datetime import datetime
+
+import httpx
+import numpy as np
+from telegram import Chat, Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import Application, BasePersistence, PersistenceInput, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, TypeHandler, filters
+from openai import AsyncOpenAI, APITimeoutError
+
+# Налаштування логування
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Конфігурація - читаємо змінні середовища напряму
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
+OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+GOOGLE_SCRIPT_URL = os.environ.get('GOOGLE_SCRIPT_URL')
+
+# Перевіряємо що всі змінні налаштовані
+if not TELEGRAM_BOT_TOKEN:
+    logger.error("TELEGRAM_BOT_TOKEN не налаштований!")
+    exit(1)
+
+if not OPENAI_API_KEY:
+    logger.error("OPENAI_API_KEY не налаштований!")
+    exit(1)
+    
+if not GOOGLE_SCRIPT_URL:
+    logger.error("GOOGLE_SCRIPT_URL не налаштований!")
+    exit(1)
+
+# Таймаути запитів до Apps Script (секунди); окремі дії можна перевизначити
+# змінною SHEETS_TIMEOUTS у форматі "get_player=5,update_player=15"
+SHEETS_DEFAULT_TIMEOUT = float(os.environ.get('SHEETS_TIMEOUT', '30'))
+SHEETS_TIMEOUTS = {
+    'get_player': 10.0,
+    'get_ability': 10.0,
+}
+for _pair in filter(None, os.environ.get('SHEETS_TIMEOUTS', '').split(',')):
+    _action, _, _value = _pair.partition('=')
+    SHEETS_TIMEOUTS[_action.strip()] = float(_value)
+
+# Розмір пулу keep-alive з'єднань до Apps Script
+SHEETS_MAX_CONNECTIONS = int(os.environ.get('SHEETS_MAX_CONNECTIONS', '100'))
+SHEETS_MAX_KEEPALIVE = int(os.environ.get('SHEETS_MAX_KEEPALIVE', '20'))
+
+# Кеш гравців: розмір, час свіжості (після нього - фонове оновлення)
+# та максимальний вік запису (після нього - примусове перечитування)
+PLAYER_CACHE_SIZE = int(os.environ.get('PLAYER_CACHE_SIZE', '1000'))
+PLAYER_CACHE_TTL = float(os.environ.get('PLAYER_CACHE_TTL', '60'))
+PLAYER_CACHE_MAX_AGE = float(os.environ.get('PLAYER_CACHE_MAX_AGE', '600'))
+
+# Відкладений запис: інтервал скидання (0 - писати одразу), поріг розміру пакета
+# та файл журналу для змін, які не вдалося записати при зупинці
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', '5'))
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get('WRITE_BEHIND_MAX_BATCH', '50'))
+WRITE_BEHIND_JOURNAL = os.environ.get('WRITE_BEHIND_JOURNAL', 'pending_writes.json')
+
+# Основне сховище гравців: "sheets" - лише Google Sheets, "sqlite" - локальна
+# база SQLite, яку фоновий реплікатор пакетами дзеркалить у таблицю
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sheets')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'rpg.db')
+REPLICATION_INTERVAL = float(os.environ.get('REPLICATION_INTERVAL', '5'))
+REPLICATION_BATCH = int(os.environ.get('REPLICATION_BATCH', '50'))
+
+# Знімок кешу гравців і сесій для теплого старту: файл ("" - вимкнено), інтервал
+# запису, скільки нещодавно активних гравців підняти в кеш одразу при старті
+# та скільки зберігати записи неактивних гравців, секунди
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', 'warm_snapshot.bin')
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', '60'))
+SNAPSHOT_PREFETCH = int(os.environ.get('SNAPSHOT_PREFETCH', '100'))
+SNAPSHOT_TTL = float(os.environ.get('SNAPSHOT_TTL', '86400'))
+
+# Збереження context.user_data і bot_data між перезапусками: база SQLite
+# ("" - вимкнено), як часто PTB віддає змінені сесії на запис, секунди,
+# та скільки зберігати сесії неактивних гравців, секунди
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', 'sessions.db')
+SESSION_FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', '30'))
+SESSION_TTL = float(os.environ.get('SESSION_TTL', '604800'))
+
+# Потокова відповідь GPT: мінімальний інтервал між редагуваннями повідомлення
+# (Telegram обмежує частоту редагувань) та мінімальний приріст тексту
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', '1.0'))
+STREAM_MIN_CHARS = int(os.environ.get('STREAM_MIN_CHARS', '20'))
+
+# Кеш відповідей GPT на однакові дії: розмір, час життя та кількість варіантів,
+# які треба зібрати від моделі перед тим як відповідати з кешу (0 - вимкнено)
+GPT_CACHE_SIZE = int(os.environ.get('GPT_CACHE_SIZE', '2000'))
+GPT_CACHE_TTL = float(os.environ.get('GPT_CACHE_TTL', '3600'))
+GPT_CACHE_VARIANTS = int(os.environ.get('GPT_CACHE_VARIANTS', '3'))
+
+# Вікно, протягом якого кілька повідомлень гравця зливаються в одну дію, секунди
+MESSAGE_DEBOUNCE = float(os.environ.get('MESSAGE_DEBOUNCE', '1.5'))
+
+# Пам'ять розмови з Майстром гри: бюджет токенів контексту на хід, максимальна
+# довжина підсумку старих ходів і скільки останніх ходів завжди лишаються дослівно
+MEMORY_TOKEN_BUDGET = int(os.environ.get('MEMORY_TOKEN_BUDGET', '400'))
+MEMORY_SUMMARY_TOKENS = int(os.environ.get('MEMORY_SUMMARY_TOKENS', '120'))
+MEMORY_KEEP_TURNS = int(os.environ.get('MEMORY_KEEP_TURNS', '2'))
+
+# Вибір моделі для ходу Майстра гри: легка модель для простих дій і, за бажанням,
+# дорожча для складних планів ("" - завжди легка), межі тайм-ауту запиту, секунди,
+# та у скільки разів тайм-аут більший за p95 останніх відповідей моделі
+OPENAI_MODEL = os.environ.get('OPENAI_MODEL', 'gpt-4o-mini')
+OPENAI_HEAVY_MODEL = os.environ.get('OPENAI_HEAVY_MODEL', '')
+GPT_TIMEOUT_MIN = float(os.environ.get('GPT_TIMEOUT_MIN', '4'))
+GPT_TIMEOUT_MAX = float(os.environ.get('GPT_TIMEOUT_MAX', '20'))
+GPT_TIMEOUT_FACTOR = float(os.environ.get('GPT_TIMEOUT_FACTOR', '2'))
+
+# Локальне виконання рутинних дій (зілля, лікування, золото, проста атака) без GPT:
+# 0 - вимкнено; найдовше повідомлення, яке ще вважається простою дією, у словах
+FAST_PATH_ENABLED = os.environ.get('FAST_PATH_ENABLED', '1') != '0'
+FAST_PATH_MAX_WORDS = int(os.environ.get('FAST_PATH_MAX_WORDS', '6'))
+
+# Групові бої: скільки гравець думає над ходом, секунди (0 - без обмеження),
+# після скількох раундів вороги відступають, скільки гравців в одному бою
+BATTLE_TURN_TIMEOUT = float(os.environ.get('BATTLE_TURN_TIMEOUT', '60'))
+BATTLE_MAX_ROUNDS = int(os.environ.get('BATTLE_MAX_ROUNDS', '20'))
+BATTLE_MAX_PLAYERS = int(os.environ.get('BATTLE_MAX_PLAYERS', '5'))
+
+# Лічильники здібностей: як часто нові використання пишуться у сховище, секунди,
+# та година (UTC), о якій скидаються денні ліміти
+ABILITY_SYNC_INTERVAL = float(os.environ.get('ABILITY_SYNC_INTERVAL', '10'))
+ABILITY_RESET_HOUR = int(os.environ.get('ABILITY_RESET_HOUR', '0'))
+
+# Оцінка шансів атаки методом Монте-Карло: кількість випробувань на одну оцінку
+# та типові значення захисту цілі для картки гравця в промпті
+COMBAT_SIM_TRIALS = int(os.environ.get('COMBAT_SIM_TRIALS', '20000'))
+COMBAT_REFERENCE_DEFENSES = (12, 15)
+
+# Обмеження навантаження на бекенди: запитів на секунду, запас сплеску,
+# одночасних запитів та довжина черги, після якої гравцям відповідаємо "зайнято"
+OPENAI_RPS = float(os.environ.get('OPENAI_RPS', '8'))
+OPENAI_BURST = int(os.environ.get('OPENAI_BURST', '16'))
+OPENAI_CONCURRENCY = int(os.environ.get('OPENAI_CONCURRENCY', '20'))
+OPENAI_MAX_QUEUE = int(os.environ.get('OPENAI_MAX_QUEUE', '50'))
+SHEETS_RPS = float(os.environ.get('SHEETS_RPS', '10'))
+SHEETS_BURST = int(os.environ.get('SHEETS_BURST', '20'))
+SHEETS_CONCURRENCY = int(os.environ.get('SHEETS_CONCURRENCY', '30'))
+SHEETS_MAX_QUEUE = int(os.environ.get('SHEETS_MAX_QUEUE', '100'))
+
+# Запобіжники бекендів: ковзне вікно останніх запитів, частка помилок (повільні
+# запити теж вважаються помилками), за якої ланцюг розмикається, мінімум запитів
+# для рішення, поріг повільного запиту та пауза перед пробним запитом, секунди
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', '50'))
+BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', '0.5'))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', '10'))
+BREAKER_SLOW_CALL = float(os.environ.get('BREAKER_SLOW_CALL', '8'))
+BREAKER_COOLDOWN = float(os.environ.get('BREAKER_COOLDOWN', '15'))
+
+# Дубль запитів читання (get_player, get_ability), якщо відповіді немає довше p95
+# останніх запитів, але не раніше ніж за стільки секунд (0 - без дублів)
+SHEETS_HEDGE_DELAY = float(os.environ.get('SHEETS_HEDGE_DELAY', '0.3'))
+
+# Режим webhook: публічна адреса бота, порт, секрет для перевірки запитів від Telegram
+# та кількість процесів-обробників (0 - обробляти в одному процесі)
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_PORT = int(os.environ.get('PORT', '8443'))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or None
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '2'))
+
+# Метрики Prometheus на локальному порту (0 - вимкнено; у режимі webhook обробник i
+# слухає METRICS_PORT + 1 + i) та поріг для логу повільних запитів, секунди
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', '3.0'))
+
+BUSY_MESSAGE = "⏳ Зараз забагато гравців одночасно. Спробуйте ще раз за хвилинку!"
+UNAVAILABLE_MESSAGE = "⚠️ Сховище гравців зараз не відповідає. Спробуйте ще раз за хвилинку!"
+
+# Ініціалізація OpenAI клієнта
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Класи персонажів
+CLASSES = {
+    'knight': {
+        'name': '🛡️ Лицар',
+        'stats': {'str': 15, 'dex': 10, 'con': 14, 'int': 8, 'wis': 12, 'cha': 13},
+        'hp_base': 15,
+        'mp_base': 0,
+        'equipment': ['sword', 'shield', 'chainmail'],
+        'gold': 50,
+        'abilities': ['mighty_strike', 'protect_ally']
+    },
+    'mage': {
+        'name': '🧙‍♂️ Маг',
+        'stats': {'str': 8, 'dex': 12, 'con': 10, 'int': 15, 'wis': 14, 'cha': 11},
+        'hp_base': 8,
+        'mp_base': 10,
+        'equipment': ['staff', 'robe', 'spellbook'],
+        'gold': 30,
+        'abilities': ['magic_missile', 'fireball', 'heal']
+    },
+    'archer': {
+        'name': '🏹 Лучник',
+        'stats': {'str': 12, 'dex': 15, 'con': 13, 'int': 10, 'wis': 14, 'cha': 8},
+        'hp_base': 12,
+        'mp_base': 0,
+        'equipment': ['bow', 'arrows:30', 'leather_armor'],
+        'gold': 40,
+        'abilities': ['precise_shot', 'multi_shot']
+    },
+    'thief': {
+        'name': '🗡️ Злодій',
+        'stats': {'str': 10, 'dex': 15, 'con': 12, 'int': 13, 'wis': 11, 'cha': 14},
+        'hp_base': 10,
+        'mp_base': 0,
+        'equipment': ['dagger', 'dagger', 'thieves_tools', 'dark_cloak'],
+        'gold': 60,
+        'abilities': ['backstab', 'stealth']
+    },
+    'cleric': {
+        'name': '⚕️ Жрець',
+        'stats': {'str': 11, 'dex': 10, 'con': 13, 'int': 12, 'wis': 15, 'cha': 14},
+        'hp_base': 12,
+        'mp_base': 8,
+        'equipment': ['mace', 'holy_symbol', 'healing_potion:2'],
+        'gold': 35,
+        'abilities': ['mass_heal', 'turn_undead']
+    }
+}
+
+# Предмети та їх характеристики
+ITEMS = {
+    'sword': {'name': 'Меч', 'damage': 'd8', 'type': 'weapon', 'price': 50},
+    'dagger': {'name': 'Кинджал', 'damage': 'd4', 'type': 'weapon', 'price': 10},
+    'bow': {'name': 'Лук', 'damage': 'd8', 'type': 'ranged', 'price': 40},
+    'staff': {'name': 'Посох', 'damage': 'd6', 'type': 'weapon', 'price': 25},
+    'mace': {'name': 'Булава', 'damage': 'd6', 'type': 'weapon', 'price': 30},
+    'shield': {'name': 'Щит', 'defense': 2, 'type': 'armor', 'price': 25},
+    'chainmail': {'name': 'Кольчуга', 'defense': 3, 'type': 'armor', 'price': 100},
+    'leather_armor': {'name': 'Шкіряна броня', 'defense': 2, 'type': 'armor', 'price': 30},
+    'robe': {'name': 'Мантія', 'defense': 1, 'type': 'armor', 'price': 20},
+    'healing_potion': {'name': 'Зілля лікування', 'heal': 'd6+1', 'type': 'consumable', 'price': 20}
+}
+
+# Спеціальні здібності
+ABILITIES = {
+    'mighty_strike': {'name': 'Могутній удар', 'uses_per_battle': 1, 'effect': 'double_damage'},
+    'protect_ally': {'name': 'Захист союзника', 'uses_per_battle': 1, 'effect': 'redirect_damage'},
+    'magic_missile': {'name': 'Магічна стріла', 'mp_cost': 2, 'damage': 'd4+INT', 'auto_hit': True},
+    'fireball': {'name': 'Вогняна куля', 'mp_cost': 4, 'damage': 'd8+INT', 'area': True},
+    'heal': {'name': 'Лікування', 'mp_cost': 2, 'heal': 'd6+WIS'},
+    'precise_shot': {'name': 'Точний постріл', 'uses_per_battle': 1, 'effect': '+5_attack'},
+    'multi_shot': {'name': 'Багатократний постріл', 'uses_per_battle': 1, 'effect': '3_arrows'},
+    'backstab': {'name': 'Удар зі спини', 'uses_per_battle': 1, 'damage': '+d6'},
+    'stealth': {'name': 'Скрадання', 'uses_per_battle': 1, 'effect': 'advantage'},
+    'mass_heal': {'name': 'Масове лікування', 'uses_per_day': 1, 'heal': 'd6_all'},
+    'turn_undead': {'name': 'Вигнання нежиті', 'uses_per_battle': 1, 'effect': 'fear_undead'}
+}
+
+# Вороги для групових боїв
+ENEMIES = {
+    'goblin': {'name': 'Гоблін', 'hp': 7, 'defense': 12, 'attack': 4, 'damage': 'd6+2', 'xp': 15, 'gold': 5},
+    'wolf': {'name': 'Вовк', 'hp': 11, 'defense': 13, 'attack': 4, 'damage': '2d4+2', 'xp': 20, 'gold': 0},
+    'skeleton': {'name': 'Скелет', 'hp': 13, 'defense': 13, 'attack': 4, 'damage': 'd6+2', 'xp': 25, 'gold': 3,
+                 'undead': True},
+    'zombie': {'name': 'Зомбі', 'hp': 22, 'defense': 8, 'attack': 3, 'damage': 'd6+1', 'xp': 25, 'gold': 1,
+               'undead': True},
+    'orc': {'name': 'Орк', 'hp': 15, 'defense': 13, 'attack': 5, 'damage': 'd12+3', 'xp': 35, 'gold': 10},
+    'troll': {'name': 'Троль', 'hp': 40, 'defense': 15, 'attack': 7, 'damage': '2d6+4', 'xp': 120, 'gold': 40}
+}
+
+# Порядок характеристик у Player.stats та Player.modifiers
+STAT_ORDER = ('str', 'dex', 'con', 'int', 'wis', 'cha')
+STAT_INDEX = {stat: index for index, stat in enumerate(STAT_ORDER)}
+
+# Однакові набори характеристик (стартові для класу тощо) зберігаються один раз,
+# а модифікатори до них рахуються один раз на набір; рідкісні набори витісняються
+STATS_POOL_SIZE = 4096
+
+@functools.lru_cache(maxsize=STATS_POOL_SIZE)
+def pooled_stats(stats: Tuple[int, ...]) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """Спільний екземпляр набору характеристик і модифікаторів до нього"""
+    return stats, tuple(DiceRoller.get_modifier(value) for value in stats)
+
+def parse_inventory(inventory: str) -> Dict[str, int]:
+    """Розбирає рядок 'bow,arrows:30,dagger,dagger' у {'bow': 1, 'arrows': 30, 'dagger': 2}"""
+    items: Dict[str, int] = {}
+    for item in inventory.split(','):
+        item_id, _, quantity = item.strip().partition(':')
+        if item_id:
+            item_id = sys.intern(item_id)
+            items[item_id] = items.get(item_id, 0) + (int(quantity) if quantity.isdigit() else 1)
+    return items
+
+def format_inventory(items: Dict[str, int]) -> str:
+    """Зворотне перетворення інвентаря у формат рядка таблиці"""
+    return ','.join(item_id if quantity == 1 else f"{item_id}:{quantity}" for item_id, quantity in items.items())
+
+def _to_int(value: Any, default: int = 0) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+@dataclass(slots=True, frozen=True)
+class Player:
+    """Гравець з розібраним інвентарем і наперед обчисленими модифікаторами.
+    
+    Об'єкт не змінюється після створення (frozen): зміни дають новий Player через
+    with_updates, тому похідні значення (картка для промпту тощо) можна кешувати прямо в ньому.
+    Інвентар - звичайний словник, його теж не змінюють на місці.
+    """
+    user_id: int
+    name: str
+    player_class: str
+    level: int
+    hp_current: int
+    hp_max: int
+    mp_current: int
+    mp_max: int
+    xp: int
+    gold: int
+    stats: Tuple[int, ...]
+    modifiers: Tuple[int, ...]
+    inventory: Dict[str, int]
+    # Колонки таблиці, про які бот не знає - зберігаємо для зворотного запису
+    extra: Optional[Dict[str, Any]] = None
+    _memo: Optional[Dict[str, Any]] = field(default=None, repr=False, compare=False)
+    
+    ROW_FIELDS = ('user_id', 'name', 'class', 'level', 'hp_current', 'hp_max', 'mp_current', 'mp_max',
+                  'xp', 'gold', 'inventory') + STAT_ORDER
+    
+    @staticmethod
+    def from_row(row: Dict[str, Any]) -> 'Player':
+        """Створює гравця з рядка таблиці"""
+        stats = tuple(_to_int(row.get(stat), 10) for stat in STAT_ORDER)
+        pooled = pooled_stats(stats)
+        extra = {key: value for key, value in row.items() if key not in Player.ROW_FIELDS}
+        return Player(
+            user_id=_to_int(row.get('user_id')),
+            name=str(row.get('name') or ''),
+            player_class=sys.intern(str(row.get('class') or '')),
+            level=_to_int(row.get('level'), 1),
+            hp_current=_to_int(row.get('hp_current')),
+            hp_max=_to_int(row.get('hp_max')),
+            mp_current=_to_int(row.get('mp_current')),
+            mp_max=_to_int(row.get('mp_max')),
+            xp=_to_int(row.get('xp')),
+            gold=_to_int(row.get('gold')),
+            stats=pooled[0],
+            modifiers=pooled[1],
+            inventory=parse_inventory(str(row.get('inventory') or '')),
+            extra=extra or None
+        )
+    
+    def to_row(self) -> Dict[str, Any]:
+        """Рядок таблиці у форматі Apps Script"""
+        row = dict(self.extra or {})
+        row.update({
+            'user_id': str(self.user_id),
+            'name': self.name,
+            'class': self.player_class,
+            'level': self.level,
+            'hp_current': self.hp_current,
+            'hp_max': self.hp_max,
+            'mp_current': self.mp_current,
+            'mp_max': self.mp_max,
+            'xp': self.xp,
+            'gold': self.gold,
+            'inventory': format_inventory(self.inventory)
+        })
+        row.update(zip(STAT_ORDER, self.stats))
+        return row
+    
+    def with_updates(self, updates: Dict[str, Any]) -> 'Player':
+        """Новий гравець із застосованими змінами у форматі рядка таблиці"""
+        row = self.to_row()
+        row.update(updates)
+        return Player.from_row(row)
+    
+    def stat(self, name: str) -> int:
+        """Значення характеристики за назвою ('str', 'DEX', ...)"""
+        index = STAT_INDEX.get(name.lower())
+        return self.stats[index] if index is not None else 10
+    
+    def modifier(self, name: str) -> int:
+        """Модифікатор характеристики за назвою"""
+        index = STAT_INDEX.get(name.lower())
+        return self.modifiers[index] if index is not None else 0
+    
+    @property
+    def class_name(self) -> str:
+        return CLASSES.get(self.player_class, {}).get('name', 'Невідомий')
+    
+    def memo(self, key: str, compute: Callable[['Player'], Any]) -> Any:
+        """Обчислює похідне значення один раз на версію гравця"""
+        if self._memo is None:
+            # Кеш похідних значень - єдине поле, яке заповнюється після створення
+            object.__setattr__(self, '_memo', {})
+        if key not in self._memo:
+            self._memo[key] = compute(self)
+        return self._memo[key]
+
+def inventory_names(items: Dict[str, int]) -> List[str]:
+    """Назви предметів для показу гравцю"""
+    return [
+        f"{ITEMS.get(item_id, {}).get('name', item_id)} x{quantity}" if quantity > 1
+        else ITEMS.get(item_id, {}).get('name', item_id)
+        for item_id, quantity in items.items()
+    ]
+
+# Стартове спорядження класів, розібране один раз
+CLASS_STARTING_INVENTORY = {
+    class_key: parse_inventory(','.join(class_data['equipment']))
+    for class_key, class_data in CLASSES.items()
+}
+
+# Межі бакетів гістограм затримок, секунди
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Етапи поточного запиту для логу повільних запитів: [(назва, секунди), ...]
+current_trace: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar('current_trace', default=None)
+
+class Metrics:
+    """Лічильники і гістограми затримок, які віддаються в текстовому форматі Prometheus"""
+    
+    def __init__(self, buckets: Tuple[float, ...], host: str, port: int):
+        self.buckets = buckets
+        self.host = host
+        self.port = port
+        # назва -> (тип, опис)
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        # назва -> {мітки: значення}; для гістограм значення - [лічильники бакетів..., сума]
+        self._series: Dict[str, Dict[Tuple[Tuple[str, str], ...], Any]] = {}
+        # компонент -> функція stats(), числові поля якої віддаються як gauge
+        self._collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+    
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+        self._series.setdefault(name, {})
+    
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        series = self._series[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + amount
+    
+    def observe(self, name: str, value: float, **labels: str):
+        series = self._series[name]
+        key = tuple(sorted(labels.items()))
+        counts = series.get(key)
+        if counts is None:
+            # останній бакет - +Inf, за ним сума значень
+            counts = series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+    
+    def register_stats(self, component: str, collect: Callable[[], Dict[str, Any]]):
+        self._collectors[component] = collect
+    
+    @staticmethod
+    def _labels(key: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+        parts = [f'{label}="{value}"' for label, value in key]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+    
+    def render(self) -> str:
+        """Текст для /metrics"""
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in self._series[name].items():
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._labels(key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), value):
+                    cumulative += count
+                    le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                    lines.append(f"{name}_bucket{self._labels(key, le)} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(key)} {value[-1]:.6f}")
+                lines.append(f"{name}_count{self._labels(key)} {cumulative}")
+        
+        lines.append("# HELP rpg_component_stat Лічильники stats() компонентів бота")
+        lines.append("# TYPE rpg_component_stat gauge")
+        for component, collect in self._collectors.items():
+            for stat, value in collect().items():
+                if isinstance(value, (int, float)):
+                    lines.append(f'rpg_component_stat{{component="{component}",stat="{stat}"}} {float(value)}')
+        return '\n'.join(lines) + '\n'
+    
+    async def start(self):
+        """Запускає HTTP сервер метрик, якщо задано порт"""
+        if not self.port:
+            return
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Метрики: http://{self.host}:{self.port}/metrics")
+    
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+    
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Заголовки запиту не потрібні, лише дочитуємо їх
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[1] == b'/metrics':
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+metrics = Metrics(LATENCY_BUCKETS, METRICS_HOST, METRICS_PORT)
+metrics.describe('rpg_handler_duration_seconds', 'histogram', 'Час обробки оновлення Telegram')
+metrics.describe('rpg_backend_duration_seconds', 'histogram', 'Час запиту до бекенду разом з очікуванням черги')
+metrics.describe('rpg_backend_errors_total', 'counter', 'Запити до бекенду, що завершились винятком')
+metrics.describe('rpg_openai_first_token_seconds', 'histogram', 'Час до першого фрагмента потокової відповіді GPT')
+metrics.describe('rpg_openai_tokens_total', 'counter', 'Токени GPT')
+metrics.describe('rpg_gpt_fallbacks_total', 'counter', 'Відповіді GPT, замінені запасною')
+metrics.describe('rpg_gpt_json_errors_total', 'counter', 'Відповіді GPT, які не вдалося розібрати як JSON')
+metrics.describe('rpg_gpt_routes_total', 'counter', 'Ходи Майстра гри за обраною моделлю')
+
+def trace_event(name: str, elapsed: float):
+    """Додає етап до траси поточного запиту"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.append((name, elapsed))
+
+@contextlib.contextmanager
+def backend_span(backend: str, action: str):
+    """Вимірює запит до бекенду: гістограма, лічильник помилок і етап траси"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc('rpg_backend_errors_total', backend=backend, action=action)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('rpg_backend_duration_seconds', elapsed, backend=backend, action=action)
+        trace_event(f"{backend}.{action}", elapsed)
+
+def instrumented(handler: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Вимірює обробник і пише в лог повільні запити з розкладом по етапах"""
+    name = handler.__name__
+    
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        trace: List[Tuple[str, float]] = []
+        token = current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            return await handler(update, context, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_trace.reset(token)
+            metrics.observe('rpg_handler_duration_seconds', elapsed, handler=name)
+            if elapsed >= SLOW_REQUEST_THRESHOLD:
+                stages = ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in trace) or 'без запитів до бекендів'
+                logger.warning(f"Повільний запит {name}: {elapsed:.2f}s ({stages})")
+    
+    return wrapper
+
+# Пріоритети запитів до бекендів: менше число - раніше в черзі
+PRIORITY_INTERACTIVE = 0  # кубики, /stats та інші швидкі дії
+PRIORITY_NARRATIVE = 1    # ходи Майстра гри
+PRIORITY_BACKGROUND = 2   # фонові записи та оновлення кешу
+
+# Пріоритет поточного обробника; кожне оновлення Telegram має свою копію
+request_priority: contextvars.ContextVar[int] = contextvars.ContextVar('request_priority', default=PRIORITY_NARRATIVE)
+
+class BackendBusy(Exception):
+    """Черга до бекенду переповнена"""
+    
+    def __init__(self, backend: str):
+        super().__init__(f"Бекенд {backend} перевантажений")
+        self.backend = backend
+
+class BackendUnavailable(Exception):
+    """Запобіжник бекенду розімкнено - запит не відправляється"""
+    
+    def __init__(self, backend: str):
+        super().__init__(f"Бекенд {backend} тимчасово вимкнено запобіжником")
+        self.backend = backend
+
+class TokenBucket:
+    """Відро токенів: rate запитів на секунду з запасом burst"""
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def time_until_token(self) -> float:
+        """Скільки чекати до появи наступного токена"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def try_take(self) -> bool:
+        if self.time_until_token() > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+class BackendScheduler:
+    """Допуск запитів до бекенду: відро токенів, обмеження паралельності та черга з пріоритетами"""
+    
+    def __init__(self, name: str, rate: float, burst: int, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        # (пріоритет, порядковий номер, future)
+        self._queue: List[tuple] = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._wakeup = asyncio.Event()
+        self._pump_task: Optional[asyncio.Task] = None
+        self.granted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: Optional[int] = None):
+        """Чекає своєї черги і займає місце на час запиту"""
+        await self._acquire(request_priority.get() if priority is None else priority)
+        try:
+            yield
+        finally:
+            self._release()
+    
+    def _queue_limit(self, priority: int) -> Optional[int]:
+        """Швидкі дії відсікаються пізніше за ходи, фонові задачі - ніколи"""
+        if priority >= PRIORITY_BACKGROUND:
+            return None
+        return self.max_queue * 2 if priority == PRIORITY_INTERACTIVE else self.max_queue
+    
+    async def _acquire(self, priority: int):
+        if not self._queue and self._active < self.max_concurrency and self.bucket.try_take():
+            self._active += 1
+            self.granted += 1
+            return
+        
+        limit = self._queue_limit(priority)
+        if limit is not None and len(self._queue) >= limit:
+            self.rejected += 1
+            raise BackendBusy(self.name)
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), future))
+        self.max_depth = max(self.max_depth, len(self._queue))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        
+        started_at = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Місце вже видали, але обробник скасували - повертаємо його
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        waited = time.monotonic() - started_at
+        trace_event(f"{self.name}.queue", waited)
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+    
+    async def _pump(self):
+        """Видає місця з черги в порядку пріоритету"""
+        while self._queue:
+            if self._active >= self.max_concurrency:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self.bucket.time_until_token()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue
+            self.bucket.try_take()
+            self._active += 1
+            self.granted += 1
+            future.set_result(None)
+    
+    def _release(self):
+        self._active -= 1
+        self._wakeup.set()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': len(self._queue),
+            'max_queue_depth': self.max_depth,
+            'active': self._active,
+            'granted': self.granted,
+            'rejected': self.rejected,
+            'avg_wait': round(self.total_wait / self.granted, 3) if self.granted else 0.0,
+            'max_wait': round(self.max_wait, 3)
+        }
+
+openai_scheduler = BackendScheduler('openai', OPENAI_RPS, OPENAI_BURST, OPENAI_CONCURRENCY, OPENAI_MAX_QUEUE)
+sheets_scheduler = BackendScheduler('sheets', SHEETS_RPS, SHEETS_BURST, SHEETS_CONCURRENCY, SHEETS_MAX_QUEUE)
+
+class CircuitBreaker:
+    """Запобіжник бекенду за часткою помилок і повільних запитів у ковзному вікні
+    
+    Розімкнений запобіжник одразу відмовляє, а раз на cooldown пропускає пробний запит:
+    успіх замикає ланцюг, помилка розмикає знову. Час успішних запитів з вікна також
+    задає затримку дубля для запитів читання.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, name: str, window: int, error_rate: float, min_calls: int,
+                 slow_call: float, cooldown: float):
+        self.name = name
+        self.max_error_rate = error_rate
+        self.min_calls = min_calls
+        self.slow_call = slow_call
+        self.cooldown = cooldown
+        # (успіх, тривалість) останніх запитів
+        self._calls: deque = deque(maxlen=window)
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_at: Optional[float] = None
+        self.opened = 0
+        self.rejected = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+    
+    def allow(self) -> bool:
+        """Чи відправляти запит"""
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self._opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self._probe_at = None
+        # Один пробний запит; якщо його скасували, через cooldown - наступний
+        if self.state == self.HALF_OPEN and (self._probe_at is None or now - self._probe_at >= self.cooldown):
+            self._probe_at = now
+            return True
+        self.rejected += 1
+        return False
+    
+    def record(self, ok: bool, elapsed: float):
+        """Результат запиту; запит, довший за slow_call, - теж помилка"""
+        ok = ok and elapsed < self.slow_call
+        if self.state == self.HALF_OPEN:
+            if ok:
+                self.state = self.CLOSED
+                self._calls.clear()
+                logger.info(f"Запобіжник {self.name} замкнено")
+            else:
+                self._trip()
+            return
+        self._calls.append((ok, elapsed))
+        if (self.state == self.CLOSED and len(self._calls) >= self.min_calls
+                and self.error_rate() >= self.max_error_rate):
+            self._trip()
+    
+    def _trip(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self.opened += 1
+        logger.warning(
+            f"Запобіжник {self.name} розімкнено на {self.cooldown:.0f}s "
+            f"(помилок {self.error_rate():.0%} з {len(self._calls)})"
+        )
+    
+    def error_rate(self) -> float:
+        if not self._calls:
+            return 0.0
+        return sum(1 for ok, _ in self._calls if not ok) / len(self._calls)
+    
+    def latency_percentile(self, q: float) -> Optional[float]:
+        """Перцентиль часу успішних запитів (None - замало даних)"""
+        latencies = [elapsed for ok, elapsed in self._calls if ok]
+        if len(latencies) < self.min_calls:
+            return None
+        return float(np.percentile(latencies, q))
+    
+    def hedge_delay(self, min_delay: float) -> Optional[float]:
+        """Через скільки відправляти дубль запиту читання (None - не дублювати)"""
+        if min_delay <= 0 or self.state != self.CLOSED:
+            return None
+        p95 = self.latency_percentile(95)
+        return None if p95 is None else max(min_delay, p95)
+    
+    def stats(self) -> Dict[str, Any]:
+        p95 = self.latency_percentile(95)
+        return {
+            'open': int(self.state != self.CLOSED),
+            'opened': self.opened,
+            'rejected': self.rejected,
+            'error_rate': round(self.error_rate(), 3),
+            'p95': round(p95, 3) if p95 is not None else 0.0,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins
+        }
+
+openai_breaker = CircuitBreaker('openai', BREAKER_WINDOW, BREAKER_ERROR_RATE, BREAKER_MIN_CALLS,
+                                BREAKER_SLOW_CALL, BREAKER_COOLDOWN)
+sheets_breaker = CircuitBreaker('sheets', BREAKER_WINDOW, BREAKER_ERROR_RATE, BREAKER_MIN_CALLS,
+                                BREAKER_SLOW_CALL, BREAKER_COOLDOWN)
+
+class PlayerCache:
+    """LRU/TTL кеш гравців (Player) з версіями записів"""
+    
+    def __init__(self, max_size: int, ttl: float, max_age: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_age = max_age
+        # user_id -> [player, version, fetched_at]
+        self._entries: 'OrderedDict[int, list]' = OrderedDict()
+        # Глобальний лічильник: версія ніколи не повторюється, навіть після витіснення
+        self._clock = 0
+        self._refreshing: Dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.refreshes = 0
+        self.fallbacks = 0
+    
+    def version(self, user_id: int) -> int:
+        """Поточна версія даних гравця (0 - немає в кеші)"""
+        entry = self._entries.get(user_id)
+        return entry[1] if entry else 0
+    
+    def put(self, user_id: int, player: Player) -> int:
+        """Кладе гравця в кеш і піднімає версію"""
+        self._clock += 1
+        self._entries[user_id] = [player, self._clock, time.monotonic()]
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return self._clock
+    
+    def update(self, user_id: int, updates: Dict[str, Any]) -> bool:
+        """Застосовує зміни до закешованого гравця (write-through)"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return False
+        self.put(user_id, entry[0].with_updates(updates))
+        return True
+    
+    def restore(self, user_id: int, player: Player, age: float) -> bool:
+        """Кладе гравця зі знімка з його віком, якщо свіжіших даних ще немає"""
+        if user_id in self._entries or age >= self.max_age:
+            return False
+        self.put(user_id, player)
+        self._entries[user_id][2] = time.monotonic() - age
+        return True
+    
+    def snapshot(self) -> List[Tuple[int, Player, float]]:
+        """Гравці в кеші з віком даних, секунди"""
+        now = time.monotonic()
+        return [(user_id, entry[0], now - entry[2]) for user_id, entry in self._entries.items()]
+    
+    def invalidate(self, user_id: int):
+        """Видаляє гравця з кешу"""
+        self._entries.pop(user_id, None)
+    
+    def peek(self, user_id: int) -> Optional[Player]:
+        """Повертає закешованого гравця без перевірки віку та лічильників"""
+        entry = self._entries.get(user_id)
+        return entry[0] if entry else None
+    
+    async def get(self, user_id: int,
+                  loader: Callable[[int], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Повертає гравця з кешу або завантажує рядок таблиці через loader"""
+        entry = self._entries.get(user_id)
+        now = time.monotonic()
+        
+        if entry is not None:
+            age = now - entry[2]
+            if age < self.max_age:
+                self._entries.move_to_end(user_id)
+                if age < self.ttl:
+                    self.hits += 1
+                else:
+                    # Віддаємо застарілі дані одразу, оновлюємо у фоні
+                    self.stale_hits += 1
+                    self._refresh_in_background(user_id, loader)
+                return {"success": True, "player": entry[0]}
+            # Занадто старий запис лишається запасним, поки гравця не вдасться перечитати
+        
+        self.misses += 1
+        result = await self._load(user_id, loader)
+        if result.get("success") and not result.get("player"):
+            self._entries.pop(user_id, None)
+        elif not result.get("success") and user_id in self._entries:
+            # Сховище недоступне - краще застарілі дані, ніж жодних
+            self.fallbacks += 1
+            return {"success": True, "player": self._entries[user_id][0], "stale": True}
+        return result
+    
+    async def _load(self, user_id: int,
+                    loader: Callable[[int], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Завантажує гравця і кешує лише успішну відповідь"""
+        started_at = self._clock
+        result = await loader(user_id)
+        if not result.get("success") or not result.get("player"):
+            return result
+        # Не перезаписуємо дані, якщо поки йшов запит гравця вже оновили
+        if self.version(user_id) > started_at:
+            return {"success": True, "player": self._entries[user_id][0]}
+        player = Player.from_row(result["player"])
+        self.put(user_id, player)
+        return {"success": True, "player": player}
+    
+    def _refresh_in_background(self, user_id: int,
+                               loader: Callable[[int], Awaitable[Dict[str, Any]]]):
+        """Запускає одне фонове оновлення на гравця"""
+        if user_id in self._refreshing:
+            return
+        self.refreshes += 1
+        task = asyncio.create_task(self._load(user_id, loader),
+                                   context=self._background_context())
+        self._refreshing[user_id] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(user_id, None))
+    
+    @staticmethod
+    def _background_context() -> contextvars.Context:
+        """Контекст з фоновим пріоритетом для задач оновлення"""
+        context = contextvars.copy_context()
+        context.run(request_priority.set, PRIORITY_BACKGROUND)
+        # Фонове оновлення не належить до траси запиту, який його запустив
+        context.run(current_trace.set, None)
+        return context
+    
+    def stats(self) -> Dict[str, Any]:
+        """Лічильники для налаштування розміру кешу"""
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'refreshes': self.refreshes,
+            'fallbacks': self.fallbacks,
+            'hit_rate': round((self.hits + self.stale_hits) / lookups, 3) if lookups else 0.0
+        }
+
+player_cache = PlayerCache(PLAYER_CACHE_SIZE, PLAYER_CACHE_TTL, PLAYER_CACHE_MAX_AGE)
+
+class WriteBehindBuffer:
+    """Буфер відкладеного запису: зливає зміни гравців і пише їх пакетами"""
+    
+    def __init__(self, interval: float, max_batch: int, journal_path: str):
+        self.interval = interval
+        self.max_batch = max_batch
+        self.journal_path = journal_path
+        # user_id -> злиті поля, у порядку першої зміни
+        self._pending: 'OrderedDict[int, Dict[str, Any]]' = OrderedDict()
+        self._pending_abilities: List[Dict[str, Any]] = []
+        # Зміни, які вже відправлені, але ще не підтверджені
+        self._inflight: Dict[int, Dict[str, Any]] = {}
+        self._inflight_abilities: List[Dict[str, Any]] = []
+        self._sender: Optional[Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]] = None
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.flush_errors = 0
+        self.merged_updates = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0 and self._task is not None
+    
+    def add_update(self, user_id: int, updates: Dict[str, Any]):
+        """Додає зміни гравця, зливаючи їх з уже очікуючими"""
+        if user_id in self._pending:
+            self.merged_updates += 1
+            self._pending[user_id].update(updates)
+        else:
+            self._pending[user_id] = dict(updates)
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+    
+    def add_ability_use(self, user_id: int, ability: str):
+        """Додає використання здібності до наступного пакета"""
+        self._pending_abilities.append({
+            "user_id": str(user_id), "ability_name": ability, "used": True, "last_used": round(time.time())
+        })
+        if len(self._pending_abilities) >= self.max_batch:
+            self._wakeup.set()
+    
+    def overlay(self, user_id: int, player: Dict[str, Any]) -> Dict[str, Any]:
+        """Накладає ще не записані зміни на дані з таблиці"""
+        inflight = self._inflight.get(user_id)
+        pending = self._pending.get(user_id)
+        if not inflight and not pending:
+            return player
+        player = dict(player)
+        player.update(inflight or {})
+        player.update(pending or {})
+        return player
+    
+    def ability_pending(self, user_id: int, ability: str) -> bool:
+        """Чи є незаписане використання здібності"""
+        user_key = str(user_id)
+        return any(
+            use["user_id"] == user_key and use["ability_name"] == ability
+            for use in self._inflight_abilities + self._pending_abilities
+        )
+    
+    def pending_count(self) -> int:
+        return len(self._pending) + len(self._pending_abilities)
+    
+    def start(self, sender: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]):
+        """Запускає фонове скидання буфера"""
+        self._sender = sender
+        self._load_journal()
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Зупиняє фонове скидання і записує все, що залишилось"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._sender is not None:
+            await self.flush()
+        if self.pending_count():
+            self._save_journal()
+    
+    async def _run(self):
+        request_priority.set(PRIORITY_BACKGROUND)
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    async def flush(self) -> bool:
+        """Відправляє всі очікуючі зміни одним запитом batch_update"""
+        async with self._lock:
+            if not self.pending_count():
+                return True
+            
+            self._inflight, self._pending = self._pending, OrderedDict()
+            self._inflight_abilities, self._pending_abilities = self._pending_abilities, []
+            
+            try:
+                result = await self._sender({
+                    "action": "batch_update",
+                    "players": [dict(fields, user_id=str(user_id)) for user_id, fields in self._inflight.items()],
+                    "abilities": self._inflight_abilities
+                })
+            except BaseException:
+                # Скасування при зупинці теж: пакет мав би піти в журнал, а не зникнути
+                self.flush_errors += 1
+                self._restore_inflight()
+                raise
+            
+            if result.get("success"):
+                self.flushes += 1
+                self._inflight = {}
+                self._inflight_abilities = []
+            else:
+                self.flush_errors += 1
+                logger.error(f"Помилка пакетного запису: {result.get('error')}")
+                self._restore_inflight()
+            return bool(result.get("success"))
+    
+    def _restore_inflight(self):
+        """Повертає невідправлений пакет у буфер перед новішими змінами, щоб зберегти порядок"""
+        restored = OrderedDict()
+        for user_id, fields in self._inflight.items():
+            restored[user_id] = dict(fields)
+        for user_id, fields in self._pending.items():
+            restored.setdefault(user_id, {}).update(fields)
+        self._pending = restored
+        self._pending_abilities = self._inflight_abilities + self._pending_abilities
+        self._inflight = {}
+        self._inflight_abilities = []
+    
+    def _save_journal(self):
+        """Зберігає незаписані зміни на диск, щоб відправити їх після перезапуску"""
+        try:
+            with open(self.journal_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "players": [[user_id, fields] for user_id, fields in self._pending.items()],
+                    "abilities": self._pending_abilities
+                }, f, ensure_ascii=False)
+            logger.warning(f"Збережено {self.pending_count()} незаписаних змін у {self.journal_path}")
+            self._pending = OrderedDict()
+            self._pending_abilities = []
+        except OSError as e:
+            logger.error(f"Не вдалося зберегти журнал змін: {e}")
+    
+    def _load_journal(self):
+        """Відновлює незаписані зміни з попереднього запуску"""
+        if not os.path.exists(self.journal_path):
+            return
+        try:
+            with open(self.journal_path, encoding='utf-8') as f:
+                journal = json.load(f)
+            restored = OrderedDict((int(user_id), fields) for user_id, fields in journal.get("players", []))
+            for user_id, fields in self._pending.items():
+                restored.setdefault(user_id, {}).update(fields)
+            self._pending = restored
+            self._pending_abilities = journal.get("abilities", []) + self._pending_abilities
+            os.remove(self.journal_path)
+            logger.info(f"Відновлено {self.pending_count()} незаписаних змін з {self.journal_path}")
+        except (OSError, ValueError) as e:
+            logger.error(f"Не вдалося прочитати журнал змін: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pending_players': len(self._pending),
+            'pending_abilities': len(self._pending_abilities),
+            'flushes': self.flushes,
+            'flush_errors': self.flush_errors,
+            'merged_updates': self.merged_updates
+        }
+
+write_buffer = WriteBehindBuffer(WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_BATCH, WRITE_BEHIND_JOURNAL)
+
+class GoogleSheetsAPI:
+    """Клас для роботи з Google Sheets через Apps Script"""
+    
+    # Спільний асинхронний клієнт з пулом keep-alive з'єднань
+    _client: Optional[httpx.AsyncClient] = None
+    # Фонові записи, на які ніхто не чекає (тримаємо посилання до завершення)
+    _background_writes: set = set()
+    
+    @staticmethod
+    def get_client() -> httpx.AsyncClient:
+        """Повертає спільний HTTP клієнт, створюючи його при першому виклику"""
+        if GoogleSheetsAPI._client is None or GoogleSheetsAPI._client.is_closed:
+            GoogleSheetsAPI._client = httpx.AsyncClient(
+                headers={'Content-Type': 'application/json'},
+                timeout=SHEETS_DEFAULT_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=SHEETS_MAX_CONNECTIONS,
+                    max_keepalive_connections=SHEETS_MAX_KEEPALIVE
+                ),
+                # Apps Script відповідає редіректом на googleusercontent.com
+                follow_redirects=True
+            )
+        return GoogleSheetsAPI._client
+    
+    @staticmethod
+    async def close():
+        """Закриває спільний HTTP клієнт"""
+        if GoogleSheetsAPI._client is not None:
+            await GoogleSheetsAPI._client.aclose()
+            GoogleSheetsAPI._client = None
+    
+    @staticmethod
+    async def make_request(data: Dict[str, Any]) -> Dict[str, Any]:
+        """Відправляє запит до Google Apps Script"""
+        action = data.get("action")
+        if not sheets_breaker.allow():
+            return {"success": False, "error": "Google Sheets тимчасово недоступний", "unavailable": True}
+        # Читання можна безпечно повторити, тож на повільну відповідь не чекаємо до таймауту
+        hedge_delay = sheets_breaker.hedge_delay(SHEETS_HEDGE_DELAY) if action in ('get_player', 'get_ability') else None
+        if hedge_delay is None:
+            return await GoogleSheetsAPI._send(data)
+        return await GoogleSheetsAPI._send_hedged(data, hedge_delay)
+    
+    @staticmethod
+    async def _send(data: Dict[str, Any]) -> Dict[str, Any]:
+        """Один HTTP запит з обліком у запобіжнику"""
+        action = data.get("action")
+        timeout = SHEETS_TIMEOUTS.get(action, SHEETS_DEFAULT_TIMEOUT)
+        started = None
+        try:
+            with backend_span('sheets', action):
+                async with sheets_scheduler.slot():
+                    started = time.perf_counter()
+                    response = await GoogleSheetsAPI.get_client().post(
+                        GOOGLE_SCRIPT_URL,
+                        json=data,
+                        timeout=timeout
+                    )
+                result = response.json()
+        except BackendBusy:
+            raise
+        except Exception as e:
+            if started is not None:
+                sheets_breaker.record(False, time.perf_counter() - started)
+            logger.error(f"Помилка запиту до Google Sheets: {e}")
+            return {"success": False, "error": str(e)}
+        sheets_breaker.record(response.status_code < 500, time.perf_counter() - started)
+        return result
+    
+    @staticmethod
+    async def _send_hedged(data: Dict[str, Any], delay: float) -> Dict[str, Any]:
+        """Запит читання з дублем: якщо відповіді немає довше delay, той самий запит іде вдруге"""
+        first = asyncio.create_task(GoogleSheetsAPI._send(data))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                sheets_breaker.hedges += 1
+                tasks.add(asyncio.create_task(GoogleSheetsAPI._send(data)))
+            result, error = None, None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    result = task.result()
+                    if result.get("success"):
+                        if task is not first:
+                            sheets_breaker.hedge_wins += 1
+                        return result
+            if result is None:
+                raise error
+            return result
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    @staticmethod
+    async def get_player(user_id: int, fallback: Optional[Player] = None) -> Dict[str, Any]:
+        """Отримує дані гравця (через кеш); якщо сховище не відповідає - останні відомі з fallback"""
+        result = await player_cache.get(user_id, storage.fetch_player)
+        if not result.get("success") and fallback is not None:
+            return {"success": True, "player": fallback, "stale": True}
+        return result
+    
+    @staticmethod
+    async def create_player(user_id: int, name: str, player_class: str) -> Dict[str, Any]:
+        """Створює нового гравця"""
+        class_data = CLASSES[player_class]
+        player = {
+            "user_id": str(user_id),
+            "name": name,
+            "class": player_class,
+            "level": 1,
+            "hp_current": class_data['hp_base'],
+            "hp_max": class_data['hp_base'],
+            "mp_current": class_data['mp_base'],
+            "mp_max": class_data['mp_base'],
+            "str": class_data['stats']['str'],
+            "dex": class_data['stats']['dex'],
+            "con": class_data['stats']['con'],
+            "int": class_data['stats']['int'],
+            "wis": class_data['stats']['wis'],
+            "cha": class_data['stats']['cha'],
+            "xp": 0,
+            "gold": class_data['gold'],
+            "inventory": ','.join(class_data['equipment'])
+        }
+        result = await storage.create_player(user_id, player)
+        if result.get("success"):
+            player_cache.put(user_id, Player.from_row(player))
+        return result
+    
+    @staticmethod
+    async def update_player(user_id: int, updates: Dict[str, Any]) -> Dict[str, Any]:
+        """Оновлює дані гравця"""
+        result = await storage.update_player(user_id, updates)
+        if result.get("success"):
+            player_cache.update(user_id, updates)
+        else:
+            # Невідомо, що саме записалося - перечитаємо при наступному зверненні
+            player_cache.invalidate(user_id)
+        return result
+    
+    @staticmethod
+    async def update_players(updates: Dict[int, Dict[str, Any]],
+                             abilities: Optional[List[Tuple[int, str]]] = None) -> Dict[str, Any]:
+        """Записує зміни кількох гравців і використання здібностей одним пакетом"""
+        result = await storage.update_players(updates, abilities or [])
+        for user_id, fields in updates.items():
+            if result.get("success"):
+                player_cache.update(user_id, fields)
+            else:
+                player_cache.invalidate(user_id)
+        return result
+    
+    @staticmethod
+    async def settle_players(results: Dict[int, Tuple[Dict[str, Any], Dict[str, int]]]) -> Dict[str, Any]:
+        """Записує підсумки гравців: поля як є, а XP і золото - приростом до поточних значень"""
+        updates = {}
+        for user_id, (fields, deltas) in results.items():
+            updates[user_id] = dict(fields)
+            if not deltas:
+                continue
+            current = await GoogleSheetsAPI.get_player(user_id)
+            if not current.get("success"):
+                return current
+            for key, delta in deltas.items():
+                updates[user_id][key] = getattr(current["player"], key) + delta
+        return await GoogleSheetsAPI.update_players(updates)
+    
+    @staticmethod
+    def update_player_in_background(user_id: int, updates: Dict[str, Any]) -> Optional[Player]:
+        """Одразу оновлює кеш, а в сховище пише фоновою задачею, не чекаючи мережі"""
+        player_cache.update(user_id, updates)
+        
+        async def write():
+            result = await storage.update_player(user_id, updates)
+            if not result.get("success"):
+                logger.error(f"Не вдалося записати зміни гравця {user_id}: {result.get('error')}")
+                player_cache.invalidate(user_id)
+        
+        task = asyncio.create_task(write(), context=PlayerCache._background_context())
+        GoogleSheetsAPI._background_writes.add(task)
+        task.add_done_callback(GoogleSheetsAPI._background_writes.discard)
+        return player_cache.peek(user_id)
+    
+    @staticmethod
+    async def get_ability_usage(user_id: int, ability: str) -> Dict[str, Any]:
+        """Перевіряє чи використовувалася здібність"""
+        return await storage.get_ability_usage(user_id, ability)
+    
+    @staticmethod
+    async def use_ability(user_id: int, ability: str) -> Dict[str, Any]:
+        """Позначає здібність як використану"""
+        return await storage.use_ability(user_id, ability)
+
+class PlayerStorage:
+    """Інтерфейс сховища гравців, що стоїть за методами GoogleSheetsAPI"""
+    
+    async def start(self):
+        """Відкриває сховище і запускає фонові задачі"""
+    
+    async def stop(self):
+        """Дописує незбережені зміни і закриває сховище"""
+    
+    async def fetch_player(self, user_id: int) -> Dict[str, Any]:
+        raise NotImplementedError
+    
+    async def create_player(self, user_id: int, player: Dict[str, Any]) -> Dict[str, Any]:
+        raise NotImplementedError
+    
+    async def update_player(self, user_id: int, updates: Dict[str, Any]) -> Dict[str, Any]:
+        raise NotImplementedError
+    
+    async def update_players(self, updates: Dict[int, Dict[str, Any]],
+                             abilities: List[Tuple[int, str]]) -> Dict[str, Any]:
+        """Пакет змін кількох гравців; за замовчуванням - по одному запису"""
+        for user_id, fields in updates.items():
+            result = await self.update_player(user_id, fields)
+            if not result.get("success"):
+                return result
+        for user_id, ability in abilities:
+            result = await self.use_ability(user_id, ability)
+            if not result.get("success"):
+                return result
+        return {"success": True}
+    
+    async def get_ability_usage(self, user_id: int, ability: str) -> Dict[str, Any]:
+        raise NotImplementedError
+    
+    async def use_ability(self, user_id: int, ability: str) -> Dict[str, Any]:
+        raise NotImplementedError
+    
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+class SheetsStorage(PlayerStorage):
+    """Google Sheets як єдине сховище, записи через буфер відкладеного запису"""
+    
+    async def start(self):
+        write_buffer.start(GoogleSheetsAPI.make_request)
+    
+    async def stop(self):
+        await write_buffer.stop()
+    
+    async def fetch_player(self, user_id: int) -> Dict[str, Any]:
+        """Читає дані гравця з таблиці разом з ще не записаними змінами"""
+        result = await GoogleSheetsAPI.make_request({
+            "action": "get_player",
+            "user_id": str(user_id)
+        })
+        if result.get("success") and result.get("player"):
+            result["player"] = write_buffer.overlay(user_id, result["player"])
+        return result
+    
+    async def create_player(self, user_id: int, player: Dict[str, Any]) -> Dict[str, Any]:
+        return await GoogleSheetsAPI.make_request(dict(player, action="create_player"))
+    
+    async def update_player(self, user_id: int, updates: Dict[str, Any]) -> Dict[str, Any]:
+        if write_buffer.enabled:
+            # До таблиці зміни підуть пакетом
+            write_buffer.add_update(user_id, updates)
+            return {"success": True, "queued": True}
+        
+        data = {
+            "action": "update_player",
+            "user_id": str(user_id)
+        }
+        data.update(updates)
+        return await GoogleSheetsAPI.make_request(data)
+    
+    async def update_players(self, updates: Dict[int, Dict[str, Any]],
+                             abilities: List[Tuple[int, str]]) -> Dict[str, Any]:
+        if write_buffer.enabled:
+            for user_id, fields in updates.items():
+                write_buffer.add_update(user_id, fields)
+            for user_id, ability in abilities:
+                write_buffer.add_ability_use(user_id, ability)
+            return {"success": True, "queued": True}
+        return await GoogleSheetsAPI.make_request({
+            "action": "batch_update",
+            "players": [dict(fields, user_id=str(user_id)) for user_id, fields in updates.items()],
+            "abilities": [
+                {"user_id": str(user_id), "ability_name": ability, "used": True, "last_used": round(time.time())}
+                for user_id, ability in abilities
+            ]
+        })
+    
+    async def get_ability_usage(self, user_id: int, ability: str) -> Dict[str, Any]:
+        if write_buffer.ability_pending(user_id, ability):
+            return {"success": True, "used": True, "queued": True}
+        return await GoogleSheetsAPI.make_request({
+            "action": "get_ability",
+            "user_id": str(user_id),
+            "ability_name": ability
+        })
+    
+    async def use_ability(self, user_id: int, ability: str) -> Dict[str, Any]:
+        if write_buffer.enabled:
+            write_buffer.add_ability_use(user_id, ability)
+            return {"success": True, "queued": True}
+        return await GoogleSheetsAPI.make_request({
+            "action": "use_ability",
+            "user_id": str(user_id),
+            "ability_name": ability,
+            "used": True,
+            "last_used": round(time.time())
+        })
+    
+    def stats(self) -> Dict[str, Any]:
+        return write_buffer.stats()
+
+class SQLiteStorage(PlayerStorage):
+    """Локальна база SQLite (WAL) як основне сховище з дзеркалом у Google Sheets"""
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS players (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        synced_version INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS players_dirty ON players(user_id) WHERE version > synced_version;
+    CREATE TABLE IF NOT EXISTS abilities (
+        user_id INTEGER NOT NULL,
+        ability_name TEXT NOT NULL,
+        uses INTEGER NOT NULL,
+        synced_uses INTEGER NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (user_id, ability_name)
+    );
+    CREATE INDEX IF NOT EXISTS abilities_dirty ON abilities(user_id) WHERE uses != synced_uses;
+    """
+    
+    def __init__(self, path: str, interval: float, batch_size: int):
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        # У режимі webhook реплікує лише один процес, щоб не дублювати записи
+        self.replicate = True
+        self._db: Optional[sqlite3.Connection] = None
+        # Усі запити до бази йдуть по черзі в одному потоці: блокування бази іншим
+        # процесом (busy_timeout) не зупиняє цикл подій, а читання-зміна-запис гравця
+        # не перемежовуються
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Лічильники в пам'яті, щоб не рахувати рядки на кожен запис і кожен збір метрик
+        self._players = 0
+        self._dirty: set = set()
+        self.replicated_players = 0
+        self.replicated_abilities = 0
+        self.replication_errors = 0
+        self.imported = 0
+    
+    @property
+    def db(self) -> sqlite3.Connection:
+        """З'єднання з базою; використовується лише в потоці бази"""
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("PRAGMA busy_timeout=5000")
+            self._db.executescript(self.SCHEMA)
+        return self._db
+    
+    async def _call(self, func: Callable[..., Any], *args) -> Any:
+        """Виконує func у потоці бази"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+    
+    def _open(self) -> Tuple[int, List[int]]:
+        players = self.db.execute("SELECT COUNT(*) FROM players").fetchone()[0]
+        dirty = [row[0] for row in self.db.execute("SELECT user_id FROM players WHERE version > synced_version")]
+        return players, dirty
+    
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+    
+    async def start(self):
+        # Лічильники рахуються з бази один раз при старті
+        self._players, dirty = await self._call(self._open)
+        self._dirty.update(dirty)
+        if self.replicate and self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            # Останній прохід: все незаписане лишається в базі і піде після перезапуску
+            while await self.replicate_once():
+                pass
+        await self._call(self._close)
+    
+    def _load_local(self, user_id: int) -> Optional[Dict[str, Any]]:
+        row = self.db.execute("SELECT data FROM players WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def _import(self, user_id: int, player: Dict[str, Any]) -> Tuple[bool, Dict[str, Any]]:
+        cursor = self.db.execute(
+            "INSERT OR IGNORE INTO players (user_id, data, version, synced_version, updated_at) "
+            "VALUES (?, ?, 1, 1, ?)",
+            (user_id, json.dumps(player, ensure_ascii=False), time.time())
+        )
+        # Якщо паралельний запис встиг першим, віддаємо його версію
+        return cursor.rowcount > 0, self._load_local(user_id)
+    
+    def _insert(self, user_id: int, player: Dict[str, Any]) -> bool:
+        existed = self.db.execute("SELECT 1 FROM players WHERE user_id = ?", (user_id,)).fetchone() is not None
+        # synced_version = 0 означає, що рядка в таблиці ще немає
+        self.db.execute(
+            "INSERT OR REPLACE INTO players (user_id, data, version, synced_version, updated_at) "
+            "VALUES (?, ?, 1, 0, ?)",
+            (user_id, json.dumps(player, ensure_ascii=False), time.time())
+        )
+        return not existed
+    
+    def _apply_update(self, user_id: int, updates: Dict[str, Any]) -> bool:
+        """Зливає зміни з локальним гравцем; False - гравця локально немає"""
+        player = self._load_local(user_id)
+        if player is None:
+            return False
+        player.update(updates)
+        self.db.execute(
+            "UPDATE players SET data = ?, version = version + 1, updated_at = ? WHERE user_id = ?",
+            (json.dumps(player, ensure_ascii=False), time.time(), user_id)
+        )
+        return True
+    
+    def _mark_dirty(self, user_id: int):
+        self._dirty.add(user_id)
+        if len(self._dirty) >= self.batch_size:
+            self._wakeup.set()
+    
+    async def fetch_player(self, user_id: int) -> Dict[str, Any]:
+        player = await self._call(self._load_local, user_id)
+        if player is not None:
+            return {"success": True, "player": player}
+        
+        # Гравця ще немає локально - переносимо його з таблиці
+        result = await GoogleSheetsAPI.make_request({
+            "action": "get_player",
+            "user_id": str(user_id)
+        })
+        if result.get("success") and result.get("player"):
+            inserted, result["player"] = await self._call(self._import, user_id, result["player"])
+            if inserted:
+                self._players += 1
+            self.imported += 1
+        return result
+    
+    async def create_player(self, user_id: int, player: Dict[str, Any]) -> Dict[str, Any]:
+        if await self._call(self._insert, user_id, player):
+            self._players += 1
+        self._dirty.add(user_id)
+        self._wakeup.set()
+        return {"success": True}
+    
+    async def update_player(self, user_id: int, updates: Dict[str, Any]) -> Dict[str, Any]:
+        if not await self._call(self._apply_update, user_id, updates):
+            result = await self.fetch_player(user_id)
+            if not result.get("success") or not result.get("player"):
+                return {"success": False, "error": result.get("error", "Гравця не знайдено")}
+            await self._call(self._apply_update, user_id, updates)
+        self._mark_dirty(user_id)
+        return {"success": True}
+    
+    def _ability_row(self, user_id: int, ability: str) -> Optional[Tuple[int, float]]:
+        return self.db.execute(
+            "SELECT uses, last_used FROM abilities WHERE user_id = ? AND ability_name = ?", (user_id, ability)
+        ).fetchone()
+    
+    def _import_ability(self, user_id: int, ability: str, uses: int, last_used: float):
+        self.db.execute(
+            "INSERT OR IGNORE INTO abilities (user_id, ability_name, uses, synced_uses, last_used) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, ability, uses, uses, last_used)
+        )
+    
+    def _use_ability(self, user_id: int, ability: str):
+        self.db.execute(
+            "INSERT INTO abilities (user_id, ability_name, uses, synced_uses, last_used) VALUES (?, ?, 1, 0, ?) "
+            "ON CONFLICT(user_id, ability_name) DO UPDATE SET uses = uses + 1, last_used = excluded.last_used",
+            (user_id, ability, time.time())
+        )
+    
+    async def get_ability_usage(self, user_id: int, ability: str) -> Dict[str, Any]:
+        row = await self._call(self._ability_row, user_id, ability)
+        if row is not None:
+            return {"success": True, "used": row[0] > 0, "uses": row[0], "last_used": row[1]}
+        
+        result = await GoogleSheetsAPI.make_request({
+            "action": "get_ability",
+            "user_id": str(user_id),
+            "ability_name": ability
+        })
+        if result.get("success"):
+            uses = int(result.get("uses", 1 if result.get("used") else 0))
+            # Без часу з таблиці вважаємо, що здібність використали щойно
+            await self._call(self._import_ability, user_id, ability, uses,
+                             float(result.get("last_used") or time.time()))
+        return result
+    
+    async def use_ability(self, user_id: int, ability: str) -> Dict[str, Any]:
+        await self._call(self._use_ability, user_id, ability)
+        return {"success": True}
+    
+    async def _run(self):
+        request_priority.set(PRIORITY_BACKGROUND)
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Розбираємо накопичене пакетами, поки є що відправляти
+            while await self.replicate_once():
+                pass
+    
+    def _select_dirty(self) -> Tuple[List[tuple], List[tuple]]:
+        players = self.db.execute(
+            "SELECT user_id, data, version, synced_version FROM players "
+            "WHERE version > synced_version LIMIT ?", (self.batch_size,)
+        ).fetchall()
+        abilities = self.db.execute(
+            "SELECT user_id, ability_name, uses, last_used FROM abilities WHERE uses != synced_uses LIMIT ?",
+            (self.batch_size,)
+        ).fetchall()
+        return players, abilities
+    
+    async def replicate_once(self) -> bool:
+        """Відправляє в таблицю один пакет змін; True - якщо варто продовжити"""
+        players, abilities = await self._call(self._select_dirty)
+        if not players and not abilities:
+            self._dirty.clear()
+            return False
+        
+        # Нових гравців створюємо окремо, решту оновлюємо одним пакетом
+        updates = []
+        for user_id, data, version, synced_version in players:
+            if synced_version == 0:
+                result = await GoogleSheetsAPI.make_request(dict(json.loads(data), action="create_player"))
+                if not result.get("success"):
+                    self.replication_errors += 1
+                    logger.error(f"Не вдалося створити гравця {user_id} у таблиці: {result.get('error')}")
+                    return False
+                self._dirty.difference_update(await self._call(self._mark_synced, [(user_id, version)], []))
+            else:
+                updates.append((user_id, data, version))
+        
+        if updates or abilities:
+            result = await GoogleSheetsAPI.make_request({
+                "action": "batch_update",
+                "players": [dict(json.loads(data), user_id=str(user_id)) for user_id, data, _ in updates],
+                "abilities": [
+                    {"user_id": str(user_id), "ability_name": ability, "used": True, "uses": uses,
+                     "last_used": round(last_used)}
+                    for user_id, ability, uses, last_used in abilities
+                ]
+            })
+            if not result.get("success"):
+                self.replication_errors += 1
+                logger.error(f"Помилка реплікації в таблицю: {result.get('error')}")
+                return False
+            synced = await self._call(
+                self._mark_synced,
+                [(user_id, version) for user_id, _, version in updates],
+                [(user_id, ability, uses) for user_id, ability, uses, _ in abilities]
+            )
+            self._dirty.difference_update(synced)
+        
+        self.replicated_players += len(players)
+        self.replicated_abilities += len(abilities)
+        return len(players) == self.batch_size or len(abilities) == self.batch_size
+    
+    def _mark_synced(self, players: List[Tuple[int, int]], abilities: List[Tuple[int, str, int]]) -> List[int]:
+        """Позначає відправлені версії; повертає гравців без новіших змін"""
+        synced = []
+        for user_id, version in players:
+            # Новіші зміни, що прийшли під час відправки, лишаються брудними
+            self.db.execute(
+                "UPDATE players SET synced_version = ? WHERE user_id = ? AND synced_version < ?",
+                (version, user_id, version)
+            )
+            row = self.db.execute("SELECT version FROM players WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None or row[0] <= version:
+                synced.append(user_id)
+        for user_id, ability, uses in abilities:
+            self.db.execute(
+                "UPDATE abilities SET synced_uses = ? WHERE user_id = ? AND ability_name = ?",
+                (uses, user_id, ability)
+            )
+        return synced
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'players': self._players,
+            'dirty_players': len(self._dirty),
+            'imported': self.imported,
+            'replicated_players': self.replicated_players,
+            'replicated_abilities': self.replicated_abilities,
+            'replication_errors': self.replication_errors
+        }
+
+if STORAGE_BACKEND == 'sqlite':
+    storage: PlayerStorage = SQLiteStorage(SQLITE_PATH, REPLICATION_INTERVAL, REPLICATION_BATCH)
+else:
+    storage = SheetsStorage()
+
+class WarmSnapshot:
+    """Знімок кешу гравців і context.user_data на диску для теплого старту після перезапуску
+    
+    Формат: MAGIC, записи гравців (JSON), індекс {user_id: [зсув, довжина, остання активність]}
+    і 8 байт зсуву індексу. Файл відкривається через mmap, при старті читається лише індекс,
+    а запис гравця розбирається при його першому оновленні.
+    """
+    
+    MAGIC = b'RPGSNAP1'
+    
+    def __init__(self, path: str, interval: float, prefetch: int, ttl: float):
+        self.path = path
+        self.interval = interval
+        self.prefetch = prefetch
+        self.ttl = ttl
+        self._mmap: Optional[mmap.mmap] = None
+        # user_id -> (зсув, довжина, остання активність) ще не відновлених записів
+        self._index: Dict[int, Tuple[int, int, float]] = {}
+        # Сесії гравців, піднятих заздалегідь, до їх першого оновлення
+        self._sessions: Dict[int, Dict[str, Any]] = {}
+        # user_id -> час останнього оновлення (time.time())
+        self._active: Dict[int, float] = {}
+        self._application: Optional[Application] = None
+        self._task: Optional[asyncio.Task] = None
+        self.restored_players = 0
+        self.restored_sessions = 0
+        self.writes = 0
+        self.last_size = 0
+        # Вимикається, коли сесії зберігає SessionPersistence - у знімку лишаються лише гравці
+        self.include_sessions = True
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+    
+    async def start(self, application: Application):
+        """Читає індекс знімка, піднімає нещодавно активних гравців і запускає періодичний запис"""
+        if not self.enabled:
+            return
+        self._application = application
+        self._load()
+        recent = sorted(self._index, key=lambda user_id: self._index[user_id][2], reverse=True)
+        for user_id in recent[:self.prefetch]:
+            session = self._take(user_id)
+            if session:
+                self._sessions[user_id] = session
+        if self._index or self._sessions:
+            logger.info(
+                f"Знімок {self.path}: {len(self._index) + len(self._sessions)} гравців, "
+                f"{self.restored_players} одразу в кеші"
+            )
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Зупиняє періодичний запис і зберігає остаточний знімок"""
+        if not self.enabled:
+            return
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.save()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"Не вдалося записати знімок: {e}")
+    
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._mmap[:len(self.MAGIC)] != self.MAGIC:
+                raise ValueError("невідомий формат")
+            index_offset = int.from_bytes(self._mmap[-8:], 'little')
+            index = json.loads(self._mmap[index_offset:-8])
+            expires = time.time() - self.ttl
+            self._index = {
+                int(user_id): (offset, length, active)
+                for user_id, (offset, length, active) in index.items() if active >= expires
+            }
+        except (OSError, ValueError) as e:
+            logger.error(f"Не вдалося прочитати знімок {self.path}: {e}")
+            self._index = {}
+    
+    def _take(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Розбирає запис гравця: дані - в кеш, сесію повертає"""
+        offset, length, active = self._index.pop(user_id)
+        self._active.setdefault(user_id, active)
+        try:
+            record = json.loads(self._mmap[offset:offset + length], object_hook=self._decode)
+        except ValueError as e:
+            logger.error(f"Пошкоджений запис знімка для гравця {user_id}: {e}")
+            return None
+        if record.get('player') is not None:
+            player = Player.from_row(record['player'])
+            if player_cache.restore(user_id, player, max(0.0, time.time() - record['fetched'])):
+                self.restored_players += 1
+        return record.get('session')
+    
+    async def hydrate(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Перед обробниками: відновлює сесію гравця зі знімка при першому оновленні"""
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            return
+        self._active[user.id] = time.time()
+        if user.id in self._sessions:
+            session = self._sessions.pop(user.id)
+        elif user.id in self._index:
+            session = self._take(user.id)
+        else:
+            return
+        if session:
+            for key, value in session.items():
+                context.user_data.setdefault(key, value)
+            self.restored_sessions += 1
+    
+    @staticmethod
+    def _encode(value: Any) -> Any:
+        if isinstance(value, Player):
+            return {'__player__': value.to_row()}
+        raise TypeError(f"{type(value).__name__} не зберігається у знімку")
+    
+    @staticmethod
+    def _decode(obj: Dict[str, Any]) -> Any:
+        if '__player__' in obj and len(obj) == 1:
+            return Player.from_row(obj['__player__'])
+        return obj
+    
+    def _session(self, user_id: int) -> Dict[str, Any]:
+        """Дані сесії, які можна записати в JSON"""
+        if not self.include_sessions:
+            return {}
+        if user_id in self._sessions:
+            return self._sessions[user_id]
+        user_data = self._application.user_data.get(user_id) if self._application else None
+        session = {}
+        for key, value in (user_data or {}).items():
+            try:
+                json.dumps(value, default=self._encode)
+            except (TypeError, ValueError):
+                continue
+            session[key] = value
+        return session
+    
+    def _serialize(self) -> bytes:
+        """Збирає знімок у пам'яті: кеш, сесії і ще не відновлені записи попереднього знімка"""
+        now = time.time()
+        cached = {user_id: (player, age) for user_id, player, age in player_cache.snapshot()}
+        user_ids = set(cached) | set(self._sessions)
+        if self._application is not None and self.include_sessions:
+            user_ids.update(user_id for user_id, data in self._application.user_data.items() if data)
+        
+        chunks = [self.MAGIC]
+        offset = len(self.MAGIC)
+        index = {}
+        for user_id in user_ids:
+            player, age = cached.get(user_id, (None, 0.0))
+            record = json.dumps({
+                'player': player.to_row() if player is not None else None,
+                'fetched': now - age,
+                'session': self._session(user_id)
+            }, ensure_ascii=False, separators=(',', ':'), default=self._encode).encode()
+            index[str(user_id)] = [offset, len(record), self._active.get(user_id, now - age)]
+            chunks.append(record)
+            offset += len(record)
+        
+        # Записи, які ще не знадобились, переносимо без розбору
+        for user_id, (old_offset, length, active) in self._index.items():
+            if user_id in user_ids or active < now - self.ttl:
+                continue
+            index[str(user_id)] = [offset, length, active]
+            chunks.append(self._mmap[old_offset:old_offset + length])
+            offset += length
+        
+        chunks.append(json.dumps(index, separators=(',', ':')).encode())
+        chunks.append(offset.to_bytes(8, 'little'))
+        return b''.join(chunks)
+    
+    def _write(self, data: bytes):
+        # Старий файл лишається відображеним у пам'ять, тому замінюємо атомарно
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+    
+    async def save(self):
+        """Записує знімок; серіалізація в циклі подій, запис на диск - в окремому потоці"""
+        data = self._serialize()
+        await asyncio.to_thread(self._write, data)
+        self.writes += 1
+        self.last_size = len(data)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pending': len(self._index) + len(self._sessions),
+            'restored_players': self.restored_players,
+            'restored_sessions': self.restored_sessions,
+            'writes': self.writes,
+            'last_size': self.last_size
+        }
+
+warm_snapshot = WarmSnapshot(SNAPSHOT_PATH, SNAPSHOT_INTERVAL, SNAPSHOT_PREFETCH, SNAPSHOT_TTL)
+
+class SessionPersistence(BasePersistence):
+    """Збереження context.user_data і bot_data в SQLite: окремий невеликий запис на гравця
+    
+    PTB раз на update_interval віддає лише сесії, яких торкались від попереднього проходу.
+    Записи, що не змінились, відкидаються за хешем, решта пишеться однією транзакцією,
+    тож вартість запису залежить від кількості активних гравців, а не всіх збережених.
+    """
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS user_data_updated ON user_data(updated_at);
+    CREATE TABLE IF NOT EXISTS bot_data (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        data TEXT NOT NULL
+    );
+    """
+    
+    def __init__(self, path: str, update_interval: float, ttl: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self.ttl = ttl
+        self._db: Optional[sqlite3.Connection] = None
+        # Усі звернення до бази - в окремому потоці, щоб не блокувати цикл подій
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sessions')
+        # user_id -> JSON запису (None - видалити), ще не записані
+        self._dirty: Dict[int, Optional[str]] = {}
+        self._dirty_bot_data: Optional[str] = None
+        # Хеші записаних даних, щоб не переписувати незмінні сесії
+        self._written: Dict[int, int] = {}
+        self._bot_data_hash = 0
+        self._flush_task: Optional[asyncio.Task] = None
+        self.loaded = 0
+        self.flushes = 0
+        self.written_records = 0
+        self.unchanged = 0
+        self.last_batch = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+    
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(self.SCHEMA)
+        return self._db
+    
+    @staticmethod
+    def _encode(data: Dict[str, Any]) -> str:
+        """JSON сесії; значення, які не записуються в JSON, пропускаються"""
+        record = {}
+        for key, value in data.items():
+            try:
+                json.dumps(value, default=WarmSnapshot._encode)
+            except (TypeError, ValueError):
+                continue
+            record[key] = value
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=WarmSnapshot._encode)
+    
+    async def _call(self, func: Callable[..., Any], *args) -> Any:
+        """Виконує func у потоці бази"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+    
+    def _load_user_data(self) -> Tuple[Dict[int, Dict[str, Any]], Dict[int, int]]:
+        expires = time.time() - self.ttl
+        self.db.execute("DELETE FROM user_data WHERE updated_at < ?", (expires,))
+        user_data, written = {}, {}
+        for user_id, data in self.db.execute("SELECT user_id, data FROM user_data"):
+            try:
+                user_data[user_id] = json.loads(data, object_hook=WarmSnapshot._decode)
+            except ValueError as e:
+                logger.error(f"Пошкоджена сесія гравця {user_id}: {e}")
+                continue
+            written[user_id] = hash(data)
+        return user_data, written
+    
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        user_data, written = await self._call(self._load_user_data)
+        self._written.update(written)
+        self.loaded = len(user_data)
+        return user_data
+    
+    def _load_bot_data(self) -> Optional[str]:
+        row = self.db.execute("SELECT data FROM bot_data WHERE id = 0").fetchone()
+        return row[0] if row else None
+    
+    async def get_bot_data(self) -> Dict[str, Any]:
+        data = await self._call(self._load_bot_data)
+        if data is None:
+            return {}
+        self._bot_data_hash = hash(data)
+        return json.loads(data, object_hook=WarmSnapshot._decode)
+    
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+    
+    async def get_callback_data(self) -> None:
+        return None
+    
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+    
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        record = self._encode(data)
+        if self._written.get(user_id) == hash(record):
+            self.unchanged += 1
+            return
+        self._dirty[user_id] = record
+        self._schedule_flush()
+    
+    async def update_bot_data(self, data: Dict[str, Any]) -> None:
+        record = self._encode(data)
+        if hash(record) == self._bot_data_hash:
+            return
+        self._dirty_bot_data = record
+        self._schedule_flush()
+    
+    async def drop_user_data(self, user_id: int) -> None:
+        self._dirty[user_id] = None
+        self._schedule_flush()
+    
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+    
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+    
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+    
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        pass
+    
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        # Сесії змінює лише цей процес, перечитувати нічого
+        pass
+    
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+    
+    async def refresh_bot_data(self, bot_data: Dict[str, Any]) -> None:
+        pass
+    
+    def _schedule_flush(self):
+        """Один запис на прохід PTB: усі update_user_data цього проходу встигають стати в чергу"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._write_dirty())
+    
+    def _write(self, dirty: Dict[int, Optional[str]], bot_data: Optional[str]):
+        now = time.time()
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+                [(user_id, record, now) for user_id, record in dirty.items() if record is not None]
+            )
+            self.db.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, record in dirty.items() if record is None]
+            )
+            if bot_data is not None:
+                self.db.execute("INSERT OR REPLACE INTO bot_data (id, data) VALUES (0, ?)", (bot_data,))
+    
+    async def _write_dirty(self):
+        """Пише накопичені зміни однією транзакцією; що надійшло під час запису - наступною"""
+        while self._dirty or self._dirty_bot_data is not None:
+            dirty, self._dirty = self._dirty, {}
+            bot_data, self._dirty_bot_data = self._dirty_bot_data, None
+            try:
+                await self._call(self._write, dirty, bot_data)
+            except sqlite3.Error as e:
+                logger.error(f"Не вдалося записати сесії: {e}")
+                # Повертаємо зміни, якщо новіших ще не надійшло
+                for user_id, record in dirty.items():
+                    self._dirty.setdefault(user_id, record)
+                if bot_data is not None and self._dirty_bot_data is None:
+                    self._dirty_bot_data = bot_data
+                return
+            for user_id, record in dirty.items():
+                if record is None:
+                    self._written.pop(user_id, None)
+                else:
+                    self._written[user_id] = hash(record)
+            if bot_data is not None:
+                self._bot_data_hash = hash(bot_data)
+            self.flushes += 1
+            self.written_records += len(dirty)
+            self.last_batch = len(dirty)
+    
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+    
+    async def flush(self) -> None:
+        """Викликається при зупинці після останнього проходу PTB"""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_dirty()
+        await self._call(self._close)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'users': len(self._written),
+            'loaded': self.loaded,
+            'dirty': len(self._dirty),
+            'flushes': self.flushes,
+            'written_records': self.written_records,
+            'unchanged': self.unchanged,
+            'last_batch': self.last_batch
+        }
+
+session_persistence = SessionPersistence(SESSION_DB_PATH, SESSION_FLUSH_INTERVAL, SESSION_TTL)
+
+# Позиція здібності в лічильниках AbilityTracker
+ABILITY_SLOTS = {ability: index for index, ability in enumerate(ABILITIES)}
+
+class AbilityTracker:
+    """Лічильники використання здібностей у пам'яті: перевірка - O(1) без мережі
+    
+    На гравця - два bytearray за ABILITY_SLOTS: денні лічильники (скидаються всі разом
+    раз на добу) і лічильники поточного бою (скидаються в кінці бою). Зі сховища денні
+    використання читаються один раз, нові пишуться у фоні пакетом.
+    """
+    
+    def __init__(self, sync_interval: float, reset_hour: int):
+        self.sync_interval = sync_interval
+        self.reset_hour = reset_hour
+        self._day = self.day_number()
+        self._daily: Dict[int, bytearray] = {}
+        self._battle: Dict[int, bytearray] = {}
+        # Гравці, чиї денні використання вже прочитані зі сховища
+        self._loaded: set = set()
+        self._pending: List[Tuple[int, str]] = []
+        self._task: Optional[asyncio.Task] = None
+        self.loads = 0
+        self.uses = 0
+        self.syncs = 0
+        self.sync_errors = 0
+        self.daily_resets = 0
+    
+    def day_number(self, timestamp: Optional[float] = None) -> int:
+        """Номер ігрової доби: межа - reset_hour за UTC"""
+        if timestamp is None:
+            timestamp = time.time()
+        return int((timestamp - self.reset_hour * 3600) // 86400)
+    
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.sync()
+    
+    async def _run(self):
+        request_priority.set(PRIORITY_BACKGROUND)
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            self._check_day()
+            await self.sync()
+    
+    def _check_day(self):
+        """Скидає денні лічильники всіх гравців разом, коли починається нова доба"""
+        day = self.day_number()
+        if day != self._day:
+            self._day = day
+            self._daily.clear()
+            self.daily_resets += 1
+    
+    def _used_today(self, result: Dict[str, Any]) -> bool:
+        """Чи припадає використання зі сховища на поточну добу"""
+        if not result.get("success") or not result.get("used"):
+            return False
+        last_used = result.get("last_used")
+        try:
+            return self.day_number(float(last_used)) == self._day
+        except (TypeError, ValueError):
+            # Сховище не знає часу використання - вважаємо, що сьогодні
+            return True
+    
+    async def ensure(self, player: Player):
+        """Один раз читає зі сховища денні використання здібностей класу гравця"""
+        self._check_day()
+        if player.user_id in self._loaded:
+            return
+        for ability in CLASSES.get(player.player_class, {}).get('abilities', []):
+            if not ABILITIES[ability].get('uses_per_day'):
+                continue
+            result = await GoogleSheetsAPI.get_ability_usage(player.user_id, ability)
+            if self._used_today(result):
+                counters = self._daily.setdefault(player.user_id, bytearray(len(ABILITY_SLOTS)))
+                counters[ABILITY_SLOTS[ability]] = max(counters[ABILITY_SLOTS[ability]], 1)
+        self._loaded.add(player.user_id)
+        self.loads += 1
+    
+    def remaining(self, user_id: int, ability: str) -> Optional[int]:
+        """Скільки разів ще можна використати здібність (None - без обмежень)"""
+        ability_data = ABILITIES[ability]
+        slot = ABILITY_SLOTS[ability]
+        if 'uses_per_day' in ability_data:
+            counters = self._daily.get(user_id)
+            return max(0, ability_data['uses_per_day'] - (counters[slot] if counters else 0))
+        if 'uses_per_battle' in ability_data:
+            counters = self._battle.get(user_id)
+            return max(0, ability_data['uses_per_battle'] - (counters[slot] if counters else 0))
+        return None
+    
+    def available(self, user_id: int, ability: str) -> bool:
+        remaining = self.remaining(user_id, ability)
+        return remaining is None or remaining > 0
+    
+    def use(self, user_id: int, ability: str):
+        """Рахує використання; денні ліміти підуть у сховище з наступною синхронізацією"""
+        slot = ABILITY_SLOTS[ability]
+        if 'uses_per_day' in ABILITIES[ability]:
+            counters = self._daily.setdefault(user_id, bytearray(len(ABILITY_SLOTS)))
+            self._pending.append((user_id, ability))
+        else:
+            counters = self._battle.setdefault(user_id, bytearray(len(ABILITY_SLOTS)))
+        counters[slot] = min(255, counters[slot] + 1)
+        self.uses += 1
+    
+    def reset_battle(self, user_ids: List[int]):
+        """Кінець бою: ліміти на бій знову доступні"""
+        for user_id in user_ids:
+            self._battle.pop(user_id, None)
+    
+    async def sync(self):
+        """Пише накопичені денні використання одним пакетом"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        result = await storage.update_players({}, pending)
+        if result.get("success"):
+            self.syncs += 1
+        else:
+            self.sync_errors += 1
+            logger.error(f"Не вдалося записати використання здібностей: {result.get('error')}")
+            self._pending = pending + self._pending
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'players': len(self._daily) + len(self._battle),
+            'loaded': len(self._loaded),
+            'loads': self.loads,
+            'uses': self.uses,
+            'pending': len(self._pending),
+            'syncs': self.syncs,
+            'sync_errors': self.sync_errors,
+            'daily_resets': self.daily_resets
+        }
+
+ability_tracker = AbilityTracker(ABILITY_SYNC_INTERVAL, ABILITY_RESET_HOUR)
+
+# Доданок виразу кубиків: знак, кількість кубиків, грані, скільки залишити
+# (0 - всі, >0 - найбільші, <0 - найменші), стала або характеристика
+@dataclass(frozen=True, slots=True)
+class DiceTerm:
+    sign: int
+    count: int = 0
+    sides: int = 0
+    keep: int = 0
+    constant: int = 0
+    stat: Optional[str] = None
+
+class DiceRoller:
+    """Клас для кидання кубиків"""
+    
+    # Токени виразу: кубики з keep-highest/lowest, число, характеристика, знак
+    TOKEN_RE = re.compile(
+        r'\s*(?:(?P<dice>(?P<count>\d*)d(?P<sides>\d+)(?:k(?P<keep_mode>[hl])(?P<keep>\d+))?)'
+        r'|(?P<number>\d+)|(?P<stat>str|dex|con|int|wis|cha)|(?P<sign>[+-]))',
+        re.IGNORECASE
+    )
+    
+    # Генератор для пакетних кидків
+    rng = np.random.default_rng()
+    
+    # Межі виразу з відповіді GPT чи кнопки, щоб кидок не виділяв величезні масиви
+    MAX_COUNT = 100
+    MAX_SIDES = 1000
+    # Урон без зброї - ним замінюється некоректний кубик урону
+    DEFAULT_DAMAGE = 'd4'
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def compile(dice_str: str) -> Tuple[DiceTerm, ...]:
+        """Розбирає вираз типу '2d6+1d4+3', 'd4+INT', '2d20kh1' у доданки (з кешем)"""
+        terms = []
+        sign = 1
+        expect_term = True
+        pos = 0
+        text = dice_str.strip()
+        while pos < len(text):
+            match = DiceRoller.TOKEN_RE.match(text, pos)
+            if match is None or match.end() == pos:
+                raise ValueError(f"Некоректний вираз кубика: {dice_str}")
+            pos = match.end()
+            
+            if match.group('sign'):
+                if not expect_term:
+                    expect_term = True
+                    sign = 1
+                if match.group('sign') == '-':
+                    sign = -sign
+                continue
+            if not expect_term:
+                raise ValueError(f"Пропущено знак у виразі кубика: {dice_str}")
+            
+            if match.group('dice'):
+                count = int(match.group('count') or 1)
+                sides = int(match.group('sides'))
+                keep = int(match.group('keep') or 0)
+                if count < 1 or sides < 1 or keep > count:
+                    raise ValueError(f"Некоректний вираз кубика: {dice_str}")
+                if count > DiceRoller.MAX_COUNT or sides > DiceRoller.MAX_SIDES:
+                    raise ValueError(f"Забагато кубиків або граней: {dice_str}")
+                if match.group('keep_mode') and match.group('keep_mode').lower() == 'l':
+                    keep = -keep
+                terms.append(DiceTerm(sign, count=count, sides=sides, keep=keep))
+            elif match.group('number'):
+                terms.append(DiceTerm(sign, constant=int(match.group('number'))))
+            else:
+                terms.append(DiceTerm(sign, stat=match.group('stat').lower()))
+            expect_term = False
+            sign = 1
+        
+        if expect_term:
+            raise ValueError(f"Некоректний вираз кубика: {dice_str}")
+        return tuple(terms)
+    
+    @staticmethod
+    def _stat_bonus(term: DiceTerm, player: Optional[Player]) -> int:
+        """Характеристика у виразі означає її модифікатор"""
+        return player.modifier(term.stat) if player is not None else 0
+    
+    @staticmethod
+    def is_valid(dice_str: str) -> bool:
+        """Чи можна кинути вираз (синтаксис і межі кількості та граней)"""
+        try:
+            DiceRoller.compile(dice_str)
+        except ValueError:
+            return False
+        return True
+    
+    @staticmethod
+    def roll(dice_str: str, player: Optional[Player] = None) -> int:
+        """Кидає кубик по строці типу 'd20', '2d6+1d4+3', 'd8+STR', '2d20kh1'"""
+        try:
+            total = 0
+            for term in DiceRoller.compile(dice_str):
+                if term.count:
+                    rolls = [random.randint(1, term.sides) for _ in range(term.count)]
+                    if term.keep:
+                        rolls.sort(reverse=term.keep > 0)
+                        rolls = rolls[:abs(term.keep)]
+                    value = sum(rolls)
+                elif term.stat:
+                    value = DiceRoller._stat_bonus(term, player)
+                else:
+                    value = term.constant
+                total += term.sign * value
+            return total
+            
+        except Exception as e:
+            logger.error(f"Помилка при кидку кубика {dice_str}: {e}")
+            return 1
+    
+    @staticmethod
+    def roll_many(dice_str: str, times: int, player: Optional[Player] = None) -> np.ndarray:
+        """Кидає той самий вираз times разів одним векторним викликом"""
+        try:
+            totals = np.zeros(times, dtype=np.int64)
+            for term in DiceRoller.compile(dice_str):
+                if term.count:
+                    rolls = DiceRoller.rng.integers(1, term.sides + 1, size=(times, term.count))
+                    if term.keep:
+                        rolls = np.sort(rolls, axis=1)
+                        rolls = rolls[:, -term.keep:] if term.keep > 0 else rolls[:, :-term.keep]
+                    totals += term.sign * rolls.sum(axis=1)
+                elif term.stat:
+                    totals += term.sign * DiceRoller._stat_bonus(term, player)
+                else:
+                    totals += term.sign * term.constant
+            return totals
+            
+        except Exception as e:
+            logger.error(f"Помилка при кидку кубика {dice_str}: {e}")
+            return np.ones(times, dtype=np.int64)
+    
+    @staticmethod
+    def with_advantage(dice_str: str) -> str:
+        """Перевірка з перевагою: два d20, залишаємо більший"""
+        return re.sub(r'(?<![\dk])1?d20(?!\d)', '2d20kh1', dice_str, flags=re.IGNORECASE)
+
+    @staticmethod
+    def get_modifier(stat_value: int) -> int:
+        """Обчислює модифікатор характеристики"""
+        return (stat_value - 10) // 2
+
+class StreamingJSONParser:
+    """Інкрементальний розбір JSON відповіді GPT по мірі надходження токенів"""
+    
+    def __init__(self):
+        self.buffer = ""
+        self._main_start: Optional[int] = None
+        self._dice_required: Optional[Dict[str, Any]] = None
+    
+    def feed(self, chunk: str):
+        self.buffer += chunk
+    
+    @staticmethod
+    def _find_value_start(buffer: str, key: str) -> Optional[int]:
+        """Позиція першого символу значення ключа або None"""
+        key_pos = buffer.find(f'"{key}"')
+        if key_pos == -1:
+            return None
+        colon = buffer.find(':', key_pos + len(key) + 2)
+        if colon == -1:
+            return None
+        pos = colon + 1
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+            pos += 1
+        return pos if pos < len(buffer) else None
+    
+    @property
+    def main_response(self) -> str:
+        """Вже отримана частина main_response (може бути неповною)"""
+        if self._main_start is None:
+            start = self._find_value_start(self.buffer, "main_response")
+            if start is None or self.buffer[start] != '"':
+                return ""
+            self._main_start = start + 1
+        
+        text = self.buffer[self._main_start:]
+        # Обрізаємо по закриваючій лапці або по незавершеній escape-послідовності
+        pos = 0
+        while pos < len(text):
+            if text[pos] == '\\':
+                if pos + 1 >= len(text) or (text[pos + 1] == 'u' and pos + 6 > len(text)):
+                    break
+                pos += 6 if text[pos + 1] == 'u' else 2
+                continue
+            if text[pos] == '"':
+                break
+            pos += 1
+        try:
+            return json.loads(f'"{text[:pos]}"')
+        except ValueError:
+            return ""
+    
+    @property
+    def dice_required(self) -> Optional[Dict[str, Any]]:
+        """Об'єкт dice_required, щойно він отриманий повністю"""
+        if self._dice_required is not None:
+            return self._dice_required
+        start = self._find_value_start(self.buffer, "dice_required")
+        if start is None or self.buffer[start] != '{':
+            return None
+        
+        depth = 0
+        in_string = False
+        escaped = False
+        for pos in range(start, len(self.buffer)):
+            char = self.buffer[pos]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0:
+                    try:
+                        self._dice_required = json.loads(self.buffer[start:pos + 1])
+                    except ValueError:
+                        return None
+                    return self._dice_required
+        return None
+
+class GPTResponseCache:
+    """Кеш відповідей GPT за нормалізованою дією та грубим відбитком гравця"""
+    
+    # Оцінка ModelRouter, до якої дія рутинна (одне дієслово в короткій фразі):
+    # відповідь на неї майже не залежить від історії розмови
+    ROUTINE_SCORE = 2.0
+    
+    def __init__(self, max_size: int, ttl: float, variants: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.variants = variants
+        # ключ -> [список варіантів відповіді, час створення]
+        self._entries: 'OrderedDict[tuple, list]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return self.variants > 0 and self.max_size > 0
+    
+    @staticmethod
+    def normalize_action(text: str) -> str:
+        """Нижній регістр, без розділових знаків і зайвих пробілів"""
+        return ' '.join(re.findall(r'\w+', text.lower()))
+    
+    @staticmethod
+    def player_fingerprint(player: Player) -> tuple:
+        """Грубий відбиток стану гравця: клас, діапазон рівня, діапазон HP, предмети"""
+        level_band = (player.level - 1) // 3
+        hp_ratio = player.hp_current / max(player.hp_max, 1)
+        if hp_ratio <= 0.25:
+            hp_band = 'critical'
+        elif hp_ratio <= 0.6:
+            hp_band = 'hurt'
+        else:
+            hp_band = 'healthy'
+        # Лише відомі предмети без кількості - стріли 30 чи 29 на відповідь не впливають
+        items = frozenset(item_id for item_id in player.inventory if item_id in ITEMS)
+        return (player.player_class, level_band, hp_band, items)
+    
+    def make_key(self, prompt: str, player: Player, context: str = "") -> Optional[tuple]:
+        """Ключ кешу; None - відповідь залежить від історії розмови і не кешується"""
+        if not self.enabled:
+            return None
+        # Історія розмови є майже завжди, тож без неї в ключі обходяться лише рутинні дії
+        if context and model_router.score(prompt) >= self.ROUTINE_SCORE:
+            return None
+        return (self.normalize_action(prompt), player.memo('fingerprint', self.player_fingerprint))
+    
+    def get(self, key: tuple) -> Optional[Dict[str, Any]]:
+        """Повертає один з варіантів, якщо їх вже зібрано достатньо"""
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] > self.ttl:
+            del self._entries[key]
+            self.evictions += 1
+            entry = None
+        if entry is None or len(entry[0]) < self.variants:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(random.choice(entry[0]))
+    
+    def put(self, key: tuple, response: Dict[str, Any]):
+        """Додає варіант відповіді, поки їх менше ніж потрібно"""
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [[], time.monotonic()]
+        if len(entry[0]) < self.variants:
+            entry[0].append(copy.deepcopy(response))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+gpt_cache = GPTResponseCache(GPT_CACHE_SIZE, GPT_CACHE_TTL, GPT_CACHE_VARIANTS)
+
+class ModelRouter:
+    """Вибір моделі, бюджету токенів і тайм-ауту для ходу Майстра гри
+    
+    Складність дії оцінюється без мережі: довжина, кількість дієслів і частин дії,
+    плюс типи останніх дій гравця за відповідями Майстра. Тайм-аут кожної моделі
+    рахується від p95 її останніх відповідей.
+    """
+    
+    # Бюджет відповіді; опис складного плану довший
+    LIGHT_TOKENS = 300
+    HEAVY_TOKENS = 450
+    # Оцінка, з якої дія вважається складною
+    HEAVY_SCORE = 4.0
+    # Тайм-аут, поки для моделі замало вимірів
+    DEFAULT_TIMEOUT = 10.0
+    # Кожен котрий складний хід усе одно йде до повільної сильної моделі як пробний
+    PROBE_EVERY = 10
+    # Скільки останніх відповідей моделі враховувати та скільки треба для перцентилів
+    LATENCY_WINDOW = 50
+    MIN_SAMPLES = 10
+    # Скільки останніх дій гравця пам'ятати і для скількох гравців
+    HISTORY_TURNS = 5
+    MAX_USERS = 10000
+    # Вага action_type з відповіді Майстра в оцінці наступних дій
+    ACTION_WEIGHTS = {'simple': 0.0, 'complex': 1.0, 'impossible': 1.0, 'multi_turn': 2.0}
+    # Дієслова першої особи ("відкриваю", "скрадаюсь", "атакую") і дієприслівники
+    VERB_RE = re.compile(r'\b\w{2,}(?:аю|яю|ую|юю|ію|їю|иму|іму|юсь|усь|ючи|учи)\b')
+    
+    def __init__(self, light_model: str, heavy_model: str, timeout_min: float,
+                 timeout_max: float, timeout_factor: float):
+        self.light_model = light_model
+        self.heavy_model = heavy_model or light_model
+        self.timeout_min = timeout_min
+        self.timeout_max = timeout_max
+        self.timeout_factor = timeout_factor
+        self._latencies: Dict[str, deque] = {}
+        # user_id -> останні action_type
+        self._history: OrderedDict = OrderedDict()
+        # Основи дієслів FastPathResolver; клас оголошено нижче, тож збираються при першій оцінці
+        self._verb_stems: Optional[Tuple[str, ...]] = None
+        self.routed = {'light': 0, 'heavy': 0}
+        self.downgrades = 0
+        # Складні ходи поспіль, поки сильна модель надто повільна
+        self._slow_turns = 0
+    
+    def score(self, prompt: str, user_id: Optional[int] = None) -> float:
+        """Груба оцінка складності дії"""
+        if self._verb_stems is None:
+            self._verb_stems = tuple(stem for stems in FastPathResolver.VERBS.values() for stem in stems)
+        words = FastPathResolver.normalize(prompt).split()
+        verbs = sum(1 for word in words if self.VERB_RE.fullmatch(word) or word.startswith(self._verb_stems))
+        clauses = len(FastPathResolver.CLAUSE_RE.findall(prompt.lower()))
+        history = self._history.get(user_id)
+        recent = sum(self.ACTION_WEIGHTS.get(action, 0.0) for action in history) / len(history) if history else 0.0
+        return verbs + clauses + len(words) / 15 + recent
+    
+    def route(self, prompt: str, user_id: Optional[int] = None) -> Tuple[str, int, float]:
+        """(модель, max_tokens, тайм-аут) для дії"""
+        tier = 'heavy' if self.score(prompt, user_id) >= self.HEAVY_SCORE else 'light'
+        model, max_tokens = self.light_model, self.LIGHT_TOKENS
+        if tier == 'heavy':
+            # Сильна модель, яка зазвичай не вкладається в максимальний тайм-аут, лише
+            # погіршить хід; кожен PROBE_EVERY-й такий хід все одно йде до неї, щоб виміри оновлювались
+            slow = self.heavy_too_slow()
+            self._slow_turns = self._slow_turns + 1 if slow else 0
+            if slow and self._slow_turns % self.PROBE_EVERY:
+                self.downgrades += 1
+            else:
+                model = self.heavy_model
+            max_tokens = self.HEAVY_TOKENS
+        self.routed[tier] += 1
+        metrics.inc('rpg_gpt_routes_total', model=model)
+        return model, max_tokens, self._timeout(model)
+    
+    def heavy_too_slow(self) -> bool:
+        """Чи медіана відповіді сильної моделі вже впирається в максимальний тайм-аут"""
+        if self.heavy_model == self.light_model:
+            return False
+        p50 = self.latency_percentile(self.heavy_model, 50)
+        return p50 is not None and p50 * self.timeout_factor >= self.timeout_max
+    
+    def _timeout(self, model: str) -> float:
+        p95 = self.latency_percentile(model, 95)
+        if p95 is None:
+            return self.DEFAULT_TIMEOUT
+        return min(self.timeout_max, max(self.timeout_min, p95 * self.timeout_factor))
+    
+    def observe(self, model: str, elapsed: float):
+        """Час відповіді моделі (для тайм-ауту - сам тайм-аут)"""
+        latencies = self._latencies.get(model)
+        if latencies is None:
+            latencies = self._latencies[model] = deque(maxlen=self.LATENCY_WINDOW)
+        latencies.append(elapsed)
+    
+    def latency_percentile(self, model: str, q: float) -> Optional[float]:
+        """Перцентиль часу відповіді моделі (None - замало даних)"""
+        latencies = self._latencies.get(model)
+        if latencies is None or len(latencies) < self.MIN_SAMPLES:
+            return None
+        return float(np.percentile(latencies, q))
+    
+    def record_action(self, user_id: int, action_type: Optional[str]):
+        """Тип дії, який визначив Майстер гри"""
+        history = self._history.get(user_id)
+        if history is None:
+            history = self._history[user_id] = deque(maxlen=self.HISTORY_TURNS)
+        else:
+            self._history.move_to_end(user_id)
+        history.append(action_type or 'simple')
+        while len(self._history) > self.MAX_USERS:
+            self._history.popitem(last=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            'light': self.routed['light'],
+            'heavy': self.routed['heavy'],
+            'downgrades': self.downgrades,
+            'users': len(self._history),
+        }
+        for tier, model in (('light', self.light_model), ('heavy', self.heavy_model)):
+            for q in (50, 95):
+                value = self.latency_percentile(model, q)
+                stats[f'{tier}_p{q}'] = round(value, 3) if value is not None else 0.0
+            stats[f'{tier}_timeout'] = round(self._timeout(model), 2)
+        return stats
+
+model_router = ModelRouter(OPENAI_MODEL, OPENAI_HEAVY_MODEL, GPT_TIMEOUT_MIN, GPT_TIMEOUT_MAX, GPT_TIMEOUT_FACTOR)
+
+class RPGGameLogic:
+    """Клас для ігрової логіки"""
+    
+    # Відповідь, якщо GPT недоступний або повернув некоректний JSON
+    FALLBACK_RESPONSE = {
+        "main_response": "Щось пішло не так з магією... Спробуй ще раз!",
+        "action_type": "simple",
+        "dice_required": {"type": "none"},
+        "hint": "Перевір чи все правильно написано.",
+        "consequences": {"success": "", "failure": ""},
+        "xp_reward": 0,
+        "gold_reward": 0
+    }
+    
+    @staticmethod
+    def fallback_response() -> Dict[str, Any]:
+        return json.loads(json.dumps(RPGGameLogic.FALLBACK_RESPONSE))
+    
+    # Статична частина системного промпту: побайтово однакова в кожному запиті,
+    # тому йде першою і може кешуватися на стороні провайдера
+    SYSTEM_PROMPT = """Ти - Майстер гри (Game Master) у RPG грі в стилі D&D.
+
+ТВОЯ РОЛЬ:
+1. Аналізуй дії гравців та визначай їх можливість
+2. Оцінюй кількість ходів (1 хід, 2 ходи, неможливо)
+3. Визначай складність (d20 + модифікатор проти цілі)
+4. Генеруй цікавий світ та ситуації
+5. Будь справедливим але викликаючим
+
+ПРАВИЛА КИДКІВ:
+- Проста дія: автоматичний успіх
+- Середня дія: d20 + модифікатор ≥ 12-15
+- Складна дія: d20 + модифікатор ≥ 16-18
+- Майже неможлива: d20 + модифікатор ≥ 20
+
+КІЛЬКІСТЬ ХОДІВ:
+- 1 хід: одна проста дія (атака, заклинання, рух)
+- 1 хід складний: комбо дія (скрадання+атака)
+- 2+ ходи: множинні дії (осліпити+атакувати+обшукати)
+- Неможливо: занадто багато за раунд
+
+ЗАВЖДИ відповідай у JSON форматі:
+{
+    "main_response": "Основна відповідь гравцю (2-3 речення)",
+    "action_type": "simple/complex/multi_turn/impossible",
+    "dice_required": {
+        "type": "d20/d6/d8/none",
+        "modifier_stat": "STR/DEX/CON/INT/WIS/CHA/none",
+        "difficulty": 12-20,
+        "damage_dice": "d4/d6/d8/d10/none"
+    },
+    "hint": "Підказка про можливості класу (1-2 речення)",
+    "consequences": {
+        "success": "Що станеться при успіху",
+        "failure": "Що станеться при невдачі"
+    },
+    "xp_reward": 0-50,
+    "gold_reward": 0-20
+}
+
+Дані гравця та контекст - у наступному повідомленні, дія гравця - в останньому."""
+    
+    # Сумарне використання токенів
+    usage = {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0}
+    
+    @staticmethod
+    def render_player_sheet(player: Player) -> str:
+        """Компактна картка гравця для промпту"""
+        stats_str = ' '.join(
+            f"{stat.upper()} {value}({modifier:+d})"
+            for stat, value, modifier in zip(STAT_ORDER, player.stats, player.modifiers)
+        )
+        return (
+            f"ГРАВЕЦЬ: {player.name}, {player.class_name}, "
+            f"рівень {player.level}, XP {player.xp}, золото {player.gold}\n"
+            f"HP {player.hp_current}/{player.hp_max}, MP {player.mp_current}/{player.mp_max}\n"
+            f"ХАРАКТЕРИСТИКИ: {stats_str}\n"
+            f"ІНВЕНТАР: {', '.join(inventory_names(player.inventory)) or 'порожньо'}\n"
+            f"{CombatSimulator.render_odds(player)}"
+        )
+    
+    @staticmethod
+    def build_messages(prompt: str, player: Player, context: str = "") -> List[Dict[str, str]]:
+        """Формує повідомлення для GPT: статичний префікс, картка гравця, дія"""
+        # Картка рахується один раз на версію гравця
+        player_info = player.memo('prompt_sheet', RPGGameLogic.render_player_sheet)
+        if context:
+            player_info += f"\nКОНТЕКСТ: {context}"
+        return [
+            {"role": "system", "content": RPGGameLogic.SYSTEM_PROMPT},
+            {"role": "system", "content": player_info},
+            {"role": "user", "content": prompt}
+        ]
+    
+    @staticmethod
+    def count_fallback(error: Exception):
+        """Лічильники запасних відповідей і зіпсованого JSON"""
+        metrics.inc('rpg_gpt_fallbacks_total')
+        if isinstance(error, json.JSONDecodeError):
+            metrics.inc('rpg_gpt_json_errors_total')
+    
+    @staticmethod
+    def record_usage(usage: Any):
+        """Логує і накопичує кількість токенів одного виклику"""
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', 0) or 0
+        totals = RPGGameLogic.usage
+        totals['calls'] += 1
+        totals['prompt_tokens'] += usage.prompt_tokens
+        totals['cached_tokens'] += cached_tokens
+        totals['completion_tokens'] += usage.completion_tokens
+        metrics.inc('rpg_openai_tokens_total', usage.prompt_tokens - cached_tokens, kind='prompt')
+        metrics.inc('rpg_openai_tokens_total', cached_tokens, kind='cached')
+        metrics.inc('rpg_openai_tokens_total', usage.completion_tokens, kind='completion')
+        logger.info(
+            f"Токени GPT: вхід {usage.prompt_tokens} (з кешу {cached_tokens}), "
+            f"вихід {usage.completion_tokens}"
+        )
+    
+    @staticmethod
+    async def get_gpt_response(prompt: str, player: Player, context: str = "") -> Dict[str, Any]:
+        """Отримує відповідь від GPT з ігровою логікою"""
+        cache_key = gpt_cache.make_key(prompt, player, context)
+        if cache_key is not None:
+            cached = gpt_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        model, max_tokens, timeout = model_router.route(prompt, player.user_id)
+        started = None
+        try:
+            if not openai_breaker.allow():
+                raise BackendUnavailable('openai')
+            with backend_span('openai', 'chat'):
+                async with openai_scheduler.slot():
+                    started = time.perf_counter()
+                    response = await openai_client.chat.completions.create(
+                        model=model,
+                        messages=RPGGameLogic.build_messages(prompt, player, context),
+                        max_tokens=max_tokens,
+                        temperature=0.7,
+                        response_format={"type": "json_object"},
+                        timeout=timeout
+                    )
+            
+            elapsed = time.perf_counter() - started
+            model_router.observe(model, elapsed)
+            openai_breaker.record(True, elapsed)
+            RPGGameLogic.record_usage(response.usage)
+            
+            # Парсимо JSON відповідь
+            content = response.choices[0].message.content
+            result = json.loads(content)
+            if cache_key is not None:
+                gpt_cache.put(cache_key, result)
+            return result
+            
+        except BackendBusy:
+            raise
+        except Exception as e:
+            if started is not None and not isinstance(e, json.JSONDecodeError):
+                openai_breaker.record(False, time.perf_counter() - started)
+            if isinstance(e, APITimeoutError):
+                # Тайм-аут теж вимір: наступні запити до цієї моделі чекатимуть довше
+                model_router.observe(model, timeout)
+            logger.error(f"Помилка GPT: {e}")
+            RPGGameLogic.count_fallback(e)
+            return RPGGameLogic.fallback_response()
+    
+    @staticmethod
+    async def stream_gpt_response(prompt: str, player: Player, context: str = "",
+                                  on_progress: Optional[Callable[[StreamingJSONParser], None]] = None
+                                  ) -> Dict[str, Any]:
+        """Отримує відповідь від GPT потоком, викликаючи on_progress на кожному фрагменті
+        
+        on_progress не чекає на Telegram: слот OpenAI тримається лише на час потоку.
+        """
+        cache_key = gpt_cache.make_key(prompt, player, context)
+        if cache_key is not None:
+            cached = gpt_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        model, max_tokens, timeout = model_router.route(prompt, player.user_id)
+        parser = StreamingJSONParser()
+        started = None
+        try:
+            if not openai_breaker.allow():
+                raise BackendUnavailable('openai')
+            with backend_span('openai', 'chat_stream'):
+                async with openai_scheduler.slot():
+                    started = time.perf_counter()
+                    stream = await openai_client.chat.completions.create(
+                        model=model,
+                        messages=RPGGameLogic.build_messages(prompt, player, context),
+                        max_tokens=max_tokens,
+                        temperature=0.7,
+                        response_format={"type": "json_object"},
+                        stream=True,
+                        stream_options={"include_usage": True},
+                        timeout=timeout
+                    )
+                    async for chunk in stream:
+                        # Кількість токенів приходить в останньому фрагменті без choices
+                        if chunk.usage is not None:
+                            RPGGameLogic.record_usage(chunk.usage)
+                        if not chunk.choices or not chunk.choices[0].delta.content:
+                            continue
+                        if not parser.buffer:
+                            first_token = time.perf_counter() - started
+                            metrics.observe('rpg_openai_first_token_seconds', first_token)
+                            trace_event('openai.first_token', first_token)
+                        parser.feed(chunk.choices[0].delta.content)
+                        if on_progress is not None:
+                            on_progress(parser)
+            elapsed = time.perf_counter() - started
+            model_router.observe(model, elapsed)
+            openai_breaker.record(True, elapsed)
+            
+            result = json.loads(parser.buffer)
+            if cache_key is not None:
+                gpt_cache.put(cache_key, result)
+            return result
+            
+        except BackendBusy:
+            raise
+        except Exception as e:
+            if started is not None and not isinstance(e, json.JSONDecodeError):
+                openai_breaker.record(False, time.perf_counter() - started)
+            if isinstance(e, APITimeoutError):
+                # Тайм-аут теж вимір: наступні запити до цієї моделі чекатимуть довше
+                model_router.observe(model, timeout)
+            logger.error(f"Помилка GPT: {e}")
+            RPGGameLogic.count_fallback(e)
+            response = RPGGameLogic.fallback_response()
+            # Якщо текст для гравця вже встиг прийти, не викидаємо його
+            partial_text = parser.main_response
+            if partial_text:
+                response["main_response"] = partial_text
+                response["dice_required"] = parser.dice_required or response["dice_required"]
+            return response
+
+    @staticmethod
+    def calculate_attack(attacker: Player, target_defense: int, weapon: str = "fists",
+                         advantage: bool = False) -> Dict:
+        """Обчислює атаку"""
+        # Отримуємо дані зброї
+        weapon_data = ITEMS.get(weapon, {'damage': 'd4', 'type': 'weapon'})
+        
+        # Модифікатор атаки
+        if weapon_data.get('type') == 'ranged':
+            attack_mod = attacker.modifier('dex')
+        else:
+            attack_mod = attacker.modifier('str')
+        
+        # Кидок атаки (з перевагою - два d20, береться більший)
+        attack_roll = DiceRoller.roll('2d20kh1' if advantage else 'd20') + attack_mod
+        
+        if attack_roll >= target_defense:
+            # Попадання - рахуємо урон
+            damage_roll = DiceRoller.roll(weapon_data['damage'])
+            if weapon_data.get('type') != 'ranged':
+                damage_roll += attacker.modifier('str')
+            
+            return {
+                'hit': True,
+                'attack_roll': attack_roll,
+                'damage': max(1, damage_roll),  # Мінімум 1 урон
+                'critical': attack_roll >= 20
+            }
+        else:
+            return {
+                'hit': False,
+                'attack_roll': attack_roll,
+                'damage': 0,
+                'critical': False
+            }
+    
+    @staticmethod
+    def equipped_weapon(player: Player, prefer_ranged: bool = False) -> str:
+        """Перша зброя з інвентаря (для лучників - дальнього бою)"""
+        weapons = [item_id for item_id in player.inventory if ITEMS.get(item_id, {}).get('type') in ('weapon', 'ranged')]
+        if prefer_ranged:
+            weapons.sort(key=lambda item_id: ITEMS[item_id]['type'] != 'ranged')
+        return weapons[0] if weapons else 'fists'
+    
+    @staticmethod
+    def roll_ability(ability: str, player: Player, targets: int = 1) -> Dict[str, Any]:
+        """Кидає ефект здібності; масові ефекти - по кидку на ціль одним векторним викликом"""
+        ability_data = ABILITIES[ability]
+        effect = ability_data.get('effect')
+        
+        if effect == 'advantage':
+            # Скрадання: перевірка спритності з перевагою
+            roll = DiceRoller.roll(DiceRoller.with_advantage('d20+DEX'), player)
+            return {'ability': ability, 'kind': 'check', 'rolls': [roll], 'total': roll}
+        
+        if effect == '3_arrows':
+            weapon = RPGGameLogic.equipped_weapon(player, prefer_ranged=True)
+            rolls = DiceRoller.roll_many(ITEMS.get(weapon, {}).get('damage', 'd4'), 3, player)
+            return {'ability': ability, 'kind': 'damage', 'rolls': rolls.tolist(), 'total': int(rolls.sum())}
+        
+        if 'heal' in ability_data or 'damage' in ability_data:
+            kind = 'heal' if 'heal' in ability_data else 'damage'
+            dice = ability_data[kind]
+            area = dice.endswith('_all') or ability_data.get('area', False)
+            dice = dice.removesuffix('_all')
+            if dice.startswith('+'):
+                # Додатковий урон до удару зброєю (удар зі спини)
+                dice = ITEMS.get(RPGGameLogic.equipped_weapon(player), {}).get('damage', 'd4') + dice
+            rolls = DiceRoller.roll_many(dice, max(1, targets) if area else 1, player)
+            rolls = np.maximum(rolls, 0)
+            return {'ability': ability, 'kind': kind, 'rolls': rolls.tolist(), 'total': int(rolls.sum())}
+        
+        # Ефекти без кидків (подвоєння урону, захист союзника тощо)
+        return {'ability': ability, 'kind': 'effect', 'effect': effect, 'rolls': [], 'total': 0}
+
+@dataclass(frozen=True, slots=True)
+class AttackOdds:
+    """Результат симуляції атак: шанси влучання, криту та розподіл урону"""
+    weapon: str
+    defense: int
+    hit_chance: float
+    crit_chance: float
+    mean_damage: float
+    # (урон, ймовірність) для кожного можливого значення, включно з 0 при промаху
+    damage_distribution: Tuple[Tuple[int, float], ...]
+    
+    def damage_percentile(self, q: float) -> int:
+        """Урон, який не перевищується з ймовірністю q"""
+        cumulative = 0.0
+        for damage, probability in self.damage_distribution:
+            cumulative += probability
+            if cumulative >= q:
+                return damage
+        return self.damage_distribution[-1][0] if self.damage_distribution else 0
+    
+    def hit_damage_range(self) -> Tuple[int, int]:
+        """Мінімальний і максимальний урон при влучанні"""
+        hits = [damage for damage, _ in self.damage_distribution if damage > 0]
+        return (min(hits), max(hits)) if hits else (0, 0)
+    
+    def summary(self) -> str:
+        """Короткий опис шансів для підказки та промпту"""
+        low, high = self.hit_damage_range()
+        mean_on_hit = self.mean_damage / self.hit_chance if self.hit_chance else 0.0
+        return (
+            f"{self.hit_chance:.0%} влучання (крит {self.crit_chance:.0%}), "
+            f"урон {low}-{high}, в середньому {mean_on_hit:.1f} при влучанні"
+        )
+
+class CombatSimulator:
+    """Векторна оцінка шансів атаки за правилами calculate_attack"""
+    
+    @staticmethod
+    def attack_odds(player: Player, target_defense: int, weapon: str = "fists",
+                    advantage: bool = False) -> AttackOdds:
+        """Шанси атаки гравця зброєю проти захисту цілі"""
+        weapon_data = ITEMS.get(weapon, {'damage': 'd4', 'type': 'weapon'})
+        ranged = weapon_data.get('type') == 'ranged'
+        attack_mod = player.modifier('dex' if ranged else 'str')
+        damage_mod = 0 if ranged else player.modifier('str')
+        # Від характеристик залежать лише модифікатори - кеш спільний для гравців з однаковими
+        return CombatSimulator._simulate(
+            weapon, weapon_data['damage'], attack_mod, damage_mod, int(target_defense), advantage
+        )
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _simulate(weapon: str, damage_dice: str, attack_mod: int, damage_mod: int,
+                  target_defense: int, advantage: bool) -> AttackOdds:
+        """Проганяє COMBAT_SIM_TRIALS атак одним набором векторних кидків"""
+        trials = COMBAT_SIM_TRIALS
+        attack = DiceRoller.roll_many('2d20kh1' if advantage else 'd20', trials) + attack_mod
+        hit = attack >= target_defense
+        damage = np.maximum(1, DiceRoller.roll_many(damage_dice, trials) + damage_mod) * hit
+        counts = np.bincount(damage)
+        distribution = tuple(
+            (int(value), float(count) / trials) for value, count in enumerate(counts) if count
+        )
+        return AttackOdds(
+            weapon=weapon,
+            defense=target_defense,
+            hit_chance=float(hit.mean()),
+            crit_chance=float((hit & (attack >= 20)).mean()),
+            mean_damage=float(damage.mean()),
+            damage_distribution=distribution
+        )
+    
+    @staticmethod
+    def weapon_name(weapon: str) -> str:
+        """Назва зброї для тексту"""
+        return ITEMS.get(weapon, {}).get('name', 'Кулаки')
+    
+    @staticmethod
+    def render_odds(player: Player) -> str:
+        """Рядок шансів основною зброєю проти типового захисту (для промпту)"""
+        weapon = RPGGameLogic.equipped_weapon(player, prefer_ranged=player.player_class == 'archer')
+        results = [CombatSimulator.attack_odds(player, defense, weapon) for defense in COMBAT_REFERENCE_DEFENSES]
+        low, high = results[0].hit_damage_range()
+        odds = '; '.join(
+            f"захист {odds.defense} - {odds.hit_chance:.0%} (крит {odds.crit_chance:.0%})" for odds in results
+        )
+        return f"АТАКА ({CombatSimulator.weapon_name(weapon)}, урон {low}-{high}): {odds}"
+    
+    @staticmethod
+    def odds_hint(dice_info: Dict[str, Any], player: Player) -> str:
+        """Шанси для кидка, який вимагає GPT; порожньо якщо кидок не атака"""
+        damage_dice = dice_info.get('damage_dice')
+        try:
+            difficulty = int(dice_info.get('difficulty'))
+        except (TypeError, ValueError):
+            return ""
+        if not damage_dice or damage_dice == 'none':
+            return ""
+        modifier_stat = str(dice_info.get('modifier_stat', '')).lower()
+        weapon = RPGGameLogic.equipped_weapon(player, prefer_ranged=modifier_stat == 'dex')
+        odds = CombatSimulator.attack_odds(player, difficulty, weapon)
+        return f"🎯 {CombatSimulator.weapon_name(weapon)} проти {difficulty}: {odds.summary()}"
+
+class ConversationMemory:
+    """Ковзна пам'ять розмови гравця в межах бюджету токенів
+    
+    Стан лежить у context.user_data['conversation']: {'summary': str, 'turns': [[дія, відповідь], ...]}.
+    Коли ходи перестають вміщатися в бюджет, найстаріші згортаються в підсумок
+    окремим фоновим запитом до GPT, не затримуючи відповідь гравцю.
+    """
+    
+    SUMMARY_PROMPT = (
+        "Ти ведеш журнал RPG пригоди. Онови короткий підсумок: допиши до попереднього "
+        "підсумку нові ходи, збережи імена, місця, предмети, поранення та незавершені цілі. "
+        "Не більше {limit} токенів, лише текст підсумку."
+    )
+    
+    def __init__(self, budget: int, summary_tokens: int, keep_turns: int):
+        self.budget = budget
+        self.summary_tokens = summary_tokens
+        self.keep_turns = keep_turns
+        self._summarizing: Dict[int, asyncio.Task] = {}
+        self.summaries = 0
+        self.summary_errors = 0
+        self.dropped_turns = 0
+    
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """Груба оцінка без токенізатора: ~3 символи кирилиці на токен"""
+        return len(text) // 3 + 1
+    
+    @staticmethod
+    def _turn_text(turn: List[str]) -> str:
+        return f"Гравець: {turn[0]}\nМайстер: {turn[1]}"
+    
+    def context(self, user_data: Dict[str, Any]) -> str:
+        """Підсумок і останні ходи, що вміщаються в бюджет, для промпту"""
+        state = user_data.get('conversation')
+        if not state:
+            return ""
+        budget = self.budget
+        summary = state['summary'][:budget * 3]
+        budget -= self.estimate_tokens(summary) if summary else 0
+        
+        recent = []
+        for turn in reversed(state['turns']):
+            text = self._turn_text(turn)
+            cost = self.estimate_tokens(text)
+            if cost > budget:
+                break
+            recent.append(text)
+            budget -= cost
+        
+        parts = []
+        if summary:
+            parts.append(f"Попередні події: {summary}")
+        if recent:
+            parts.append("Останні ходи:\n" + "\n".join(reversed(recent)))
+        return "\n".join(parts)
+    
+    def _tokens(self, state: Dict[str, Any]) -> int:
+        return self.estimate_tokens(state['summary']) + sum(
+            self.estimate_tokens(self._turn_text(turn)) for turn in state['turns']
+        )
+    
+    def record(self, user_id: int, user_data: Dict[str, Any], action: str, reply: str):
+        """Додає хід і, якщо бюджет перевищено, запускає фонове згортання"""
+        state = user_data.setdefault('conversation', {'summary': '', 'turns': []})
+        state['turns'].append([action, reply])
+        if (len(state['turns']) > self.keep_turns and self._tokens(state) > self.budget
+                and user_id not in self._summarizing):
+            task = asyncio.create_task(self._summarize(state), context=PlayerCache._background_context())
+            self._summarizing[user_id] = task
+            task.add_done_callback(lambda _: self._summarizing.pop(user_id, None))
+    
+    def reset(self, user_data: Dict[str, Any]):
+        """Новий персонаж - нова історія"""
+        user_data.pop('conversation', None)
+    
+    async def _summarize(self, state: Dict[str, Any]):
+        """Згортає найстаріші ходи в підсумок разом з попереднім підсумком"""
+        folded = state['turns'][:-self.keep_turns]
+        if not folded:
+            return
+        turns_text = "\n".join(self._turn_text(turn) for turn in folded)
+        summary = None
+        started = None
+        try:
+            if not openai_breaker.allow():
+                raise BackendUnavailable('openai')
+            with backend_span('openai', 'summary'):
+                async with openai_scheduler.slot(PRIORITY_BACKGROUND):
+                    started = time.perf_counter()
+                    response = await openai_client.chat.completions.create(
+                        model=OPENAI_MODEL,
+                        messages=[
+                            {"role": "system", "content": self.SUMMARY_PROMPT.format(limit=self.summary_tokens)},
+                            {"role": "user", "content": f"ПІДСУМОК: {state['summary'] or 'немає'}\n\nНОВІ ХОДИ:\n{turns_text}"}
+                        ],
+                        max_tokens=self.summary_tokens,
+                        temperature=0.3,
+                        timeout=20
+                    )
+            openai_breaker.record(True, time.perf_counter() - started)
+            RPGGameLogic.record_usage(response.usage)
+            summary = (response.choices[0].message.content or "").strip()
+        except Exception as e:
+            if started is not None:
+                openai_breaker.record(False, time.perf_counter() - started)
+            logger.error(f"Помилка підсумку розмови: {e}")
+        
+        # Поки йшов запит, могли додатися нові ходи - прибираємо лише згорнуті
+        del state['turns'][:len(folded)]
+        if summary:
+            state['summary'] = summary
+            self.summaries += 1
+        else:
+            # Бюджет жорсткий: без підсумку найстаріші ходи просто відкидаються
+            self.summary_errors += 1
+            self.dropped_turns += len(folded)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'summarizing': len(self._summarizing),
+            'summaries': self.summaries,
+            'summary_errors': self.summary_errors,
+            'dropped_turns': self.dropped_turns
+        }
+
+conversation_memory = ConversationMemory(MEMORY_TOKEN_BUDGET, MEMORY_SUMMARY_TOKENS, MEMORY_KEEP_TURNS)
+
+class FastPathResolver:
+    """Розпізнає рутинні дії над даними гравця і виконує їх локально, без GPT"""
+    
+    # Основи дієслів (у нормалізованому тексті без апострофів)
+    VERBS = {
+        'drink': ('пю', 'вип', 'пити', 'пий', 'ковтаю'),
+        'use': ('використ', 'застосов'),
+        'cast': ('кастую', 'чаклую', 'читаю', 'закликаю'),
+        'heal': ('лікую', 'підліков', 'вилікову', 'зцілю', 'хілю'),
+        'attack': ('атакую', 'атакувати', 'бю', 'вдаряю', 'вдарю', 'стріляю', 'нападаю', 'рубаю', 'колю'),
+        'check': ('скільки', 'перевір', 'покажи', 'глянь', 'подивлюсь'),
+    }
+    # Розмовні назви на додачу до назв з ITEMS і ABILITIES
+    ALIASES = {
+        'зілл': ('item', 'healing_potion'),
+        'хілк': ('item', 'healing_potion'),
+        'золот': ('gold', None),
+        'грош': ('gold', None),
+        'гроші': ('gold', None),
+        'монет': ('gold', None),
+        'здоровя': ('hp', None),
+        'хп': ('hp', None),
+        'hp': ('hp', None),
+        'мана': ('mp', None),
+        'мани': ('mp', None),
+        'mp': ('mp', None),
+    }
+    # Кілька дій в одному повідомленні - це вже історія для Майстра гри
+    CLAUSE_RE = re.compile(r"[,;]|\b(?:і|й|та|потім|після|а потім|поки)\b")
+    # Дія на когось чи щось ("на друга", "для Олега") - теж; "у мене" ціллю не є
+    SELF_RE = re.compile(r"\b(?:в|у) мене\b|\bна (?:себе|собі)\b")
+    TARGET_RE = re.compile(r"\b(?:на|для|по|до|проти|в|у|за|з|із)\b")
+    # Слова, що не змінюють ціль лікування
+    SELF_WORDS = frozenset(('я', 'себе', 'собі', 'сам', 'сама', 'мене', 'зараз', 'ще', 'раз', 'швидко'))
+    
+    def __init__(self, enabled: bool, max_words: int):
+        self.enabled = enabled
+        self.max_words = max_words
+        aliases: Dict[str, Tuple[str, Optional[str]]] = {}
+        for item_id, item_data in ITEMS.items():
+            aliases[self.normalize(item_data['name'])] = ('item', item_id)
+        for ability, ability_data in ABILITIES.items():
+            aliases[self.normalize(ability_data['name'])] = ('ability', ability)
+        aliases.update(self.ALIASES)
+        self._aliases = aliases
+        # Довші назви першими, щоб "зілля лікування" не розпалось на дві
+        self._object_re = re.compile(
+            r'\b(' + '|'.join(re.escape(alias) for alias in sorted(aliases, key=len, reverse=True)) + r')\w*'
+        )
+        self._verb_stems = tuple(stem for stems in self.VERBS.values() for stem in stems)
+        self.messages = 0
+        self.resolved: Dict[str, int] = {}
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Нижній регістр, без апострофів і розділових знаків"""
+        text = re.sub(r"['’ʼ`]", '', text.lower())
+        return ' '.join(re.findall(r'\w+', text))
+    
+    def match(self, text: str, session: Dict[str, Any]) -> Optional[Tuple[str, Optional[str]]]:
+        """Намір простого повідомлення: ('potion' | 'heal' | 'gold' | 'hp' | 'mp' | 'attack', зброя) або None"""
+        normalized = self.normalize(text)
+        words = normalized.split()
+        if not words or len(words) > self.max_words or self.CLAUSE_RE.search(text.lower()):
+            return None
+        
+        if self.TARGET_RE.search(self.SELF_RE.sub(' ', normalized)):
+            return None
+        
+        verbs = {verb for verb, stems in self.VERBS.items() if any(word.startswith(stems) for word in words)}
+        objects = [self._aliases[match.group(1)] for match in self._object_re.finditer(normalized)]
+        items = {key for kind, key in objects if kind == 'item'}
+        abilities = {key for kind, key in objects if kind == 'ability'}
+        kinds = {kind for kind, _ in objects}
+        
+        if 'healing_potion' in items and verbs & {'drink', 'use', 'heal'}:
+            return ('potion', None)
+        if ('heal' in abilities and verbs & {'cast', 'use', 'heal'}) or (verbs == {'heal'} and not objects):
+            # "лікую друга" - лікування іншого гравця вирішує Майстер гри
+            return None if self.has_target(normalized) else ('heal', None)
+        if kinds & {'gold', 'hp', 'mp'} and ('check' in verbs or text.rstrip().endswith('?')) and len(kinds) == 1:
+            return (kinds.pop(), None)
+        if 'attack' in verbs and not abilities and kinds <= {'item'}:
+            weapons = [item_id for item_id in items if ITEMS[item_id].get('type') in ('weapon', 'ranged')]
+            if len(weapons) == len(items) and self.pending_attack(session) is not None:
+                return ('attack', weapons[0] if weapons else None)
+        return None
+    
+    def has_target(self, normalized: str) -> bool:
+        """Чи лишились слова, крім дієслова, відомих назв і "себе" - тобто ціль дії"""
+        rest = self._object_re.sub(' ', normalized).split()
+        return any(not word.startswith(self._verb_stems) and word not in self.SELF_WORDS for word in rest)
+    
+    @staticmethod
+    def pending_attack(session: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Кидок атаки, якого Майстер гри чекає від гравця"""
+        dice_info = (session.get('last_gpt_response') or {}).get('dice_required') or {}
+        damage_dice = dice_info.get('damage_dice')
+        if not damage_dice or damage_dice == 'none':
+            return None
+        try:
+            int(dice_info.get('difficulty'))
+        except (TypeError, ValueError):
+            return None
+        return dice_info
+    
+    def resolve(self, intent: str, weapon: Optional[str], player: Player,
+                session: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+        """Виконує намір: текст відповіді і зміни рядка гравця"""
+        if intent == 'gold':
+            return f"💰 У вас {player.gold} золота.", {}
+        
+        if intent == 'hp':
+            return f"❤️ HP: {player.hp_current}/{player.hp_max}", {}
+        
+        if intent == 'mp':
+            return f"💙 MP: {player.mp_current}/{player.mp_max}", {}
+        
+        if intent == 'potion':
+            potions = player.inventory.get('healing_potion', 0)
+            if not potions:
+                return "🎒 У вас немає зілля лікування.", {}
+            if player.hp_current >= player.hp_max:
+                return f"❤️ Ви й так повністю здорові ({player.hp_current}/{player.hp_max}).", {}
+            healed = max(1, DiceRoller.roll(ITEMS['healing_potion']['heal']))
+            hp = min(player.hp_max, player.hp_current + healed)
+            inventory = dict(player.inventory)
+            if potions > 1:
+                inventory['healing_potion'] = potions - 1
+            else:
+                del inventory['healing_potion']
+            return (
+                f"🧪 Ви випили зілля лікування: +{hp - player.hp_current} HP\n"
+                f"❤️ HP: {hp}/{player.hp_max}\n"
+                f"🎒 Зілль залишилось: {potions - 1}"
+            ), {'hp_current': hp, 'inventory': format_inventory(inventory)}
+        
+        if intent == 'heal':
+            if 'heal' not in CLASSES.get(player.player_class, {}).get('abilities', []):
+                return f"❌ {player.class_name} не володіє «{ABILITIES['heal']['name']}».", {}
+            cost = ABILITIES['heal']['mp_cost']
+            if player.mp_current < cost:
+                return f"💙 Недостатньо мани: потрібно {cost} MP, є {player.mp_current}.", {}
+            if player.hp_current >= player.hp_max:
+                return f"❤️ Ви й так повністю здорові ({player.hp_current}/{player.hp_max}).", {}
+            healed = max(1, RPGGameLogic.roll_ability('heal', player)['total'])
+            hp = min(player.hp_max, player.hp_current + healed)
+            mp = player.mp_current - cost
+            return (
+                f"✨ {ABILITIES['heal']['name']}: +{hp - player.hp_current} HP (−{cost} MP)\n"
+                f"❤️ HP: {hp}/{player.hp_max}\n"
+                f"💙 MP: {mp}/{player.mp_max}"
+            ), {'hp_current': hp, 'mp_current': mp}
+        
+        # Атака, якої чекає Майстер гри: ціль і її захист - з останньої відповіді GPT
+        gpt_response = session['last_gpt_response']
+        dice_info = gpt_response['dice_required']
+        difficulty = int(dice_info['difficulty'])
+        if weapon is None or weapon not in player.inventory:
+            weapon = RPGGameLogic.equipped_weapon(player, prefer_ranged=str(dice_info.get('modifier_stat', '')).upper() == 'DEX')
+        attack = RPGGameLogic.calculate_attack(player, difficulty, weapon)
+        consequences = gpt_response.get('consequences') or {}
+        if attack['hit']:
+            text = (
+                f"⚔️ {CombatSimulator.weapon_name(weapon)}: {attack['attack_roll']} проти {difficulty} - влучання! "
+                f"Урон {attack['damage']}{' (критичний!)' if attack['critical'] else ''}"
+            )
+            outcome = consequences.get('success')
+        else:
+            text = f"⚔️ {CombatSimulator.weapon_name(weapon)}: {attack['attack_roll']} проти {difficulty} - промах."
+            outcome = consequences.get('failure')
+        # Кидок зроблено - повторна атака піде вже до Майстра гри
+        session['last_gpt_response'] = dict(gpt_response, dice_required={'type': 'none'})
+        return (f"{text}\n\n{outcome}" if outcome else text), {}
+    
+    async def try_handle(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                         player: Player, text: str) -> bool:
+        """Відповідає на просту дію локально; False - дію треба віддати Майстру гри"""
+        self.messages += 1
+        matched = self.match(text, context.user_data) if self.enabled else None
+        if matched is None:
+            return False
+        intent, weapon = matched
+        reply, updates = self.resolve(intent, weapon, player, context.user_data)
+        if updates:
+            await GoogleSheetsAPI.update_player(player.user_id, updates)
+        self.resolved[intent] = self.resolved.get(intent, 0) + 1
+        conversation_memory.record(player.user_id, context.user_data, text, reply)
+        await update.message.reply_text(reply)
+        return True
+    
+    def stats(self) -> Dict[str, Any]:
+        fast = sum(self.resolved.values())
+        result = {
+            'messages': self.messages,
+            'fast_path': fast,
+            'share': round(fast / self.messages, 3) if self.messages else 0.0
+        }
+        result.update({f'intent_{intent}': count for intent, count in self.resolved.items()})
+        return result
+
+fast_path = FastPathResolver(FAST_PATH_ENABLED, FAST_PATH_MAX_WORDS)
+
+class BattleError(Exception):
+    """Дія в бою неможлива; текст помилки показується гравцю"""
+
+@dataclass(slots=True)
+class Combatant:
+    """Учасник бою: гравець або ворог"""
+    key: str
+    name: str
+    hp: int
+    hp_max: int
+    defense: int
+    mp: int = 0
+    initiative: int = 0
+    player: Optional[Player] = None
+    enemy: Optional[str] = None
+    advantage: bool = False
+    guarded_by: Optional[str] = None
+    frightened: bool = False
+    
+    @property
+    def alive(self) -> bool:
+        return self.hp > 0
+
+@dataclass(slots=True)
+class Battle:
+    """Бій у чаті: учасники, черга ходів за ініціативою і номер раунду"""
+    chat_id: int
+    combatants: Dict[str, Combatant] = field(default_factory=dict)
+    order: List[str] = field(default_factory=list)
+    turn: int = -1
+    round: int = 0
+    timer: Optional[asyncio.TimerHandle] = None
+    
+    @property
+    def started(self) -> bool:
+        return bool(self.order)
+    
+    @property
+    def current(self) -> Optional[Combatant]:
+        return self.combatants[self.order[self.turn]] if self.started else None
+    
+    def side(self, players: bool) -> List[Combatant]:
+        return [combatant for combatant in self.combatants.values() if (combatant.player is not None) == players]
+
+class BattleManager:
+    """Групові бої в пам'яті: кидки, HP і ліміти здібностей локально, у сховище - один пакет у кінці"""
+    
+    OUTCOMES = {
+        'victory': "🏆 Перемога!",
+        'defeat': "💀 Загін переможено... Ви ледве вибираєтесь живими.",
+        'retreat': "🌫️ Вороги відступають - бій затягнувся.",
+        'flee': "🏃 Загін відступає з бою."
+    }
+    
+    def __init__(self, turn_timeout: float, max_rounds: int, max_players: int):
+        self.turn_timeout = turn_timeout
+        self.max_rounds = max_rounds
+        self.max_players = max_players
+        self._battles: Dict[int, Battle] = {}
+        # user_id -> чат, у якому гравець зараз б'ється
+        self._players: Dict[int, int] = {}
+        self._tasks: set = set()
+        self.started = 0
+        self.finished = 0
+        self.victories = 0
+        self.rounds = 0
+        self.actions = 0
+        self.timeouts = 0
+        self.writes = 0
+        self.write_errors = 0
+        # Черга до диспетчера, якщо бот працює кількома обробниками
+        self.outbox: Optional['multiprocessing.Queue'] = None
+        self.forwarded = 0
+    
+    def get(self, chat_id: int) -> Optional[Battle]:
+        return self._battles.get(chat_id)
+    
+    @staticmethod
+    def armor_class(player: Player) -> int:
+        """Захист гравця: 10 + модифікатор спритності + броня з інвентаря"""
+        armor = sum(ITEMS[item_id].get('defense', 0) for item_id in player.inventory if item_id in ITEMS)
+        return 10 + player.modifier('dex') + armor
+    
+    @staticmethod
+    def parse_ability(text: str) -> Optional[str]:
+        """Ключ здібності за ключем або назвою"""
+        if text in ABILITIES:
+            return text
+        normalized = FastPathResolver.normalize(text)
+        for ability, ability_data in ABILITIES.items():
+            if normalized and FastPathResolver.normalize(ability_data['name']).startswith(normalized):
+                return ability
+        return None
+    
+    def open(self, chat_id: int, enemy: str, count: int, player: Player) -> Battle:
+        """Відкриває набір у бій з ворогами; гравець, що його почав, приєднується одразу"""
+        if chat_id in self._battles:
+            raise BattleError("⚔️ У цьому чаті вже йде бій. /battle - стан бою")
+        if enemy not in ENEMIES:
+            raise BattleError(f"❓ Невідомий ворог. Доступні: {', '.join(ENEMIES)}")
+        battle = Battle(chat_id)
+        enemy_data = ENEMIES[enemy]
+        for index in range(1, count + 1):
+            battle.combatants[f'e{index}'] = Combatant(
+                key=f'e{index}',
+                name=enemy_data['name'] if count == 1 else f"{enemy_data['name']} {index}",
+                hp=enemy_data['hp'],
+                hp_max=enemy_data['hp'],
+                defense=enemy_data['defense'],
+                enemy=enemy
+            )
+        self.join(battle, player)
+        self._battles[chat_id] = battle
+        self.started += 1
+        return battle
+    
+    def join(self, battle: Battle, player: Player):
+        if battle.started:
+            raise BattleError("⏳ Бій уже почався - приєднатися не можна")
+        if player.user_id in self._players:
+            raise BattleError("⚔️ Ви вже берете участь у бою")
+        if len(battle.side(True)) >= self.max_players:
+            raise BattleError(f"👥 У бою вже {self.max_players} гравців")
+        if player.hp_current <= 0:
+            raise BattleError("❤️ У вас немає сил битися - спочатку відновіть HP")
+        key = f'p{player.user_id}'
+        battle.combatants[key] = Combatant(
+            key=key,
+            name=player.name,
+            hp=player.hp_current,
+            hp_max=player.hp_max,
+            defense=self.armor_class(player),
+            mp=player.mp_current,
+            player=player
+        )
+        self._players[player.user_id] = battle.chat_id
+    
+    def leave(self, battle: Battle, user_id: int) -> bool:
+        """Виходить з набору до початку бою; True - набір закрито"""
+        battle.combatants.pop(f'p{user_id}', None)
+        self._players.pop(user_id, None)
+        if battle.side(True):
+            return False
+        self._battles.pop(battle.chat_id, None)
+        return True
+    
+    def begin(self, battle: Battle) -> List[str]:
+        """Кидок ініціативи; вороги, що ходять першими, ходять одразу"""
+        if battle.started:
+            raise BattleError("⚔️ Бій уже йде")
+        combatants = list(battle.combatants.values())
+        for combatant, roll in zip(combatants, DiceRoller.roll_many('d20', len(combatants))):
+            combatant.initiative = int(roll) + (combatant.player.modifier('dex') if combatant.player else 0)
+        combatants.sort(key=lambda combatant: combatant.initiative, reverse=True)
+        battle.order = [combatant.key for combatant in combatants]
+        battle.round = 1
+        lines = ["🎲 Ініціатива: " + ", ".join(f"{combatant.name} {combatant.initiative}" for combatant in combatants)]
+        return lines + self._advance(battle)
+    
+    def act(self, battle: Battle, user_id: int, ability: Optional[str] = None,
+            target: Optional[int] = None) -> List[str]:
+        """Хід гравця: атака зброєю або здібність, далі ходи ворогів до наступного гравця"""
+        actor = battle.current
+        if actor is None:
+            raise BattleError("⏳ Бій ще не почався: /fight")
+        if actor.key != f'p{user_id}':
+            raise BattleError(f"⏳ Зараз хід: {actor.name}")
+        lines = self._use_ability(battle, actor, ability, target) if ability else [self._attack(battle, actor, target)]
+        self._cancel_timer(battle)
+        self.actions += 1
+        return lines + self._advance(battle)
+    
+    def _enemy_target(self, battle: Battle, index: Optional[int]) -> Combatant:
+        if index is None:
+            living = [combatant for combatant in battle.side(False) if combatant.alive]
+            return living[0]
+        target = battle.combatants.get(f'e{index}')
+        if target is None or not target.alive:
+            raise BattleError(f"🎯 Ворога {index} немає серед живих")
+        return target
+    
+    def _ally_target(self, battle: Battle, index: Optional[int], default: Combatant) -> Combatant:
+        if index is None:
+            return default
+        allies = battle.side(True)
+        if not 1 <= index <= len(allies):
+            raise BattleError(f"🎯 Союзника {index} немає")
+        return allies[index - 1]
+    
+    @staticmethod
+    def _damage(target: Combatant, damage: int) -> str:
+        target.hp = max(0, target.hp - damage)
+        return f"{target.name}: {target.hp}/{target.hp_max} HP" + (" 💀" if not target.alive else "")
+    
+    def _attack(self, battle: Battle, actor: Combatant, target_index: Optional[int], bonus: int = 0,
+                factor: int = 1, extra_dice: Optional[str] = None, ranged: bool = False) -> str:
+        """Атака зброєю через calculate_attack; бонус до кидка зменшує захист цілі"""
+        target = self._enemy_target(battle, target_index)
+        weapon = RPGGameLogic.equipped_weapon(actor.player, prefer_ranged=ranged)
+        advantage, actor.advantage = actor.advantage, False
+        attack = RPGGameLogic.calculate_attack(actor.player, target.defense - bonus, weapon, advantage=advantage)
+        roll = attack['attack_roll'] + bonus
+        text = f"⚔️ {actor.name} ({CombatSimulator.weapon_name(weapon)}) → {target.name}: {roll} проти {target.defense}"
+        if not attack['hit']:
+            return f"{text} - промах"
+        damage = attack['damage'] * factor + (DiceRoller.roll(extra_dice) if extra_dice else 0)
+        critical = " (критичний!)" if attack['critical'] else ""
+        return f"{text} - урон {damage}{critical}. {self._damage(target, damage)}"
+    
+    def _use_ability(self, battle: Battle, actor: Combatant, ability: str,
+                     target_index: Optional[int]) -> List[str]:
+        """Перевіряє ліміти здібності локально і застосовує її ефект"""
+        ability_data = ABILITIES[ability]
+        name = ability_data['name']
+        if ability not in CLASSES.get(actor.player.player_class, {}).get('abilities', []):
+            raise BattleError(f"❌ {actor.player.class_name} не володіє «{name}»")
+        user_id = actor.player.user_id
+        if not ability_tracker.available(user_id, ability):
+            period = "цьому бою" if 'uses_per_battle' in ability_data else "сьогодні"
+            raise BattleError(f"⏳ «{name}» вже використано {period}")
+        cost = ability_data.get('mp_cost', 0)
+        if actor.mp < cost:
+            raise BattleError(f"💙 Недостатньо мани: потрібно {cost} MP, є {actor.mp}")
+        
+        effect = ability_data.get('effect')
+        lines = []
+        if ability == 'mighty_strike':
+            lines.append(self._attack(battle, actor, target_index, factor=2))
+        elif ability == 'precise_shot':
+            lines.append(self._attack(battle, actor, target_index, bonus=5, ranged=True))
+        elif ability == 'backstab':
+            lines.append(self._attack(battle, actor, target_index, extra_dice='d6'))
+        elif effect == '3_arrows':
+            lines.append(self._attack(battle, actor, target_index, ranged=True))
+            for _ in range(2):
+                if not any(enemy.alive for enemy in battle.side(False)):
+                    break
+                # Коли ціль впала, решта стріл летить у наступного ворога
+                chosen = battle.combatants.get(f'e{target_index}')
+                lines.append(self._attack(battle, actor, target_index if chosen and chosen.alive else None,
+                                          ranged=True))
+        elif effect == 'advantage':
+            actor.advantage = True
+            lines.append(f"🌑 {actor.name} зникає в тінях - наступна атака з перевагою")
+        elif effect == 'redirect_damage':
+            ally = self._ally_target(battle, target_index, actor)
+            if ally is actor or not ally.alive:
+                raise BattleError("🎯 Вкажіть живого союзника: /use protect_ally <номер>")
+            ally.guarded_by = actor.key
+            lines.append(f"🛡️ {actor.name} прикриває {ally.name} від наступного удару")
+        elif effect == 'fear_undead':
+            undead = [enemy for enemy in battle.side(False) if enemy.alive and ENEMIES[enemy.enemy].get('undead')]
+            if not undead:
+                raise BattleError("👻 Тут немає нежиті")
+            for enemy in undead:
+                enemy.frightened = True
+            lines.append(f"✨ {actor.name} виганяє нежить: {', '.join(enemy.name for enemy in undead)} тремтять")
+        elif 'damage' in ability_data:
+            targets = ([enemy for enemy in battle.side(False) if enemy.alive] if ability_data.get('area')
+                       else [self._enemy_target(battle, target_index)])
+            rolls = RPGGameLogic.roll_ability(ability, actor.player, len(targets))['rolls']
+            lines.append(f"🔥 {actor.name}: {name}")
+            lines += [f"  → урон {damage}. {self._damage(target, damage)}" for target, damage in zip(targets, rolls)]
+        else:
+            # Лікування: одного союзника або весь загін (включно з тими, хто без свідомості)
+            targets = (battle.side(True) if ability_data['heal'].endswith('_all')
+                       else [self._ally_target(battle, target_index, actor)])
+            rolls = RPGGameLogic.roll_ability(ability, actor.player, len(targets))['rolls']
+            lines.append(f"✨ {actor.name}: {name}")
+            for target, healed in zip(targets, rolls):
+                target.hp = min(target.hp_max, target.hp + max(1, healed))
+                lines.append(f"  → {target.name}: {target.hp}/{target.hp_max} HP")
+        
+        ability_tracker.use(user_id, ability)
+        actor.mp -= cost
+        return lines
+    
+    def _enemy_turn(self, battle: Battle, enemy: Combatant) -> str:
+        if enemy.frightened:
+            enemy.frightened = False
+            return f"👻 {enemy.name} тремтить від страху і пропускає хід"
+        enemy_data = ENEMIES[enemy.enemy]
+        target = random.choice([player for player in battle.side(True) if player.alive])
+        natural = DiceRoller.roll('d20')
+        attack = natural + enemy_data['attack']
+        text = f"🩸 {enemy.name} → {target.name}: {attack} проти {target.defense}"
+        if natural == 1 or (natural != 20 and attack < target.defense):
+            return f"{text} - промах"
+        damage = max(1, DiceRoller.roll(enemy_data['damage'])) * (2 if natural == 20 else 1)
+        guard = battle.combatants.get(target.guarded_by) if target.guarded_by else None
+        target.guarded_by = None
+        if guard is not None and guard.alive:
+            text += f", але удар приймає {guard.name}"
+            target = guard
+        critical = " (критичний!)" if natural == 20 else ""
+        return f"{text} - урон {damage}{critical}. {self._damage(target, damage)}"
+    
+    def outcome(self, battle: Battle) -> Optional[str]:
+        if not any(enemy.alive for enemy in battle.side(False)):
+            return 'victory'
+        if not any(player.alive for player in battle.side(True)):
+            return 'defeat'
+        if battle.round > self.max_rounds:
+            return 'retreat'
+        return None
+    
+    def _advance(self, battle: Battle) -> List[str]:
+        """Передає хід далі; вороги ходять одразу, поки черга не дійде до живого гравця"""
+        lines = []
+        while self.outcome(battle) is None:
+            battle.turn += 1
+            if battle.turn >= len(battle.order):
+                # Новий раунд починається з першого в черзі, без ще одного зсуву
+                battle.turn = 0
+                battle.round += 1
+                self.rounds += 1
+                if self.outcome(battle) is not None:
+                    break
+            current = battle.current
+            if not current.alive:
+                continue
+            if current.player is not None:
+                break
+            lines.append(self._enemy_turn(battle, current))
+        return lines
+    
+    def render(self, battle: Battle) -> str:
+        """Стан бою або набору"""
+        if not battle.started:
+            enemies = ', '.join(enemy.name for enemy in battle.side(False))
+            players = ', '.join(player.name for player in battle.side(True))
+            return (
+                f"⚔️ Набір у бій: {enemies}\n"
+                f"👥 Гравці: {players}\n\n"
+                f"/join - приєднатися, /fight - почати бій, /flee - вийти"
+            )
+        lines = [f"⚔️ Раунд {battle.round}", "Гравці:"]
+        for index, player in enumerate(battle.side(True), 1):
+            status = f"❤️ {player.hp}/{player.hp_max}" if player.alive else "💀"
+            mana = f" 💙 {player.mp}" if player.player.mp_max else ""
+            lines.append(f" {index}. {player.name} {status}{mana}")
+        lines.append("Вороги:")
+        for enemy in battle.side(False):
+            status = f"❤️ {enemy.hp}/{enemy.hp_max}" if enemy.alive else "💀"
+            lines.append(f" {enemy.key[1:]}. {enemy.name} {status}")
+        current = battle.current
+        if current is not None and current.player is not None:
+            abilities = ', '.join(CLASSES.get(current.player.player_class, {}).get('abilities', []))
+            lines.append(f"\n👉 Хід: {current.name}\n/attack [ворог], /use <{abilities}> [ціль], /flee")
+        return '\n'.join(lines)
+    
+    async def conclude(self, battle: Battle, bot: Any) -> List[str]:
+        """Після ходу: підсумок бою, якщо він скінчився, інакше стан і таймер наступного ходу"""
+        outcome = self.outcome(battle)
+        if outcome is not None:
+            return await self.finish(battle, outcome)
+        self._watch_turn(battle, bot)
+        return [self.render(battle)]
+    
+    async def finish(self, battle: Battle, outcome: str) -> List[str]:
+        """Закриває бій і записує результат усіх гравців одним пакетом"""
+        self._cancel_timer(battle)
+        if self._battles.pop(battle.chat_id, None) is None:
+            return []
+        players = battle.side(True)
+        for player in players:
+            self._players.pop(player.player.user_id, None)
+        ability_tracker.reset_battle([player.player.user_id for player in players])
+        self.finished += 1
+        
+        lines = [self.OUTCOMES[outcome]]
+        xp = gold = 0
+        if outcome == 'victory':
+            self.victories += 1
+            enemies = [ENEMIES[enemy.enemy] for enemy in battle.side(False)]
+            xp = sum(enemy['xp'] for enemy in enemies) // len(players)
+            gold = sum(enemy['gold'] for enemy in enemies) // len(players)
+            lines.append(f"⭐ +{xp} XP, 💰 +{gold} золота кожному")
+        
+        # XP і золото могли змінитись поза боєм, тож нагорода - приріст, а не нове значення
+        deltas = {key: value for key, value in (('xp', xp), ('gold', gold)) if value}
+        results = {
+            combatant.player.user_id: ({'hp_current': max(1, combatant.hp), 'mp_current': combatant.mp}, deltas)
+            for combatant in players
+        }
+        if self.outbox is not None:
+            # Гравці закріплені за своїми обробниками: підсумок запише власник гравця
+            for user_id, (fields, player_deltas) in results.items():
+                self.outbox.put({'player_result': {'user_id': user_id, 'fields': fields, 'deltas': player_deltas}})
+            self.forwarded += len(results)
+            return lines
+        
+        result = await GoogleSheetsAPI.settle_players(results)
+        self.writes += 1
+        if not result.get("success"):
+            self.write_errors += 1
+            logger.error(f"Не вдалося записати результат бою в чаті {battle.chat_id}: {result.get('error')}")
+            lines.append("⚠️ Результат бою не вдалося зберегти")
+        return lines
+    
+    async def stop(self):
+        """При зупинці записує HP і ману учасників незавершених боїв"""
+        # Інші обробники теж зупиняються і пересланого вже не приймуть
+        self.outbox = None
+        for battle in list(self._battles.values()):
+            if battle.started:
+                await self.finish(battle, 'retreat')
+    
+    def _watch_turn(self, battle: Battle, bot: Any):
+        """Таймер ходу: хто не походив вчасно, пропускає хід"""
+        self._cancel_timer(battle)
+        if self.turn_timeout > 0:
+            battle.timer = asyncio.get_running_loop().call_later(
+                self.turn_timeout, self._on_timeout, battle, battle.current.key, bot
+            )
+    
+    @staticmethod
+    def _cancel_timer(battle: Battle):
+        if battle.timer is not None:
+            battle.timer.cancel()
+            battle.timer = None
+    
+    def _on_timeout(self, battle: Battle, key: str, bot: Any):
+        battle.timer = None
+        if self._battles.get(battle.chat_id) is not battle or battle.current.key != key:
+            return
+        self.timeouts += 1
+        lines = [f"⌛ {battle.current.name} не походив вчасно - хід пропущено"] + self._advance(battle)
+        task = asyncio.create_task(self._report_timeout(battle, lines, bot))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _report_timeout(self, battle: Battle, lines: List[str], bot: Any):
+        try:
+            lines += await self.conclude(battle, bot)
+            await bot.send_message(battle.chat_id, '\n'.join(lines))
+        except Exception as e:
+            logger.error(f"Помилка пропуску ходу в чаті {battle.chat_id}: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'active': len(self._battles),
+            'players': len(self._players),
+            'started': self.started,
+            'finished': self.finished,
+            'victories': self.victories,
+            'rounds': self.rounds,
+            'actions': self.actions,
+            'timeouts': self.timeouts,
+            'writes': self.writes,
+            'write_errors': self.write_errors,
+            'forwarded': self.forwarded
+        }
+
+battle_manager = BattleManager(BATTLE_TURN_TIMEOUT, BATTLE_MAX_ROUNDS, BATTLE_MAX_PLAYERS)
+
+def build_action_keyboard(dice_info: Dict[str, Any], player: Player, turn_id: int = 0) -> InlineKeyboardMarkup:
+    """Формує кнопки кубика та підказки під відповіддю GPT; turn_id - номер ходу, до якого належить кидок"""
+    keyboard = []
+    
+    # Кнопка кубика якщо потрібна
+    if dice_info.get("type") != "none" and dice_info.get("type"):
+        dice_type = dice_info["type"]
+        modifier_stat = dice_info.get("modifier_stat", "")
+        
+        if modifier_stat and modifier_stat != "none":
+            modifier = player.modifier(modifier_stat)
+            mod_str = f"+{modifier_stat}({modifier:+d})" if modifier != 0 else f"+{modifier_stat}"
+            dice_text = f"🎲 {dice_type}{mod_str}"
+            dice_callback = f"roll_{dice_type}+{modifier_stat}@{turn_id}"
+        else:
+            dice_text = f"🎲 {dice_type}"
+            dice_callback = f"roll_{dice_type}@{turn_id}"
+        
+        keyboard.append([InlineKeyboardButton(dice_text, callback_data=dice_callback)])
+    
+    # Кнопка підказки (завжди)
+    keyboard.append([InlineKeyboardButton("💡 Підказка", callback_data="show_hint")])
+    
+    return InlineKeyboardMarkup(keyboard)
+
+def format_gm_response(main_response: str, dice_info: Dict[str, Any]) -> str:
+    """Текст відповіді з інформацією про складність якщо є кубик"""
+    if dice_info.get("difficulty"):
+        return f"{main_response}\n\n🎯 Складність: {dice_info['difficulty']}"
+    return main_response
+
+class StreamingMessageEditor:
+    """Поступово редагує повідомлення "думаю" текстом з потоку GPT"""
+    
+    def __init__(self, message: Message, player: Player, turn_id: int = 0):
+        self.message = message
+        self.player = player
+        self.turn_id = turn_id
+        self.started_at = time.monotonic()
+        self.first_text_at: Optional[float] = None
+        self._last_edit_at = 0.0
+        self._shown_text = ""
+        self._keyboard: Optional[InlineKeyboardMarkup] = None
+        self._keyboard_shown = False
+        self._latest_text = ""
+        self._pump: Optional[asyncio.Task] = None
+    
+    async def _edit(self, text: str, reply_markup: Optional[InlineKeyboardMarkup],
+                    wait_on_limit: bool = False) -> bool:
+        try:
+            await self.message.edit_text(text, reply_markup=reply_markup)
+        except RetryAfter as e:
+            logger.warning(f"Обмеження частоти редагувань: {e.retry_after}s")
+            if not wait_on_limit:
+                # Проміжне оновлення просто пропускаємо
+                return False
+            await asyncio.sleep(e.retry_after)
+            return await self._edit(text, reply_markup)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.error(f"Помилка редагування повідомлення: {e}")
+                return False
+        self._last_edit_at = time.monotonic()
+        return True
+    
+    def on_progress(self, parser: StreamingJSONParser):
+        """Викликається на кожному фрагменті потоку; редагування йде окремою задачею"""
+        if self._keyboard is None and parser.dice_required is not None:
+            self._keyboard = build_action_keyboard(parser.dice_required, self.player, self.turn_id)
+        self._latest_text = parser.main_response.strip()
+        # Поки попереднє редагування триває, нові фрагменти лише оновлюють текст
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._push())
+    
+    async def _push(self):
+        """Показує найсвіжіший текст, доки він росте"""
+        while True:
+            text = self._latest_text
+            grew = len(text) - len(self._shown_text) >= STREAM_MIN_CHARS
+            keyboard_ready = self._keyboard is not None and not self._keyboard_shown
+            if not text or not (grew or keyboard_ready):
+                return
+            # Перший текст показуємо одразу, далі не частіше ніж раз на інтервал
+            wait = STREAM_EDIT_INTERVAL - (time.monotonic() - self._last_edit_at)
+            if self._shown_text and wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            keyboard = self._keyboard
+            if not await self._edit(text + " ▌", keyboard):
+                return
+            if self.first_text_at is None:
+                self.first_text_at = time.monotonic()
+                logger.info(f"Перший текст відповіді через {self.first_text_at - self.started_at:.2f}s")
+            self._shown_text = text
+            self._keyboard_shown = keyboard is not None
+    
+    async def stop(self):
+        """Зупиняє проміжні редагування"""
+        if self._pump is not None and not self._pump.done():
+            self._pump.cancel()
+            try:
+                await self._pump
+            except asyncio.CancelledError:
+                pass
+        self._pump = None
+    
+    async def finish(self, gpt_response: Dict[str, Any]):
+        """Показує фінальну відповідь з кнопками"""
+        # Запізніле проміжне редагування не повинно перекрити фінальний текст
+        await self.stop()
+        dice_info = gpt_response.get("dice_required") or {}
+        await self._edit(
+            format_gm_response(gpt_response["main_response"], dice_info),
+            build_action_keyboard(dice_info, self.player, self.turn_id),
+            wait_on_limit=True
+        )
+        logger.info(f"Відповідь GPT повністю показана через {time.monotonic() - self.started_at:.2f}s")
+
+class MessageDebouncer:
+    """Зливає швидкі послідовні повідомлення гравця в один хід Майстра гри"""
+    
+    def __init__(self, window: float):
+        self.window = window
+        # user_id -> {'texts', 'timer', 'turn', 'turn_texts'}
+        self._states: Dict[int, Dict[str, Any]] = {}
+        self.merged = 0
+        self.cancelled = 0
+    
+    def submit(self, user_id: int, text: str, start_turn: Callable[[str], Awaitable[None]],
+               spawn: Callable[[Awaitable[None]], asyncio.Task] = asyncio.create_task):
+        """Додає повідомлення і перезапускає вікно очікування; spawn запускає сам хід"""
+        state = self._states.setdefault(user_id, {'texts': [], 'timer': None, 'turn': None, 'turn_texts': []})
+        state['texts'].append(text)
+        if state['timer'] is not None:
+            state['timer'].cancel()
+            self.merged += 1
+        # Хід запускає останнє повідомлення - відповідь прийде під ним
+        state['timer'] = asyncio.create_task(self._fire(user_id, start_turn, spawn))
+    
+    async def _fire(self, user_id: int, start_turn: Callable[[str], Awaitable[None]],
+                    spawn: Callable[[Awaitable[None]], asyncio.Task]):
+        await asyncio.sleep(self.window)
+        state = self._states[user_id]
+        state['timer'] = None
+        texts, state['texts'] = state['texts'], []
+        
+        # Гравець дописав дію, поки попередній хід ще обробляється -
+        # скасовуємо його і відповідаємо на все разом
+        turn = state['turn']
+        if turn is not None and not turn.done():
+            turn.cancel()
+            self.cancelled += 1
+            texts = state['turn_texts'] + texts
+            try:
+                await turn
+            except asyncio.CancelledError:
+                pass
+        
+        state['turn_texts'] = texts
+        state['turn'] = spawn(start_turn('\n'.join(texts)))
+        state['turn'].add_done_callback(lambda task: self._cleanup(user_id, task))
+    
+    def _cleanup(self, user_id: int, task: asyncio.Task):
+        """Прибирає стан гравця, коли нічого не очікує"""
+        state = self._states.get(user_id)
+        if state is None or state['turn'] is not task:
+            return
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Помилка ходу гравця {user_id}: {task.exception()}")
+        if not state['texts'] and state['timer'] is None:
+            del self._states[user_id]
+    
+    def pending(self, user_id: int) -> bool:
+        """Чи чекає гравець ще на злиття своїх повідомлень"""
+        state = self._states.get(user_id)
+        return state is not None and state['timer'] is not None
+    
+    def stats(self) -> Dict[str, Any]:
+        return {'active_users': len(self._states), 'merged': self.merged, 'cancelled': self.cancelled}
+
+message_debouncer = MessageDebouncer(MESSAGE_DEBOUNCE)
+
+# Підписи характеристик для /stats
+STAT_LABELS = {
+    'str': '💪 Сила', 'dex': '🏃 Спритність', 'con': '🛡️ Витривалість',
+    'int': '🧠 Інтелект', 'wis': '👁️ Мудрість', 'cha': '😊 Харизма'
+}
+
+def render_stats_view(player: Player) -> str:
+    """Текст /stats з модифікаторами"""
+    lines = [
+        "📊 **ХАРАКТЕРИСТИКИ ПЕРСОНАЖА**\n",
+        f"👤 **{player.name}** ({player.class_name})",
+        f"⭐ Рівень: {player.level} (XP: {player.xp})\n",
+        f"❤️ **Здоров'я:** {player.hp_current}/{player.hp_max}",
+        f"💙 **Мана:** {player.mp_current}/{player.mp_max}",
+        f"💰 **Золото:** {player.gold}\n",
+        "**Основні характеристики:**",
+    ]
+    lines.extend(
+        f"{STAT_LABELS[stat]}: {value} ({modifier:+d})"
+        for stat, value, modifier in zip(STAT_ORDER, player.stats, player.modifiers)
+    )
+    return "\n".join(lines) + "\n"
+
+def render_inventory_view(player: Player) -> str:
+    """Текст /inventory"""
+    return "🎒 **ІНВЕНТАР**\n\n" + "".join(f"• {item_name}\n" for item_name in inventory_names(player.inventory))
+
+def render_abilities_view(class_key: str) -> str:
+    """Текст /abilities для класу"""
+    lines = ["⚡ **СПЕЦІАЛЬНІ ЗДІБНОСТІ**\n"]
+    for ability in CLASSES.get(class_key, {}).get('abilities', []):
+        ability_data = ABILITIES.get(ability, {'name': ability})
+        lines.append(f"🔸 **{ability_data['name']}**")
+        if 'mp_cost' in ability_data:
+            lines.append(f"   💙 Вартість: {ability_data['mp_cost']} MP")
+        if 'uses_per_battle' in ability_data:
+            lines.append(f"   ⚔️ Використань за бій: {ability_data['uses_per_battle']}")
+        if 'uses_per_day' in ability_data:
+            lines.append(f"   📅 Використань за день: {ability_data['uses_per_day']}")
+        if 'damage' in ability_data:
+            lines.append(f"   💥 Урон: {ability_data['damage']}")
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+ABILITIES_VIEWS = {class_key: render_abilities_view(class_key) for class_key in CLASSES}
+
+async def require_player(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[Player]:
+    """Гравець для команди; якщо його немає або сховище не відповідає - пояснює гравцю"""
+    player_data = await GoogleSheetsAPI.get_player(update.effective_user.id, context.user_data.get('player_data'))
+    if not player_data.get("success"):
+        # Таймаут сховища - це не "персонажа немає"
+        await update.message.reply_text(UNAVAILABLE_MESSAGE)
+        return None
+    if not player_data.get("player"):
+        await update.message.reply_text("❌ Спочатку створіть персонажа командою /start")
+        return None
+    if not player_data.get("stale"):
+        context.user_data['player_data'] = player_data["player"]
+    return player_data["player"]
+
+# Обробники команд
+@instrumented
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /start"""
+    request_priority.set(PRIORITY_INTERACTIVE)
+    user_id = update.effective_user.id
+    
+    # Перевіряємо чи гравець вже існує
+    player_data = await GoogleSheetsAPI.get_player(user_id, context.user_data.get('player_data'))
+    
+    if not player_data.get("success"):
+        # Не знаємо, чи є персонаж - не пропонуємо створити нового поверх існуючого
+        await update.message.reply_text(UNAVAILABLE_MESSAGE)
+    elif player_data.get("player"):
+        player = player_data["player"]
+        await update.message.reply_text(
+            f"🎮 Вітаю знову, {player.name}!\n"
+            f"🛡️ Клас: {player.class_name}\n"
+            f"❤️ HP: {player.hp_current}/{player.hp_max}\n"
+            f"💙 MP: {player.mp_current}/{player.mp_max}\n"
+            f"⭐ Рівень: {player.level} (XP: {player.xp})\n"
+            f"💰 Золото: {player.gold}\n\n"
+            f"Готовий до пригод? Напиши що хочеш зробити!\n\n"
+            f"Доступні команди:\n"
+            f"/stats - характеристики персонажа\n"
+            f"/inventory - інвентар\n"
+            f"/abilities - спеціальні здібності\n"
+            f"/help - довідка"
+        )
+    else:
+        # Показуємо кнопки вибору класу
+        keyboard = []
+        for class_key, class_data in CLASSES.items():
+            keyboard.append([InlineKeyboardButton(class_data['name'], callback_data=f"class_{class_key}")])
+        
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(
+            "🏰 Ласкаво просимо до RPG пригоди!\n\n"
+            "🎯 **Виберіть клас свого персонажа:**\n\n"
+            "🛡️ **Лицар** - сильний воїн з мечем і щитом\n"
+            "🧙‍♂️ **Маг** - володар магії та заклинань\n"
+            "🏹 **Лучник** - майстер стрільби та виживання\n"
+            "🗡️ **Злодій** - скритний та спритний\n"
+            "⚕️ **Жрець** - цілитель та захисник від зла",
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
+
+@instrumented
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats - показати характеристики"""
+    request_priority.set(PRIORITY_INTERACTIVE)
+    player = await require_player(update, context)
+    if player is None:
+        return
+    
+    # Текст рахується один раз на версію гравця
+    await update.message.reply_text(player.memo('stats_view', render_stats_view), parse_mode='Markdown')
+
+@instrumented
+async def inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /inventory - показати інвентар"""
+    request_priority.set(PRIORITY_INTERACTIVE)
+    player = await require_player(update, context)
+    if player is None:
+        return
+    
+    if not player.inventory:
+        await update.message.reply_text("🎒 Ваш інвентар порожній!")
+        return
+    
+    await update.message.reply_text(player.memo('inventory_view', render_inventory_view), parse_mode='Markdown')
+
+@instrumented
+async def abilities(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /abilities - показати здібності"""
+    request_priority.set(PRIORITY_INTERACTIVE)
+    player = await require_player(update, context)
+    if player is None:
+        return
+    # Здібності залежать лише від класу - текст готовий з запуску
+    abilities_text = ABILITIES_VIEWS.get(player.player_class) or render_abilities_view(player.player_class)
+    
+    await update.message.reply_text(abilities_text, parse_mode='Markdown')
+
+@instrumented
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /help - довідка"""
+    help_text = """
+🎮 **RPG BOT - ДОВІДКА**
+
+**Основні команди:**
+/start - почати гру або показати персонажа
+/stats - характеристики персонажа
+/inventory - показати інвентар
+/abilities - спеціальні здібності
+/help - ця довідка
+
+**Групові бої:**
+/battle [ворог] [кількість] - набір у бій або стан бою
+/join - приєднатися до бою
+/fight - почати бій
+/attack [номер] - атакувати ворога
+/use здібність [ціль] - використати здібність
+/flee - вийти з набору або відступити
+
+**Як грати:**
+1. Створіть персонажа командою /start
+2. Пишіть що хочете робити звичайним текстом
+3. Натискайте кнопки кубиків коли потрібно
+4. Використовуйте кнопку "Підказка" для порад
+
+**Приклади дій:**
+• "Йду в ліс"
+• "Атакую орка мечем"  
+• "Шукаю скарби"
+• "Розмовляю з торговцем"
+• "Використовую зілля лікування"
+
+**Система кубиків:**
+• d20 - основні перевірки
+• d6, d8, d10 - урон від зброї
+• Модифікатори від характеристик
+
+**Характеристики:**
+💪 Сила - рукопашний бій, підйом важких речей
+🏃 Спритність - стрільба, ухилення, скрадання  
+🛡️ Витривалість - здоров'я, опір хворобам
+🧠 Інтелект - магія, знання
+👁️ Мудрість - інтуїція, сприйняття
+😊 Харизма - переконання, торгівля
+
+Приємної гри! 🎲
+"""
+    
+    await update.message.reply_text(help_text, parse_mode='Markdown')
+
+def battle_target(args: List[str]) -> Optional[int]:
+    """Номер цілі з аргументів команди"""
+    return int(args[0]) if args and args[0].isdigit() else None
+
+@instrumented
+async def battle_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /battle [ворог] [кількість] - набір у бій або стан поточного бою"""
+    request_priority.set(PRIORITY_INTERACTIVE)
+    battle = battle_manager.get(update.effective_chat.id)
+    if battle is not None:
+        await update.message.reply_text(battle_manager.render(battle))
+        return
+    
+    args = context.args or []
+    enemy = args[0].lower() if args else 'goblin'
+    count = min(6, max(1, int(args[1]))) if len(args) > 1 and args[1].isdigit() else 1
+    player = await require_player(update, context)
+    if player is None:
+        return
+    await ability_tracker.ensure(player)
+    try:
+        battle = battle_manager.open(update.effective_chat.id, enemy, count, player)
+    except BattleError as e:
+        await update.message.reply_text(str(e))
+        return
+    await update.message.reply_text(battle_manager.render(battle))
+
+@instrumented
+async def join_battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /join - приєднатися до набору в бій"""
+    request_priority.set(PRIORITY_INTERACTIVE)
+    battle = battle_manager.get(update.effective_chat.id)
+    if battle is None:
+        await update.message.reply_text("⚔️ Тут немає набору в бій. Почніть його командою /battle")
+        return
+    player = await require_player(update, context)
+    if player is None:
+        return
+    await ability_tracker.ensure(player)
+    try:
+        battle_manager.join(battle, player)
+    except BattleError as e:
+        await update.message.reply_text(str(e))
+        return
+    await update.message.reply_text(battle_manager.render(battle))
+
+@instrumented
+async def start_fight(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /fight - кидок ініціативи і перший раунд"""
+    request_priority.set(PRIORITY_INTERACTIVE)
+    battle = battle_manager.get(update.effective_chat.id)
+    if battle is None or f'p{update.effective_user.id}' not in battle.combatants:
+        await update.message.reply_text("⚔️ Почати бій може лише його учасник")
+        return
+    try:
+        lines = battle_manager.begin(battle)
+    except BattleError as e:
+        await update.message.reply_text(str(e))
+        return
+    lines += await battle_manager.conclude(battle, context.bot)
+    await update.message.reply_text('\n'.join(lines))
+
+@instrumented
+async def battle_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команди /attack [ворог] і /use <здібність> [ціль] - хід гравця в бою"""
+    request_priority.set(PRIORITY_INTERACTIVE)
+    battle = battle_manager.get(update.effective_chat.id)
+    if battle is None:
+        await update.message.reply_text("⚔️ Тут зараз немає бою")
+        return
+    
+    args = context.args or []
+    ability = None
+    if update.message.text.startswith('/use'):
+        ability = BattleManager.parse_ability(args[0]) if args else None
+        if ability is None:
+            await update.message.reply_text("❓ Вкажіть здібність: /use <назва> [ціль]. Список - /abilities")
+            return
+        args = args[1:]
+    try:
+        lines = battle_manager.act(battle, update.effective_user.id, ability, battle_target(args))
+    except BattleError as e:
+        await update.message.reply_text(str(e))
+        return
+    lines += await battle_manager.conclude(battle, context.bot)
+    await update.message.reply_text('\n'.join(lines))
+
+@instrumented
+async def flee_battle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /flee - вийти з набору або відступити з бою всім загоном"""
+    request_priority.set(PRIORITY_INTERACTIVE)
+    battle = battle_manager.get(update.effective_chat.id)
+    if battle is None or f'p{update.effective_user.id}' not in battle.combatants:
+        await update.message.reply_text("⚔️ Ви не берете участі в бою в цьому чаті")
+        return
+    if not battle.started:
+        if battle_manager.leave(battle, update.effective_user.id):
+            await update.message.reply_text("🚪 Набір у бій скасовано")
+        else:
+            await update.message.reply_text(battle_manager.render(battle))
+        return
+    lines = await battle_manager.finish(battle, 'flee')
+    await update.message.reply_text('\n'.join(lines))
+
+@instrumented
+async def handle_class_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обробка вибору класу"""
+    query = update.callback_query
+    await query.answer()
+    request_priority.set(PRIORITY_INTERACTIVE)
+    
+    class_chosen = query.data.replace("class_", "")
+    user_id = query.from_user.id
+    user_name = query.from_user.first_name or "Герой"
+    
+    # Створюємо гравця
+    result = await GoogleSheetsAPI.create_player(user_id, user_name, class_chosen)
+    
+    if result.get("success"):
+        conversation_memory.reset(context.user_data)
+        class_data = CLASSES[class_chosen]
+        await query.edit_message_text(
+            f"🎉 **Персонаж створено!**\n\n"
+            f"👤 **Ім'я:** {user_name}\n"
+            f"🛡️ **Клас:** {class_data['name']}\n"
+            f"❤️ **HP:** {class_data['hp_base']}\n"
+            f"💙 **MP:** {class_data['mp_base']}\n"
+            f"💰 **Золото:** {class_data['gold']}\n"
+            f"🎒 **Спорядження:** {', '.join(inventory_names(CLASS_STARTING_INVENTORY[class_chosen]))}\n\n"
+            f"🎮 **Ваша пригода починається!**\n"
+            f"Напишіть що хочете зробити, наприклад:\n"
+            f"• 'Йду досліджувати ліс'\n"
+            f"• 'Шукаю пригоди в таверні'\n"
+            f"• 'Треную свої навички'\n\n"
+            f"💡 Використовуйте /help для довідки!",
+            parse_mode='Markdown'
+        )
+    else:
+        await query.edit_message_text(
+            f"❌ Помилка створення персонажа: {result.get('error', 'Невідома помилка')}"
+        )
+
+def coerce_reward(value: Any, limit: int) -> int:
+    """Нагорода з відповіді GPT як ціле в межах 0..limit"""
+    try:
+        return max(0, min(limit, int(value)))
+    except (TypeError, ValueError):
+        return 0
+
+async def session_player(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> Optional[Player]:
+    """Гравець з кешу або сесії; до сховища йдемо лише якщо локальних даних немає"""
+    player = player_cache.peek(user_id) or context.user_data.get('player_data')
+    if player is not None:
+        return player
+    player_data = await GoogleSheetsAPI.get_player(user_id)
+    return player_data.get("player") if player_data.get("success") else None
+
+def resolve_dice_roll(dice_info: str, player: Player, session: Dict[str, Any],
+                      turn_id: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+    """Кидок за кнопкою проти складності з останньої відповіді GPT: текст і зміни гравця
+    
+    Наслідки й нагороди - лише якщо кнопка належить останньому ходу (turn_id).
+    """
+    if '+' in dice_info:
+        dice_type, modifier_info = dice_info.split('+', 1)
+        # Модифікатор числом або від характеристики
+        modifier = int(modifier_info) if modifier_info.isdigit() else player.modifier(modifier_info)
+    else:
+        dice_type = dice_info
+        modifier = 0
+    
+    roll_result = DiceRoller.roll(dice_type)
+    total = roll_result + modifier
+    mod_str = f"+{modifier}" if modifier >= 0 else str(modifier)
+    lines = [f"🎯 {dice_type}{mod_str} = {roll_result}{mod_str} = **{total}**"]
+    
+    gpt_response = session.get('last_gpt_response') or {}
+    dice_required = gpt_response.get('dice_required') or {}
+    pending = dice_required.get('type') not in (None, '', 'none')
+    stale = pending and (turn_id is None or turn_id != session.get('turn_id'))
+    pending = pending and not stale
+    try:
+        difficulty = int(dice_required.get('difficulty') or 15)
+    except (TypeError, ValueError):
+        difficulty = 15
+    if pending:
+        lines[0] += f" проти {difficulty}"
+    
+    critical = dice_type == 'd20' and roll_result in (1, 20)
+    success = roll_result == 20 if critical else total >= difficulty
+    if critical:
+        lines.append("🎯 **КРИТИЧНИЙ УСПІХ!**" if success else "💥 **КРИТИЧНА НЕВДАЧА!**")
+    else:
+        lines.append("✅ **УСПІХ!**" if success else "❌ **НЕВДАЧА**")
+    if stale:
+        lines.append("⌛ Ця кнопка від попереднього ходу - кидок без наслідків і нагород.")
+    
+    # Наслідки й нагороди - лише за кидок, якого чекав Майстер гри, і лише один раз
+    updates: Dict[str, Any] = {}
+    if pending:
+        outcome = (gpt_response.get('consequences') or {}).get('success' if success else 'failure')
+        if outcome:
+            lines.append(outcome)
+        if success:
+            damage_dice = dice_required.get('damage_dice')
+            if damage_dice and damage_dice != 'none':
+                if not DiceRoller.is_valid(str(damage_dice)):
+                    damage_dice = DiceRoller.DEFAULT_DAMAGE
+                damage = max(1, DiceRoller.roll(damage_dice) * (2 if critical else 1))
+                lines.append(f"⚔️ Урон: {damage}{' (критичний!)' if critical else ''}")
+            xp = coerce_reward(gpt_response.get('xp_reward'), 50)
+            gold = coerce_reward(gpt_response.get('gold_reward'), 20)
+            if xp:
+                updates['xp'] = player.xp + xp
+                lines.append(f"⭐ +{xp} XP")
+            if gold:
+                updates['gold'] = player.gold + gold
+                lines.append(f"💰 +{gold} золота")
+        elif critical:
+            # Критична невдача боляче б'є, але не вбиває
+            hp = max(1, player.hp_current - DiceRoller.roll('d4'))
+            if hp < player.hp_current:
+                updates['hp_current'] = hp
+                lines.append(f"❤️ −{player.hp_current - hp} HP ({hp}/{player.hp_max})")
+        # Відповідь може бути спільною з кешем GPT - не змінюємо її на місці;
+        # нагороди видано, тож і в сесії їх більше немає
+        session['last_gpt_response'] = dict(gpt_response, dice_required={'type': 'none'}, xp_reward=0, gold_reward=0)
+    
+    return "\n\n".join(lines), updates
+
+@instrumented
+async def handle_dice_roll(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обробка кидання кубиків"""
+    query = update.callback_query
+    await query.answer()
+    request_priority.set(PRIORITY_INTERACTIVE)
+    
+    user_id = query.from_user.id
+    dice_data = query.data
+    
+    # Парсимо дані кубика
+    if dice_data.startswith('roll_'):
+        dice_info, _, turn = dice_data.replace('roll_', '').partition('@')
+        turn_id = int(turn) if turn.isdigit() else None
+        
+        # Кидок вирішується з даних сесії, мережа потрібна лише якщо їх немає
+        player = await session_player(user_id, context)
+        if player is None:
+            await query.edit_message_text("❌ Помилка отримання даних гравця")
+            return
+        
+        result_text, updates = resolve_dice_roll(dice_info, player, context.user_data, turn_id)
+        if updates:
+            # Запис у сховище йде у фоні - кнопка не чекає на мережу
+            player = GoogleSheetsAPI.update_player_in_background(user_id, updates) or player.with_updates(updates)
+        context.user_data['player_data'] = player
+        
+        await query.edit_message_text(
+            f"🎲 **Кидок кубика**\n\n"
+            f"{result_text}\n\n"
+            f"Що робите далі?"
+        )
+
+@instrumented
+async def handle_hint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обробка запиту підказки"""
+    query = update.callback_query
+    await query.answer()
+    
+    # Отримуємо збережену підказку з контексту
+    hint = context.user_data.get('last_hint', 'Підказка недоступна')
+    
+    await query.edit_message_text(
+        f"💡 **ПІДКАЗКА**\n\n{hint}\n\n"
+        f"Що робите далі?",
+        parse_mode='Markdown'
+    )
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обробка звичайних повідомлень від гравців"""
+    user_id = update.effective_user.id
+    
+    # Рутинна дія відповідає одразу, без вікна злиття, якщо гравець не дописує іншу дію
+    if (fast_path.enabled and not message_debouncer.pending(user_id)
+            and fast_path.match(update.message.text, context.user_data) is not None):
+        context.application.create_task(run_fast_path(update, context, update.message.text), update=update)
+        return
+    
+    # Кілька повідомлень поспіль стають однією дією; одночасно йде лише один хід.
+    # Хід - задача Application: після неї PTB зберігає user_data і передає помилки
+    # в handle_error, а час вимірює сам run_gm_turn
+    message_debouncer.submit(
+        user_id,
+        update.message.text,
+        lambda action: run_gm_turn(update, context, action),
+        lambda turn: context.application.create_task(turn, update=update)
+    )
+
+@instrumented
+async def run_fast_path(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
+    """Рутинна дія без Майстра гри; якщо її вже не можна виконати локально - звичайний хід"""
+    request_priority.set(PRIORITY_INTERACTIVE)
+    try:
+        player = await require_player(update, context)
+    except BackendBusy:
+        await update.message.reply_text(BUSY_MESSAGE)
+        return
+    if player is None:
+        return
+    if not await fast_path.try_handle(update, context, player, user_message):
+        await run_gm_turn(update, context, user_message)
+
+@instrumented
+async def run_gm_turn(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
+    """Один хід Майстра гри у відповідь на дію гравця"""
+    user_id = update.effective_user.id
+    request_priority.set(PRIORITY_NARRATIVE)
+    
+    # Отримуємо дані гравця
+    try:
+        player = await require_player(update, context)
+    except BackendBusy:
+        await update.message.reply_text(BUSY_MESSAGE)
+        return
+    if player is None:
+        return
+    
+    # Рутинні дії над відомими даними не потребують Майстра гри
+    if await fast_path.try_handle(update, context, player, user_message):
+        return
+    
+    # Показуємо що бот думає
+    thinking_message = await update.message.reply_text("🤔 Аналізую вашу дію...")
+    # Кнопки кидка прив'язані до ходу: кнопка зі старого повідомлення нагород не дає
+    turn_id = context.user_data.get('turn_id', 0) + 1
+    editor = StreamingMessageEditor(thinking_message, player, turn_id)
+    shown = False
+    
+    try:
+        # Отримуємо відповідь від GPT потоком і показуємо текст по мірі надходження
+        story = conversation_memory.context(context.user_data)
+        gpt_response = await RPGGameLogic.stream_gpt_response(
+            user_message, player, context=story, on_progress=editor.on_progress
+        )
+        
+        # Запасну відповідь у пам'ять розмови не пишемо - Майстер нічого не вирішив
+        main_response = gpt_response.get('main_response', '')
+        if main_response and main_response != RPGGameLogic.FALLBACK_RESPONSE['main_response']:
+            conversation_memory.record(user_id, context.user_data, user_message, main_response)
+            model_router.record_action(user_id, gpt_response.get('action_type'))
+        
+        # Зберігаємо контекст для кнопок
+        context.user_data['last_gpt_response'] = gpt_response
+        context.user_data['turn_id'] = turn_id
+        hint = gpt_response.get('hint', 'Підказка недоступна')
+        odds = CombatSimulator.odds_hint(gpt_response.get('dice_required') or {}, player)
+        context.user_data['last_hint'] = f"{hint}\n\n{odds}" if odds else hint
+        context.user_data['player_data'] = player
+        
+        await editor.finish(gpt_response)
+        shown = True
+    except BackendBusy:
+        await editor.stop()
+        await thinking_message.edit_text(BUSY_MESSAGE)
+        shown = True
+    finally:
+        if not shown:
+            # Гравець дописав дію (хід скасовано) або хід впав - не лишаємо "думаю" назавжди
+            await editor.stop()
+            with contextlib.suppress(TelegramError):
+                await thinking_message.delete()
+
+async def handle_button_press(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обробка натискання кнопок"""
+    query = update.callback_query
+    
+    # На запит відповідають самі обробники кнопок
+    if query.data == "show_hint":
+        await handle_hint(update, context)
+    elif query.data.startswith("roll_"):
+        await handle_dice_roll(update, context)
+
+async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Обробка помилок обробників"""
+    if isinstance(context.error, BackendBusy):
+        logger.warning(f"Запит відхилено: {context.error}")
+        if isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text(BUSY_MESSAGE)
+        return
+    logger.error(f"Помилка обробки оновлення: {context.error}", exc_info=context.error)
+
+async def on_startup(application: Application):
+    """Запускає фонові задачі після ініціалізації бота"""
+    await storage.start()
+    await ability_tracker.start()
+    await warm_snapshot.start(application)
+    for component, collect in (
+        ('player_cache', player_cache.stats), ('gpt_cache', gpt_cache.stats), ('storage', storage.stats),
+        ('openai_scheduler', openai_scheduler.stats), ('sheets_scheduler', sheets_scheduler.stats),
+        ('message_debouncer', message_debouncer.stats), ('warm_snapshot', warm_snapshot.stats),
+        ('session_persistence', session_persistence.stats), ('battles', battle_manager.stats),
+        ('abilities', ability_tracker.stats),
+        ('sheets_breaker', sheets_breaker.stats), ('openai_breaker', openai_breaker.stats),
+        ('conversation_memory', conversation_memory.stats), ('fast_path', fast_path.stats),
+        ('model_router', model_router.stats),
+    ):
+        metrics.register_stats(component, collect)
+    await metrics.start()
+
+async def on_shutdown(application: Application):
+    """Звільняє ресурси при зупинці бота"""
+    await metrics.stop()
+    await warm_snapshot.stop()
+    logger.info(f"Знімок для теплого старту: {warm_snapshot.stats()}")
+    await battle_manager.stop()
+    await ability_tracker.stop()
+    logger.info(f"Лічильники здібностей: {ability_tracker.stats()}")
+    logger.info(f"Збереження сесій: {session_persistence.stats()}")
+    # Спочатку дописуємо відкладені зміни, поки HTTP клієнт ще відкритий
+    logger.info(f"Статистика сховища: {storage.stats()}")
+    await storage.stop()
+    logger.info(f"Статистика кешу гравців: {player_cache.stats()}")
+    logger.info(f"Статистика кешу відповідей GPT: {gpt_cache.stats()}")
+    logger.info(f"Використання токенів GPT: {RPGGameLogic.usage}")
+    logger.info(f"Вибір моделей GPT: {model_router.stats()}")
+    logger.info(f"Статистика злиття повідомлень: {message_debouncer.stats()}")
+    logger.info(f"Пам'ять розмов: {conversation_memory.stats()}")
+    logger.info(f"Локальні дії без GPT: {fast_path.stats()}")
+    logger.info(f"Групові бої: {battle_manager.stats()}")
+    logger.info(f"Черга OpenAI: {openai_scheduler.stats()}")
+    logger.info(f"Черга Google Sheets: {sheets_scheduler.stats()}")
+    logger.info(f"Запобіжники: sheets {sheets_breaker.stats()}, openai {openai_breaker.stats()}")
+    await GoogleSheetsAPI.close()
+    await openai_client.close()
+
+class HashRing:
+    """Консистентне хешування: при зміні кількості обробників переїжджає лише частина гравців"""
+    
+    def __init__(self, replicas: int = 100):
+        self.replicas = replicas
+        self._keys: List[int] = []
+        self._nodes: Dict[int, int] = {}
+    
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+    
+    def add(self, node: int):
+        for replica in range(self.replicas):
+            key = self._hash(f"worker-{node}-{replica}")
+            self._nodes[key] = node
+            bisect.insort(self._keys, key)
+    
+    def remove(self, node: int):
+        for replica in range(self.replicas):
+            key = self._hash(f"worker-{node}-{replica}")
+            if self._nodes.pop(key, None) is not None:
+                self._keys.remove(key)
+    
+    def get(self, routing_key: int) -> Optional[int]:
+        """Обробник, якому належить ключ"""
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, self._hash(str(routing_key))) % len(self._keys)
+        return self._nodes[self._keys[index]]
+
+def run_worker(index: int, queue: 'multiprocessing.Queue', outbox: 'multiprocessing.Queue'):
+    """Точка входу процесу-обробника"""
+    # Зупинкою керує диспетчер, щоб обробник встиг дописати зміни
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    
+    if METRICS_PORT:
+        metrics.port = METRICS_PORT + 1 + index
+    journal_root, journal_ext = os.path.splitext(WRITE_BEHIND_JOURNAL)
+    write_buffer.journal_path = f"{journal_root}.{index}{journal_ext}"
+    if warm_snapshot.enabled:
+        # Гравці закріплені за обробником, тож і знімок у кожного свій
+        snapshot_root, snapshot_ext = os.path.splitext(SNAPSHOT_PATH)
+        warm_snapshot.path = f"{snapshot_root}.{index}{snapshot_ext}"
+    if session_persistence.enabled:
+        session_root, session_ext = os.path.splitext(SESSION_DB_PATH)
+        session_persistence.path = f"{session_root}.{index}{session_ext}"
+    if isinstance(storage, SQLiteStorage):
+        # База спільна для всіх обробників, у таблицю її дзеркалить лише перший
+        storage.replicate = index == 0
+    # Підсумки боїв пересилаються обробникам, яким належать гравці
+    battle_manager.outbox = outbox
+    
+    application = build_application(with_updater=False)
+    asyncio.run(worker_loop(index, application, queue))
+
+async def worker_loop(index: int, application: Application, queue: 'multiprocessing.Queue'):
+    """Обробляє оновлення, які диспетчер надсилає в чергу процесу"""
+    loop = asyncio.get_running_loop()
+    incoming: asyncio.Queue = asyncio.Queue()
+    
+    def read_queue():
+        # Черга multiprocessing блокуюча, тому читаємо її в окремому потоці
+        while True:
+            item = queue.get()
+            loop.call_soon_threadsafe(incoming.put_nowait, item)
+            if item is None:
+                return
+    
+    threading.Thread(target=read_queue, daemon=True).start()
+    settling: set = set()
+    
+    async with application:
+        await on_startup(application)
+        await application.start()
+        logger.info(f"Обробник {index} запущений (pid {os.getpid()})")
+        
+        while True:
+            data = await incoming.get()
+            if data is None:
+                break
+            if 'player_result' in data:
+                # Підсумок бою з іншого обробника - пишемо як власник гравця
+                result = data['player_result']
+                task = asyncio.create_task(GoogleSheetsAPI.settle_players(
+                    {result['user_id']: (result['fields'], result['deltas'])}
+                ))
+                settling.add(task)
+                task.add_done_callback(settling.discard)
+                continue
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        
+        if settling:
+            await asyncio.wait(settling)
+        await application.stop()
+        await on_shutdown(application)
+    logger.info(f"Обробник {index} зупинений")
+
+class WorkerPool:
+    """Процеси-обробники, між якими оновлення розподіляються за user_id"""
+    
+    # Команди групового бою: бій живе в пам'яті обробника, закріпленого за чатом
+    BATTLE_COMMANDS = ('battle', 'join', 'fight', 'attack', 'use', 'flee')
+    
+    def __init__(self, size: int):
+        self.size = size
+        self.ring = HashRing()
+        self._context = multiprocessing.get_context('spawn')
+        self._processes: Dict[int, multiprocessing.Process] = {}
+        self._queues: Dict[int, 'multiprocessing.Queue'] = {}
+        # Від обробників до диспетчера: підсумки боїв для власників гравців
+        self._outbox = self._context.Queue()
+        self._supervisor: Optional[asyncio.Task] = None
+        self.restarts = 0
+        self.forwarded = 0
+    
+    def _spawn(self, index: int):
+        queue = self._context.Queue()
+        process = self._context.Process(target=run_worker, args=(index, queue, self._outbox),
+                                        name=f"rpg-worker-{index}")
+        process.start()
+        self._queues[index] = queue
+        self._processes[index] = process
+        self.ring.add(index)
+    
+    def start(self):
+        for index in range(self.size):
+            self._spawn(index)
+    
+    @staticmethod
+    def routing_key(update: Update) -> int:
+        """Груповий бій або гравець, до якого належить оновлення
+        
+        Групові бої живуть у пам'яті процесу за chat_id, тому команди бою з групи
+        (/join, /attack учасників) мають потрапляти в один обробник. Решта оновлень
+        іде власнику гравця, щоб його кеш і записи були лише в одному процесі.
+        """
+        chat = update.effective_chat
+        message = update.effective_message
+        if (chat is not None and chat.type in (Chat.GROUP, Chat.SUPERGROUP)
+                and message is not None and message.text and message.text.startswith('/')):
+            command = message.text.split()[0][1:].split('@')[0].lower()
+            if command in WorkerPool.BATTLE_COMMANDS:
+                return chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        if chat is not None:
+            return chat.id
+        return update.update_id
+    
+    def dispatch(self, data: Dict[str, Any], routing_key: int) -> bool:
+        index = self.ring.get(routing_key)
+        if index is None:
+            logger.error("Немає живих обробників, оновлення відкинуто")
+            return False
+        self._queues[index].put(data)
+        return True
+    
+    def _forward_results(self, loop: asyncio.AbstractEventLoop):
+        """Пересилає підсумки боїв обробникам, яким належать гравці"""
+        while True:
+            data = self._outbox.get()
+            if data is None:
+                return
+            loop.call_soon_threadsafe(self._forward, data)
+    
+    def _forward(self, data: Dict[str, Any]):
+        if self.dispatch(data, data['player_result']['user_id']):
+            self.forwarded += 1
+    
+    def _restart(self, index: int):
+        """Перезапускає впалий обробник, не втрачаючи оновлень з його черги"""
+        self.ring.remove(index)
+        old_queue = self._queues.pop(index)
+        self.restarts += 1
+        logger.error(f"Обробник {index} впав (код {self._processes[index].exitcode}), перезапускаю")
+        self._spawn(index)
+        while True:
+            try:
+                data = old_queue.get_nowait()
+            except Exception:
+                break
+            if data is not None:
+                self._queues[index].put(data)
+    
+    async def _supervise(self, interval: float = 2.0):
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in list(self._processes.items()):
+                if not process.is_alive():
+                    self._restart(index)
+    
+    def start_supervisor(self):
+        """Стежить за обробниками і перезапускає впалі"""
+        self._supervisor = asyncio.create_task(self._supervise())
+        threading.Thread(target=self._forward_results, args=(asyncio.get_running_loop(),), daemon=True).start()
+    
+    async def shutdown(self):
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+        await asyncio.to_thread(self.stop)
+    
+    def stop(self, timeout: float = 20.0):
+        """Просить обробники завершитись і чекає, поки вони допишуть зміни"""
+        self._outbox.put(None)
+        for queue in self._queues.values():
+            queue.put(None)
+        deadline = time.monotonic() + timeout
+        for index, process in self._processes.items():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error(f"Обробник {index} не завершився вчасно, зупиняю примусово")
+                process.terminate()
+
+def register_handlers(application: Application):
+    """Додає обробники команд, кнопок і повідомлень"""
+    # Раніше за всі обробники: сесія гравця зі знімка попереднього запуску
+    application.add_handler(TypeHandler(Update, warm_snapshot.hydrate), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("inventory", inventory))
+    application.add_handler(CommandHandler("abilities", abilities))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("battle", battle_command))
+    application.add_handler(CommandHandler("join", join_battle))
+    application.add_handler(CommandHandler("fight", start_fight))
+    application.add_handler(CommandHandler(["attack", "use"], battle_action))
+    application.add_handler(CommandHandler("flee", flee_battle))
+    
+    application.add_handler(CallbackQueryHandler(handle_class_selection, pattern="^class_"))
+    application.add_handler(CallbackQueryHandler(handle_button_press, pattern="^(show_hint|roll_)"))
+    
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_error_handler(handle_error)
+
+def build_application(with_updater: bool = True) -> Application:
+    """Створює бота з усіма обробниками"""
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        # Без цього оновлення обробляються по одному для всіх гравців
+        .concurrent_updates(True)
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    if session_persistence.enabled:
+        builder = builder.persistence(session_persistence)
+        # Сесії відновлює PTB з бази, знімок тримає лише кеш гравців
+        warm_snapshot.include_sessions = False
+    application = builder.build()
+    register_handlers(application)
+    return application
+
+def build_dispatcher(pool: WorkerPool) -> Application:
+    """Створює вхідний webhook-диспетчер, що пересилає оновлення обробникам"""
+    
+    async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        pool.dispatch(update.to_dict(), WorkerPool.routing_key(update))
+    
+    async def start_supervisor(application: Application):
+        pool.start_supervisor()
+    
+    async def stop_workers(application: Application):
+        await pool.shutdown()
+    
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(start_supervisor)
+        .post_shutdown(stop_workers)
+        .concurrent_updates(True)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, route_update))
+    return application
+
+def main():
+    """Головна функція"""
+    parser = argparse.ArgumentParser(description="RPG Telegram бот")
+    parser.add_argument('--mode', choices=['polling', 'webhook'],
+                        default=os.environ.get('BOT_MODE', 'polling'))
+    args = parser.parse_args()
+    
+    if args.mode == 'polling':
+        application = build_application()
+        logger.info("🎮 RPG Бот запущений!")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        return
+    
+    if not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL не налаштований!")
+        exit(1)
+    
+    if WEBHOOK_WORKERS > 0:
+        pool = WorkerPool(WEBHOOK_WORKERS)
+        pool.start()
+        application = build_dispatcher(pool)
+    else:
+        application = build_application()
+    
+    url_path = f"telegram/{hashlib.sha256(TELEGRAM_BOT_TOKEN.encode()).hexdigest()[:16]}"
+    logger.info(f"🎮 RPG Бот запущений у режимі webhook ({WEBHOOK_WORKERS} обробників)!")
+    application.run_webhook(
+        listen='0.0.0.0',
+        port=WEBHOOK_PORT,
+        url_path=url_path,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{url_path}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES
+    )
+
+if __name__ == '__main__':
+    main()
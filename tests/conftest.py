@@ -0,0 +1,8 @@
+import os
+import sys
+
+# main.py читає обов'язкові змінні середовища при імпорті
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:test')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+os.environ.setdefault('GOOGLE_SCRIPT_URL', 'http://127.0.0.1:1/exec')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,64 @@
+import asyncio
+import queue
+
+import main as bot
+
+
+def test_every_combatant_acts_once_per_round(monkeypatch):
+    # Вороги завжди промахуються, тож бій не скінчиться раніше
+    monkeypatch.setattr(bot.DiceRoller, 'roll', staticmethod(lambda dice, *args, **kwargs: 1))
+    manager = bot.BattleManager(turn_timeout=0, max_rounds=5, max_players=5)
+    battle = bot.Battle(chat_id=-1)
+    for key in ('p1', 'e1', 'p2'):
+        player = bot.Player.from_row({'user_id': int(key[1:]), 'name': key, 'class': 'knight',
+                                      'hp_current': 20, 'hp_max': 20}) if key[0] == 'p' else None
+        battle.combatants[key] = bot.Combatant(key=key, name=key, hp=1000, hp_max=1000, defense=10,
+                                               player=player, enemy=None if player else 'goblin')
+    battle.order = ['p1', 'e1', 'p2']
+    battle.round = 1
+
+    enemy_turns = len(manager._advance(battle))
+    turns = []
+    while manager.outcome(battle) is None:
+        turns.append((battle.round, battle.current.key))
+        enemy_turns += len(manager._advance(battle))
+
+    # Кожен учасник ходить рівно раз на раунд, у порядку ініціативи
+    assert turns == [(round_, key) for round_ in range(1, 6) for key in ('p1', 'p2')]
+    assert enemy_turns == 5
+
+
+def test_battle_reward_keeps_reward_from_private_chat(tmp_path, monkeypatch):
+    storage = bot.SQLiteStorage(str(tmp_path / 'rpg.db'), interval=60, batch_size=100)
+    storage.replicate = False
+    monkeypatch.setattr(bot, 'storage', storage)
+    monkeypatch.setattr(bot, 'player_cache', bot.PlayerCache(100, 60, 600))
+    manager = bot.BattleManager(turn_timeout=0, max_rounds=5, max_players=5)
+    # Бій іде в обробнику групи, а гравець належить іншому
+    manager.outbox = queue.Queue()
+
+    async def scenario():
+        await storage.start()
+        await bot.GoogleSheetsAPI.create_player(5, 'Hero', 'knight')
+        joined = (await bot.GoogleSheetsAPI.get_player(5))['player']
+        battle = bot.Battle(chat_id=-1)
+        battle.combatants['p5'] = bot.Combatant(key='p5', name='Hero', hp=12, hp_max=joined.hp_max,
+                                                defense=10, player=joined, enemy=None)
+        battle.combatants['e1'] = bot.Combatant(key='e1', name='Гоблін', hp=0, hp_max=7,
+                                                defense=12, player=None, enemy='goblin')
+        manager._battles[battle.chat_id] = battle
+        # Поки триває бій, власник гравця записує нагороду з особистого чату
+        await bot.GoogleSheetsAPI.update_player(5, {'xp': joined.xp + 50, 'gold': joined.gold + 20})
+        await manager.finish(battle, 'victory')
+        # Диспетчер пересилає підсумок бою власнику гравця
+        result = manager.outbox.get_nowait()['player_result']
+        await bot.GoogleSheetsAPI.settle_players({result['user_id']: (result['fields'], result['deltas'])})
+        bot.player_cache.invalidate(5)
+        player = (await bot.GoogleSheetsAPI.get_player(5))['player']
+        await storage.stop()
+        return joined, player
+
+    joined, player = asyncio.run(scenario())
+    assert player.xp == joined.xp + 50 + bot.ENEMIES['goblin']['xp']
+    assert player.gold == joined.gold + 20 + bot.ENEMIES['goblin']['gold']
+    assert player.hp_current == 12
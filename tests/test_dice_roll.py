@@ -0,0 +1,66 @@
+import main as bot
+
+
+def make_session(turn_id=2):
+    response = {
+        'main_response': 'Двері замкнені',
+        'dice_required': {'type': 'd20', 'modifier_stat': 'DEX', 'difficulty': 1, 'damage_dice': 'none'},
+        'consequences': {'success': 'Замок клацнув', 'failure': 'Відмичка зламалась'},
+        'xp_reward': 30,
+        'gold_reward': 10,
+    }
+    return {'last_gpt_response': response, 'turn_id': turn_id}
+
+
+def player():
+    return bot.Player.from_row({'user_id': 1, 'name': 'Test', 'class': 'knight', 'xp': 0, 'gold': 0})
+
+
+def always_roll(monkeypatch, value):
+    monkeypatch.setattr(bot.DiceRoller, 'roll', staticmethod(lambda dice, *args, **kwargs: value))
+
+
+def test_current_turn_button_grants_rewards_once(monkeypatch):
+    always_roll(monkeypatch, 15)
+    session = make_session()
+
+    _, updates = bot.resolve_dice_roll('d20+DEX', player(), session, turn_id=2)
+    assert updates == {'xp': 30, 'gold': 10}
+    assert session['last_gpt_response']['xp_reward'] == 0
+
+    _, again = bot.resolve_dice_roll('d20+DEX', player(), session, turn_id=2)
+    assert again == {}
+
+
+def test_button_from_previous_turn_gives_nothing(monkeypatch):
+    always_roll(monkeypatch, 15)
+    session = make_session(turn_id=3)
+
+    text, updates = bot.resolve_dice_roll('d20+DEX', player(), session, turn_id=2)
+    assert updates == {}
+    assert 'Замок клацнув' not in text
+    # Кидок поточного ходу все ще чекає свою кнопку
+    assert session['last_gpt_response']['dice_required']['type'] == 'd20'
+
+    _, updates = bot.resolve_dice_roll('d20+DEX', player(), session)
+    assert updates == {}
+
+
+def test_keyboard_carries_turn_id():
+    keyboard = bot.build_action_keyboard({'type': 'd20', 'modifier_stat': 'STR'}, player(), 7)
+    assert keyboard.inline_keyboard[0][0].callback_data == 'roll_d20+STR@7'
+
+
+def test_oversized_damage_dice_falls_back_to_default(monkeypatch):
+    assert not bot.DiceRoller.is_valid('100000000d6')
+    assert not bot.DiceRoller.is_valid('2d100000')
+    assert bot.DiceRoller.is_valid('100d1000')
+    assert bot.DiceRoller.roll('100000000d6') == 1
+
+    session = make_session()
+    session['last_gpt_response']['dice_required'].update(difficulty=-100, damage_dice='100000000d6')
+    # Кидки без випадковості: d20 дає 10, d4 - 4
+    monkeypatch.setattr(bot.random, 'randint', lambda low, high: min(high, 10))
+    text, _ = bot.resolve_dice_roll('d20+DEX', player(), session, turn_id=2)
+    # Замість 100000000d6 - урон без зброї, d4
+    assert '⚔️ Урон: 4' in text
@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main as bot
+
+
+@pytest.mark.parametrize('text, intent', [
+    ("п'ю зілля", ('potion', None)),
+    ('використовую лікування', ('heal', None)),
+    ('лікую себе', ('heal', None)),
+    ('скільки в мене золота', ('gold', None)),
+    ('скільки у мене хп', ('hp', None)),
+    ('скільки в мене мани', ('mp', None)),
+    ('мана?', ('mp', None)),
+])
+def test_routine_actions_resolve_locally(text, intent):
+    assert bot.fast_path.match(text, {}) == intent
+
+
+@pytest.mark.parametrize('text', [
+    'використовую лікування на друга',
+    'використовую лікування для Олега',
+    'лікую друга',
+    "п'ю зілля для друга",
+    'п’ю зілля, потім атакую',
+])
+def test_actions_with_target_go_to_game_master(text):
+    assert bot.fast_path.match(text, {}) is None
+
+
+def test_routine_action_skips_debounce_window(monkeypatch):
+    player = bot.Player.from_row({'user_id': 1, 'name': 'Test', 'class': 'knight', 'gold': 42})
+    replies = []
+
+    async def require_player(update, context):
+        return player
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    monkeypatch.setattr(bot, 'require_player', require_player)
+    monkeypatch.setattr(bot, 'message_debouncer', bot.MessageDebouncer(window=3600))
+    monkeypatch.setattr(bot.conversation_memory, 'record', lambda *args: None)
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1),
+                             message=SimpleNamespace(text='скільки в мене золота?', reply_text=reply_text))
+
+    async def scenario():
+        application = SimpleNamespace(create_task=lambda coro, update=None: asyncio.create_task(coro))
+        await bot.handle_message(update, SimpleNamespace(user_data={}, application=application))
+        await asyncio.sleep(0.05)
+
+    asyncio.run(scenario())
+    assert replies == ['💰 У вас 42 золота.']
@@ -0,0 +1,86 @@
+import asyncio
+from types import SimpleNamespace
+
+import main as bot
+
+
+class FakeMessage:
+    def __init__(self, edit_delay=0.0):
+        self.edit_delay = edit_delay
+        self.edits = []
+        self.deleted = False
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        reply = FakeMessage(self.edit_delay)
+        self.replies.append(reply)
+        return reply
+
+    async def edit_text(self, text, reply_markup=None):
+        await asyncio.sleep(self.edit_delay)
+        self.edits.append(text)
+
+    async def delete(self):
+        self.deleted = True
+
+
+def setup_turn(monkeypatch):
+    player = bot.Player.from_row({'user_id': 1, 'name': 'Test', 'class': 'knight'})
+
+    async def require_player(update, context):
+        return player
+
+    async def not_routine(*args):
+        return False
+
+    async def gm_answer(prompt, player, context='', on_progress=None):
+        return {'main_response': 'Двері відчинено', 'dice_required': {'type': 'none'}, 'action_type': 'simple'}
+
+    monkeypatch.setattr(bot, 'require_player', require_player)
+    monkeypatch.setattr(bot.fast_path, 'try_handle', not_routine)
+    monkeypatch.setattr(bot.RPGGameLogic, 'stream_gpt_response', gm_answer)
+
+
+def test_cancel_during_finish_removes_thinking_message(monkeypatch):
+    setup_turn(monkeypatch)
+    message = FakeMessage(edit_delay=3600)
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1), message=message)
+    context = SimpleNamespace(user_data={})
+
+    async def scenario():
+        turn = asyncio.create_task(bot.run_gm_turn(update, context, 'відчиняю двері'))
+        await asyncio.sleep(0.05)
+        turn.cancel()
+        try:
+            await turn
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(scenario())
+
+    assert message.replies[0].deleted
+
+
+def test_debouncer_runs_turn_through_spawn():
+    debouncer = bot.MessageDebouncer(0.01)
+    spawned = []
+    actions = []
+
+    async def start_turn(action):
+        actions.append(action)
+
+    def spawn(turn):
+        task = asyncio.create_task(turn)
+        spawned.append(task)
+        return task
+
+    async def scenario():
+        debouncer.submit(1, 'йду', start_turn, spawn)
+        debouncer.submit(1, 'до лісу', start_turn, spawn)
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*spawned)
+
+    asyncio.run(scenario())
+
+    assert len(spawned) == 1
+    assert actions == ['йду\nдо лісу']
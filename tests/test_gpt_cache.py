@@ -0,0 +1,47 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import main as bot
+
+
+def fake_openai(monkeypatch):
+    calls = []
+
+    async def create(**kwargs):
+        calls.append(kwargs)
+        content = json.dumps({'main_response': f'Відповідь {len(calls)}', 'action_type': 'simple'})
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    monkeypatch.setattr(bot, 'openai_client', SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+    monkeypatch.setattr(bot, 'gpt_cache', bot.GPTResponseCache(max_size=100, ttl=60, variants=1))
+    return calls
+
+
+def test_routine_action_hits_cache_with_conversation_memory(monkeypatch):
+    calls = fake_openai(monkeypatch)
+    player = bot.Player.from_row({'user_id': 1, 'name': 'Test', 'class': 'knight'})
+
+    async def scenario():
+        first = await bot.RPGGameLogic.get_gpt_response('Оглядаюсь', player, 'Гравець: йду в ліс')
+        # Пам'ять розмови вже інша, а рутинна дія та сама
+        second = await bot.RPGGameLogic.get_gpt_response('оглядаюсь!', player, 'Гравець: оглядаюсь')
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == second
+    assert len(calls) == 1
+    assert bot.gpt_cache.hits == 1
+
+
+def test_complex_action_with_memory_is_not_cached(monkeypatch):
+    calls = fake_openai(monkeypatch)
+    player = bot.Player.from_row({'user_id': 1, 'name': 'Test', 'class': 'knight'})
+    action = 'Підкрадаюсь до вартового і, поки він спить, краду ключ, а потім відчиняю браму'
+
+    async def scenario():
+        for _ in range(2):
+            await bot.RPGGameLogic.get_gpt_response(action, player, 'Гравець: йду до замку')
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
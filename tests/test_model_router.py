@@ -0,0 +1,28 @@
+import main as bot
+
+PLAN = "Я скрадаюсь до гобліна, б'ю його кинджалом і обшукую тіло"
+
+
+def make_router(heavy_model=''):
+    return bot.ModelRouter('gpt-4o-mini', heavy_model, 4, 20, 2)
+
+
+def test_heavy_model_is_opt_in():
+    assert bot.OPENAI_HEAVY_MODEL == '' or 'OPENAI_HEAVY_MODEL' in bot.os.environ
+    model, max_tokens, _ = make_router().route(PLAN, 1)
+    assert model == 'gpt-4o-mini'
+    assert max_tokens == bot.ModelRouter.HEAVY_TOKENS
+
+
+def test_complex_plans_use_configured_heavy_model():
+    router = make_router('gpt-4o')
+    assert router.route('Я відкриваю двері', 1)[0] == 'gpt-4o-mini'
+    assert router.route(PLAN, 1)[0] == 'gpt-4o'
+
+
+def test_timeout_follows_measured_latency():
+    router = make_router()
+    assert router.route('відкриваю двері', 1)[2] == bot.ModelRouter.DEFAULT_TIMEOUT
+    for _ in range(bot.ModelRouter.MIN_SAMPLES):
+        router.observe('gpt-4o-mini', 3.0)
+    assert router.route('відкриваю двері', 1)[2] == 6.0
@@ -0,0 +1,37 @@
+import copy
+import dataclasses
+import pickle
+
+import pytest
+
+import main as bot
+
+
+def make_player(**row):
+    return bot.Player.from_row(dict({'user_id': 1, 'name': 'Test', 'class': 'knight', 'gold': 10}, **row))
+
+
+def test_player_is_frozen_and_updates_drop_memo():
+    player = make_player()
+    sheet = player.memo('prompt_sheet', bot.RPGGameLogic.render_player_sheet)
+    assert player.memo('prompt_sheet', lambda p: 'інше') is sheet
+
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        player.gold = 99
+
+    richer = player.with_updates({'gold': 99})
+    assert 'золото 99' in richer.memo('prompt_sheet', bot.RPGGameLogic.render_player_sheet)
+
+
+def test_player_survives_pickle_and_copy():
+    player = make_player(str=16)
+    player.memo('fingerprint', bot.GPTResponseCache.player_fingerprint)
+    for clone in (pickle.loads(pickle.dumps(player)), copy.deepcopy(player)):
+        assert clone == player
+        assert clone.modifier('str') == 3
+
+
+def test_stats_pool_is_bounded():
+    for strength in range(bot.STATS_POOL_SIZE + 10):
+        make_player(str=strength)
+    assert bot.pooled_stats.cache_info().currsize <= bot.STATS_POOL_SIZE
@@ -0,0 +1,28 @@
+from telegram import Update
+
+import main as bot
+
+
+def message_update(user_id, chat, text='/join'):
+    return Update.de_json({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'chat': chat, 'text': text,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'P'},
+    }}, None)
+
+
+def test_group_updates_go_to_one_worker():
+    group = {'id': -100500, 'type': 'supergroup', 'title': 'Party'}
+    keys = {bot.WorkerPool.routing_key(message_update(user_id, group)) for user_id in (1, 2, 3)}
+    assert keys == {-100500}
+
+
+def test_group_story_goes_to_player_owner():
+    group = {'id': -100500, 'type': 'supergroup', 'title': 'Party'}
+    assert bot.WorkerPool.routing_key(message_update(7, group, 'Відкриваю двері')) == 7
+    assert bot.WorkerPool.routing_key(message_update(7, group, '/stats')) == 7
+    assert bot.WorkerPool.routing_key(message_update(7, group, '/attack@rpg_bot 1')) == -100500
+
+
+def test_private_updates_route_by_player():
+    update = message_update(42, {'id': 42, 'type': 'private'})
+    assert bot.WorkerPool.routing_key(update) == 42
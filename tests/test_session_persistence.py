@@ -0,0 +1,39 @@
+import asyncio
+import sqlite3
+
+import main as bot
+
+
+def test_locked_session_database_does_not_block_event_loop(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    persistence = bot.SessionPersistence(path, update_interval=60, ttl=3600)
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    async def scenario():
+        await persistence.get_user_data()
+        # Інший процес тримає блокування запису
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        clock = asyncio.create_task(ticker())
+        await persistence.update_user_data(1, {'turn_id': 3})
+        await asyncio.sleep(0.3)
+        other.execute('COMMIT')
+        other.close()
+        await persistence.flush()
+        clock.cancel()
+
+        restored = bot.SessionPersistence(path, update_interval=60, ttl=3600)
+        user_data = await restored.get_user_data()
+        await restored.flush()
+        return user_data
+
+    user_data = asyncio.run(scenario())
+
+    assert ticks >= 10
+    assert user_data == {1: {'turn_id': 3}}
@@ -0,0 +1,41 @@
+import asyncio
+import sqlite3
+
+import main as bot
+
+
+def test_locked_database_does_not_block_event_loop(tmp_path):
+    path = str(tmp_path / 'rpg.db')
+    storage = bot.SQLiteStorage(path, interval=60, batch_size=100)
+    storage.replicate = False
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    async def scenario():
+        await storage.start()
+        await storage.create_player(1, {'user_id': 1, 'name': 'A', 'gold': 0})
+        # Інший процес тримає блокування запису
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        clock = asyncio.create_task(ticker())
+        update = asyncio.create_task(storage.update_player(1, {'gold': 5}))
+        await asyncio.sleep(0.3)
+        other.execute('COMMIT')
+        other.close()
+        await update
+        clock.cancel()
+        player = (await storage.fetch_player(1))['player']
+        stats = storage.stats()
+        await storage.stop()
+        return player, stats
+
+    player, stats = asyncio.run(scenario())
+
+    assert ticks >= 10
+    assert player['gold'] == 5
+    assert stats['players'] == 1 and stats['dirty_players'] == 1
@@ -0,0 +1,41 @@
+import asyncio
+import time
+
+import main as bot
+
+
+class SlowMessage:
+    """Повідомлення Telegram, редагування якого довго чекає (flood wait)"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.edits = []
+
+    async def edit_text(self, text, reply_markup=None):
+        await asyncio.sleep(self.delay)
+        self.edits.append(text)
+
+
+def test_progress_does_not_wait_for_telegram(monkeypatch):
+    monkeypatch.setattr(bot, 'STREAM_EDIT_INTERVAL', 0)
+    player = bot.Player.from_row({'user_id': 1, 'name': 'Test', 'class': 'knight'})
+    message = SlowMessage(0.2)
+    editor = bot.StreamingMessageEditor(message, player)
+    parser = bot.StreamingJSONParser()
+
+    async def scenario():
+        started = time.perf_counter()
+        parser.feed('{"main_response": "')
+        for _ in range(20):
+            parser.feed('Гоблін відступає. ')
+            editor.on_progress(parser)
+        elapsed = time.perf_counter() - started
+        await editor.finish({'main_response': 'Кінець', 'dice_required': {'type': 'none'}})
+        return elapsed
+
+    elapsed = asyncio.run(scenario())
+
+    assert elapsed < 0.1
+    # Проміжні фрагменти злились, останнім показано фінальний текст
+    assert len(message.edits) <= 3
+    assert 'Кінець' in message.edits[-1]
@@ -0,0 +1,32 @@
+import asyncio
+import json
+
+import main as bot
+
+
+def test_stop_during_slow_send_journals_inflight_batch(tmp_path):
+    journal = tmp_path / 'pending_writes.json'
+    buffer = bot.WriteBehindBuffer(interval=0.01, max_batch=100, journal_path=str(journal))
+    sent = []
+
+    async def slow_sender(payload):
+        sent.append(payload)
+        if len(sent) == 1:
+            await asyncio.sleep(3600)
+        # Сховище так і не відповіло - фінальний скид теж не вдається
+        return {'success': False, 'error': 'down'}
+
+    async def scenario():
+        buffer.start(slow_sender)
+        buffer.add_update(1, {'gold': 99})
+        while not sent:
+            await asyncio.sleep(0.01)
+        # Новіша зміна, поки пакет у дорозі
+        buffer.add_update(1, {'xp': 5})
+        await buffer.stop()
+
+    asyncio.run(scenario())
+
+    assert sent[0]['players'] == [{'gold': 99, 'user_id': '1'}]
+    saved = json.loads(journal.read_text(encoding='utf-8'))
+    assert saved['players'] == [[1, {'gold': 99, 'xp': 5}]]